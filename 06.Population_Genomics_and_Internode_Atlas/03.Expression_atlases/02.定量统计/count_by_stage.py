@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+'''
+按时期 × 基因类别（scaf/SO/SS）统计表达/过滤基因数，替代 count_by_stage.sh
+
+基因列表（YZ.{类别}.gene.list）只读一次并放入哈希集合；每个时期的原始矩阵和过滤后矩阵
+只逐行读取第1列的基因ID，不写临时文件，也不对每个 时期×类别 重新扫描列表。
+输出 expression_summary.tsv（与 count_by_stage.sh 相同的列），plot.r 直接读取该表作图：
+    Stage  Type  Total  Expressed  Filtered
+    Total     = 基因列表的行数（同 wc -l）
+    Expressed = 在原始矩阵中、不在过滤后矩阵中的该类基因数（同 grep -Fvxf filt all）
+    Filtered  = 在过滤后矩阵中的该类基因数
+'''
+
+import os
+import click
+
+DEFAULT_TYPES = ['scaf', 'SO', 'SS']
+
+def read_gene_list(path):
+    """读取基因列表，返回 (基因ID集合, 行数)"""
+    with open(path) as f:
+        lines = f.read().splitlines()
+    return set(lines), len(lines)
+
+def iter_ids(path):
+    """逐行读取表达矩阵第1列的基因ID（跳过表头），同 cut -f1 | tail -n +2"""
+    with open(path) as f:
+        next(f, None)
+        for line in f:
+            yield line.rstrip('\n').split('\t', 1)[0]
+
+def count_stage(original_file, filtered_file, gene_sets):
+    """
+    统计一个时期每个基因类别的表达/过滤基因数。
+
+    参数:
+        gene_sets (dict): 类别 -> 基因ID集合。
+    返回:
+        dict: 类别 -> (Expressed, Filtered)。
+    """
+    filtered = list(iter_ids(filtered_file))
+    filtered_set = set(filtered)
+    counts = {}
+    for name, genes in gene_sets.items():
+        counts[name] = [0, sum(1 for g in filtered if g in genes)]
+    for gene in iter_ids(original_file):
+        if gene in filtered_set:
+            continue
+        for name, genes in gene_sets.items():
+            if gene in genes:
+                counts[name][0] += 1
+    return {name: tuple(c) for name, c in counts.items()}
+
+def summarize(stages, types, output_file):
+    """
+    参数:
+        stages (list): (时期名, 原始矩阵, 过滤后矩阵)。
+        types (list): (类别名, 基因列表文件)。
+    """
+    gene_sets, totals = {}, {}
+    for name, path in types:
+        gene_sets[name], totals[name] = read_gene_list(path)
+    with open(output_file, 'w') as out:
+        out.write('Stage\tType\tTotal\tExpressed\tFiltered\n')
+        for stage, original_file, filtered_file in stages:
+            counts = count_stage(original_file, filtered_file, gene_sets)
+            for name, _ in types:
+                out.write(f"{stage}\t{name}\t{totals[name]}\t{counts[name][0]}\t{counts[name][1]}\n")
+            print(f"  * {stage}: {original_file} / {filtered_file}")
+    print(f"Expression summary saved to: {output_file}")
+
+@click.command()
+@click.option('--original', '-i', multiple=True,
+              help='Original expression matrix per stage (default: stage{1..4}_ori_expression_data.tsv)')
+@click.option('--filtered', '-f', multiple=True, help='Filtered expression matrix per stage (default: stage{1..4}.filter.tsv)')
+@click.option('--stage', '-s', multiple=True, help='Stage name for each matrix pair (default: stage1..N)')
+@click.option('--type', '-t', 'types', multiple=True,
+              help='Gene class as NAME or NAME=LIST (list default: YZ.NAME.gene.list; default classes: scaf SO SS)')
+@click.option('--output', '-o', default='expression_summary.tsv', show_default=True, help='Output summary table (read by plot.r)')
+def main(original, filtered, stage, types, output):
+    """统计各时期各基因类别的表达/过滤基因数，写出 expression_summary.tsv。"""
+    if not original:
+        original = [f"stage{s}_ori_expression_data.tsv" for s in range(1, 5)]
+        filtered = filtered or [f"stage{s}.filter.tsv" for s in range(1, 5)]
+    if len(original) != len(filtered):
+        raise click.BadParameter("--original and --filtered must be given the same number of times")
+    stage = stage or [f"stage{s}" for s in range(1, len(original) + 1)]
+    if len(stage) != len(original):
+        raise click.BadParameter("One --stage is required per matrix pair")
+    type_files = []
+    for t in types or DEFAULT_TYPES:
+        name, _, path = t.partition('=')
+        type_files.append((name, path or f"YZ.{name}.gene.list"))
+    for path in list(original) + list(filtered) + [p for _, p in type_files]:
+        if not os.path.exists(path):
+            raise click.FileError(path, hint='file not found')
+    summarize(list(zip(stage, original, filtered)), type_files, output)
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,12 @@
 #!/usr/bin/env bash
 # count_by_stage.sh  — four stages × (scaf/SO/SS)
+# 需已有：YZ.scaf.gene.list  YZ.SO.gene.list  YZ.SS.gene.list
+# 基因列表读入哈希集合，每个矩阵只读一遍ID列（原为 grep -Fvxf / grep -Fxf 逐个时期×类别扫描）
 
-
-
-lists=(scaf SO SS)      # 需已有：YZ.scaf.gene.list  YZ.SO.gene.list  YZ.SS.gene.list
-echo -e "Stage\tType\tTotal\tExpressed\tFiltered" > expression_summary.tsv
-
+args=()
 for s in 1 2 3 4; do
-  orig="stage${s}_ori_expression_data.tsv"
-  filt="stage${s}.filter.tsv"
-
-  cut -f1 "$orig" | tail -n +2 > all.tmp
-  cut -f1 "$filt" | tail -n +2 > filt.tmp
-  grep -Fvxf filt.tmp all.tmp > expr.tmp
-
-  for t in "${lists[@]}"; do
-    list="YZ.${t}.gene.list"
-    total=$(wc -l < "$list")
-    expr=$(grep -Fxf "$list" expr.tmp | wc -l)
-    filn=$(grep -Fxf "$list" filt.tmp | wc -l)
-    echo -e "stage${s}\t${t}\t${total}\t${expr}\t${filn}" >> expression_summary.tsv
-  done
-
-  rm -f all.tmp filt.tmp expr.tmp
+  args+=(-i stage${s}_ori_expression_data.tsv -f stage${s}.filter.tsv -s stage${s})
 done
+python3 count_by_stage.py "${args[@]}" -t scaf -t SO -t SS -o expression_summary.tsv
 
 cat expression_summary.tsv
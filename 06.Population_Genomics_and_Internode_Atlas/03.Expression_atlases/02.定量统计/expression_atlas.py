@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+'''
+表达图谱内存映射存储
+
+把各时期的 kallisto 表达矩阵（stage{i}_ori_expression_data.tsv，行为基因、列为样品）
+一次性转换为 float32 的 时期 × 基因 × 样品 张量（expression.npy），并附带索引文件：
+    genes.tsv          基因ID和亚基因组标签（scaf/SO/SS，来自 YZ-SO-SS-gene 谱系列表）
+    samples.tsv        全部样品（各时期样品的并集）
+    stages.tsv         时期名和来源文件
+    stage_samples.tsv  每个时期的样品及其在原文件中的顺序
+    present.npy        时期 × 基因 的布尔矩阵，基因是否出现在该时期的原文件中
+    gene_order.npy     每个时期原文件中基因的顺序（图谱行号，不足处为 -1）
+某时期缺少的基因/样品在张量中为 NaN。之后的 Python 步骤通过 ExpressionAtlas 内存映射打开，
+按时期、亚基因组或基因列表取子矩阵，不再解析文本。
+'''
+
+import os
+import shutil
+import click
+import numpy as np
+import pandas as pd
+
+EXPRESSION_FILE = 'expression.npy'
+PRESENT_FILE = 'present.npy'
+GENE_ORDER_FILE = 'gene_order.npy'
+GENES_FILE = 'genes.tsv'
+SAMPLES_FILE = 'samples.tsv'
+STAGES_FILE = 'stages.tsv'
+STAGE_SAMPLES_FILE = 'stage_samples.tsv'
+# 谱系列表整行中出现的关键字 -> 亚基因组标签（关键字同 run.sh 中的 grep scaffold/SO/SS）
+SUBGENOME_PATTERNS = [('scaf', 'scaffold'), ('SO', 'SO'), ('SS', 'SS')]
+
+def load_subgenome_labels(gene_list):
+    """
+    读取 YZ-SO-SS-gene 谱系列表（第1列为基因ID），返回 基因ID -> 亚基因组标签。
+    每个基因只有一个标签：按 scaffold、SO、SS 的顺序取该行包含的第一个关键字，同一基因出现多行时以第一行为准。
+    run.sh 中的 grep 不互斥（同时包含 scaffold 和 SO 的行会同时进入 YZ.scaf.gene.list 和 YZ.SO.gene.list），
+    因此按亚基因组取基因时与这些列表可能不完全相同。
+    """
+    labels = {}
+    with open(gene_list) as f:
+        for line in f:
+            gene = line.rstrip('\n').split('\t')[0]
+            for label, pattern in SUBGENOME_PATTERNS:
+                if pattern in line:
+                    labels.setdefault(gene, label)
+                    break
+    return pd.Series(labels, dtype=object)
+
+def build_atlas(expression_files, atlas_dir, stages=None, gene_list=None, chunksize=20000):
+    """
+    将各时期的表达矩阵写入 atlas_dir（已存在则替换）。
+
+    参数:
+        expression_files (list): 各时期的表达矩阵（第1列为基因ID）。
+        stages (list): 时期名，默认为文件名（不含扩展名）。
+        gene_list (str): YZ-SO-SS-gene 谱系列表，为空时亚基因组标签为空。
+    """
+    stages = list(stages) if stages else [os.path.splitext(os.path.basename(f))[0] for f in expression_files]
+    if len(stages) != len(expression_files):
+        raise ValueError("One stage name is required per expression file")
+
+    # 第一遍只读基因ID列和表头，确定基因和样品的并集（按首次出现的顺序）
+    stage_samples, gene_ids = [], []
+    for path in expression_files:
+        header = pd.read_csv(path, sep='\t', nrows=0).columns
+        stage_samples.append(list(header[1:]))
+        gene_ids.append(pd.read_csv(path, sep='\t', usecols=[0], dtype=str).iloc[:, 0])
+    genes = pd.Index(pd.concat(gene_ids).unique())
+    samples = pd.Index(list(dict.fromkeys(s for names in stage_samples for s in names)))
+    print(f"Building expression atlas: {len(stages)} stages x {len(genes)} genes x {len(samples)} samples")
+
+    # 先写到临时目录，完成后再改名
+    tmp_dir = f"{atlas_dir.rstrip('/')}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    expression = np.lib.format.open_memmap(os.path.join(tmp_dir, EXPRESSION_FILE), mode='w+', dtype=np.float32,
+                                           shape=(len(stages), len(genes), len(samples)))
+    present = np.zeros((len(stages), len(genes)), dtype=bool)
+    for s, path in enumerate(expression_files):
+        expression[s] = np.nan
+        cols = samples.get_indexer(stage_samples[s])
+        for chunk in pd.read_csv(path, sep='\t', index_col=0, chunksize=chunksize):
+            rows = genes.get_indexer(chunk.index.astype(str))
+            # 与 cal_sum_uniq.py 相同：按 float64 解析后转换为 float32
+            expression[s][np.ix_(rows, cols)] = chunk.values.astype(np.float32)
+            present[s, rows] = True
+        print(f"  * {stages[s]}: {int(present[s].sum())} genes x {len(cols)} samples from {path}")
+    expression.flush()
+    del expression
+    np.save(os.path.join(tmp_dir, PRESENT_FILE), present)
+    gene_order = np.full((len(stages), len(genes)), -1, dtype=np.int64)
+    for s, ids in enumerate(gene_ids):
+        rows = genes.get_indexer(ids.unique())
+        gene_order[s, :len(rows)] = rows
+    np.save(os.path.join(tmp_dir, GENE_ORDER_FILE), gene_order)
+
+    labels = load_subgenome_labels(gene_list) if gene_list else pd.Series(dtype=object)
+    pd.DataFrame({'gene_id': genes, 'subgenome': labels.reindex(genes).fillna('').values}).to_csv(
+        os.path.join(tmp_dir, GENES_FILE), sep='\t', index=False)
+    pd.DataFrame({'sample': samples}).to_csv(os.path.join(tmp_dir, SAMPLES_FILE), sep='\t', index=False)
+    pd.DataFrame({'stage': stages, 'source': [os.path.abspath(f) for f in expression_files]}).to_csv(
+        os.path.join(tmp_dir, STAGES_FILE), sep='\t', index=False)
+    pd.DataFrame([(stage, sample) for stage, names in zip(stages, stage_samples) for sample in names],
+                 columns=['stage', 'sample']).to_csv(os.path.join(tmp_dir, STAGE_SAMPLES_FILE), sep='\t', index=False)
+
+    if os.path.exists(atlas_dir):
+        shutil.rmtree(atlas_dir)
+    os.rename(tmp_dir, atlas_dir)
+    print(f"Expression atlas saved to: {atlas_dir}")
+    return atlas_dir
+
+class ExpressionAtlas:
+    """
+    表达图谱查询接口（内存映射，不读入整个张量）：
+
+        atlas = ExpressionAtlas(atlas_dir)
+        atlas.frame('stage1')                      # 该时期原文件中的全部基因和样品
+        atlas.frame('stage2', subgenome='SO')      # 只取 SO 亚基因组基因
+        atlas.frame('stage3', genes=gene_list)     # 按基因列表顺序取
+    取全部基因和样品时直接返回内存映射的视图，不复制数据。
+    """
+
+    def __init__(self, atlas_dir):
+        self.atlas_dir = atlas_dir
+        self.expression = np.load(os.path.join(atlas_dir, EXPRESSION_FILE), mmap_mode='r')
+        self.present = np.load(os.path.join(atlas_dir, PRESENT_FILE), mmap_mode='r')
+        self.gene_order = np.load(os.path.join(atlas_dir, GENE_ORDER_FILE), mmap_mode='r')
+        genes_df = pd.read_csv(os.path.join(atlas_dir, GENES_FILE), sep='\t', dtype=str, keep_default_na=False)
+        self.genes = pd.Index(genes_df['gene_id'])
+        self.subgenome = genes_df['subgenome'].values
+        self.samples = pd.Index(pd.read_csv(os.path.join(atlas_dir, SAMPLES_FILE), sep='\t', dtype=str)['sample'])
+        self.stages = pd.Index(pd.read_csv(os.path.join(atlas_dir, STAGES_FILE), sep='\t', dtype=str)['stage'])
+        stage_samples = pd.read_csv(os.path.join(atlas_dir, STAGE_SAMPLES_FILE), sep='\t', dtype=str)
+        self._stage_samples = {stage: pd.Index(df['sample']) for stage, df in stage_samples.groupby('stage', sort=False)}
+
+    def stage_samples(self, stage):
+        """该时期的样品（原文件中的列顺序）"""
+        return self._stage_samples[stage]
+
+    def gene_rows(self, stage, subgenome=None, genes=None):
+        """该时期要取的基因行号：genes 按给定顺序（不在该时期的跳过），否则按原文件顺序并可按亚基因组过滤"""
+        s = self.stages.get_loc(stage)
+        if genes is not None:
+            rows = self.genes.get_indexer(pd.Index(genes).astype(str))
+            return rows[(rows >= 0) & self.present[s][np.maximum(rows, 0)]]
+        rows = np.asarray(self.gene_order[s][:int(self.present[s].sum())])
+        if subgenome is not None:
+            rows = rows[np.isin(self.subgenome[rows], [subgenome] if isinstance(subgenome, str) else list(subgenome))]
+        return rows
+
+    def matrix(self, stage, subgenome=None, genes=None):
+        """返回 (表达矩阵, 基因ID, 样品名)；选取全部基因和样品时为内存映射视图"""
+        values = self.expression[self.stages.get_loc(stage)]
+        rows = self.gene_rows(stage, subgenome=subgenome, genes=genes)
+        if not np.array_equal(rows, np.arange(values.shape[0])):
+            values = values[rows]
+        stage_samples = self.stage_samples(stage)
+        cols = self.samples.get_indexer(stage_samples)
+        if not np.array_equal(cols, np.arange(len(self.samples))):
+            values = np.take(values, cols, axis=1)
+        return values, self.genes[rows], stage_samples
+
+    def iter_chunks(self, stage, chunksize=5000, subgenome=None, genes=None):
+        """同 matrix()，按基因分块依次返回 (基因ID, 基因×样品 矩阵)，每次只读入一个块"""
+        values = self.expression[self.stages.get_loc(stage)]
+        rows = self.gene_rows(stage, subgenome=subgenome, genes=genes)
+        cols = self.samples.get_indexer(self.stage_samples(stage))
+        for start in range(0, len(rows), chunksize):
+            block = rows[start:start + chunksize]
+            yield self.genes[block], np.take(values[block], cols, axis=1)
+
+    def frame(self, stage, subgenome=None, genes=None):
+        """同 matrix()，以基因为行、样品为列的 DataFrame 返回"""
+        values, gene_ids, samples = self.matrix(stage, subgenome=subgenome, genes=genes)
+        return pd.DataFrame(values, index=gene_ids, columns=samples, copy=False)
+
+@click.command()
+@click.option('--expression-file', '-i', required=True, multiple=True,
+              help='Stage expression matrix, e.g. stage1_ori_expression_data.tsv (can be given multiple times)')
+@click.option('--stage', '-s', multiple=True, help='Stage name for each expression file (default: file name)')
+@click.option('--gene-list', '-g', default=None, help='YZ-SO-SS-gene lineage list for subgenome labels')
+@click.option('--atlas-dir', '-o', required=True, help='Output atlas directory')
+def main(expression_file, stage, gene_list, atlas_dir):
+    """一次性把各时期的表达矩阵转换为内存映射的表达图谱。"""
+    build_atlas(expression_file, atlas_dir, stages=stage, gene_list=gene_list)
+
+if __name__ == "__main__":
+    main()
@@ -6,31 +6,23 @@ suppressPackageStartupMessages({
   library(dplyr)
   library(tidyr)
   library(scales)
-  library(tibble)  # for tribble
+  library(tibble)
 })
 
-# ---------- 1) 嵌入数据 ----------
-df <- tribble(
-  ~Stage, ~Type,   ~Total,  ~Expressed, ~Filtered,
-  "stage1","scaf", 12107,   4602,       7505,
-  "stage1","SO",   243853,  85592,      158261,
-  "stage1","SS",   126589,  46273,      80316,
-  "stage2","scaf", 12107,   4965,       7142,
-  "stage2","SO",   243853,  93097,      150756,
-  "stage2","SS",   126589,  50455,      76134,
-  "stage3","scaf", 12107,   4986,       7121,
-  "stage3","SO",   243853,  94278,      149575,
-  "stage3","SS",   126589,  50698,      75891,
-  "stage4","scaf", 12107,   5019,       7088,
-  "stage4","SO",   243853,  94430,      149423,
-  "stage4","SS",   126589,  50422,      76167
-)
+# ---------- 1) 读入数据 ----------
+# expression_summary.tsv 由 count_by_stage.py 生成（Stage/Type/Total/Expressed/Filtered），
+# 可用第1个命令行参数指定其他路径
+args <- commandArgs(trailingOnly = TRUE)
+summary_file <- if (length(args) >= 1) args[1] else "expression_summary.tsv"
+df <- read.delim(summary_file, stringsAsFactors = FALSE)
+stage_levels <- unique(df$Stage)
+n_stage <- length(stage_levels)
 
 # ---------- 2) 预处理：同心环映射 ----------
 df <- df %>%
   mutate(
-    Stage = factor(Stage, levels = paste0("stage", 1:4)),
-    ring  = as.numeric(Stage),                                # 内→外 = 1..4
+    Stage = factor(Stage, levels = stage_levels),
+    ring  = as.numeric(Stage),                                # 内→外 = 1..N
     Type  = factor(Type, levels = c("SO","SS","scaf"),
                    labels = c("So","Ss","Sca"))
   )
@@ -62,7 +54,7 @@ p_filt_mean <- 1 - p_expr_mean
 mean_total_inner <- mean(stage_sum$Expr + stage_sum$Filt)  # 放大量级确保可见
 
 outer_long <- tibble(
-  ring = 5,
+  ring = n_stage + 1,
   Status = factor(c("Expression observed","No expression"),
                   levels = c("Expression observed","No expression")),
   Count = c(p_expr_mean, p_filt_mean) * mean_total_inner,
@@ -130,7 +122,7 @@ p <- ggplot() +
   ) +
   scale_color_identity(guide = "none") +
   coord_polar(theta = "y", clip = "off") +
-  scale_x_continuous(limits = c(0.0, 6.2), breaks = 1:5) +  # 充足外缘防裁切
+  scale_x_continuous(limits = c(0.0, n_stage + 2.2), breaks = 1:(n_stage + 1)) +  # 充足外缘防裁切
   scale_fill_manual(values = pal, breaks = names(legend_labels),
                     labels = unname(legend_labels),
                     name = "Gene class and status") +
@@ -147,8 +139,8 @@ p <- ggplot() +
 
 # 圈层标签（0°方向）
 stage_labels <- tibble(
-  ring = 1:5, y = 0,
-  txt = c("Stage 1","Stage 2","Stage 3","Stage 4","Overall (mean)")
+  ring = 1:(n_stage + 1), y = 0,
+  txt = c(sub("^stage", "Stage ", stage_levels), "Overall (mean)")
 )
 p <- p + geom_text(data = stage_labels, aes(x = ring, y = y, label = txt),
                    inherit.aes = FALSE, size = 4, fontface = "bold")
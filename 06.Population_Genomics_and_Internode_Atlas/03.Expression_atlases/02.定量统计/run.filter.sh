@@ -1,7 +1,10 @@
 
 ## 过滤基因
 # TPM > 0.01 定义为表达，保留至少50个样本表达的基因；
+# 4个时期在同一次运行中处理（原为 Rscript prepare_gene_expression_onlyfilter.R 逐个时期运行）
+args=()
 for i in 1 2 3 4
 do
-Rscript prepare_gene_expression_onlyfilter.R stage${i}_ori_expression_data.tsv 50 stage${i}.filter.tsv
+args+=(-i stage${i}_ori_expression_data.tsv -o stage${i}.filter.tsv)
 done
+python3 ../03.剂量累加/prepare_gene_expression.py "${args[@]}" -m 50 --only-filter
@@ -8,6 +8,16 @@ grep scaffold ${gene_list} |cut -f1 > YZ.scaf.gene.list
 grep SO ${gene_list} |cut -f1 > YZ.SO.gene.list
 grep SS ${gene_list} |cut -f1 > YZ.SS.gene.list
 
+# 一次性把4个时期的表达矩阵转换为内存映射的表达图谱（float32，附带亚基因组标签），
+# 之后的 Python 步骤可用 --atlas expression_atlas 直接读取，不再解析文本
+# （03.剂量累加/04.cal_sum.sh 在图谱存在时使用；pca_analysis_common.py 也支持 --atlas）
+args=()
+for i in 1 2 3 4
+do
+args+=(-i stage${i}_ori_expression_data.tsv -s stage${i})
+done
+python3 expression_atlas.py "${args[@]}" -g ${gene_list} -o expression_atlas
+
 # 统计过滤和非过滤的非类基因占比
 
 
@@ -1,8 +1,21 @@
-
-
 # 根据等位基因表，计算每个簇的总表达情况并区分亚基因组
+# cluster 表只解析一次，4个时期在同一次运行中并行计算，输出仍按时期分开
+# --incremental：等位基因表修订后只重新计算基因列表或成员表达有变化的 cluster
 
+# 02.定量统计/run.sh 已在表达矩阵目录下生成表达图谱时，直接从图谱内存映射读取（--expression-file 为时期名），
+# 否则解析原始表达矩阵
+expr_dir=/public/home/agis_xiazq/project/000.Nature/12-1.transcriptome/09.YZ_genome_kallisto_pop/02.gene.expre
+args=()
+if [ -d ${expr_dir}/expression_atlas ]; then
+args+=(--atlas ${expr_dir}/expression_atlas)
+fi
 for i in 1 2 3 4
 do
-~/miniconda3/bin/python3 cal_sum_uniq.py --cluster-file /public/home/agis_xiazq/project/02.YZ/R2.SubGenome/03.allele_defined_subgenome/03.get-allele-table/genes_output.tsv --expression-file /public/home/agis_xiazq/project/000.Nature/12-1.transcriptome/09.YZ_genome_kallisto_pop/02.gene.expre/stage${i}_ori_expression_data.tsv --output-prefix stage${i}_sum_expression_data
+if [ -d ${expr_dir}/expression_atlas ]; then
+args+=(--expression-file stage${i} --output-prefix stage${i}_sum_expression_data)
+else
+args+=(--expression-file ${expr_dir}/stage${i}_ori_expression_data.tsv --output-prefix stage${i}_sum_expression_data)
+fi
 done
+
+~/miniconda3/bin/python3 cal_sum_uniq.py --cluster-file /public/home/agis_xiazq/project/02.YZ/R2.SubGenome/03.allele_defined_subgenome/03.get-allele-table/genes_output.tsv "${args[@]}" --workers 4 --incremental
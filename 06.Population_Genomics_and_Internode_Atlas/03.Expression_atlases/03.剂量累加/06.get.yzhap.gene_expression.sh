@@ -1,5 +1,8 @@
-
+# 4个时期在同一次运行中提取，同时输出唯一配对基因对（so 和 ss 各一个基因）的子集，
+# 即原 07.get.YZhap.pairid.sh + 08.get.YZhap.pairid.gene_expression.sh 的结果
+args=()
 for i in 1 2 3 4
 do
-python3 extract_hap_gene_expression.py --cluster-file ~/project/02.YZ/R2.SubGenome/04.allele_defined_subgenome/03.get-allele-table/long_id/cluster.YZhap_long.id --so-expr-file /public/home/agis_xiazq/project/02.YZ/R4.PopVar/quantitative/stage${i}_sum_expression_data_so_sums.tsv --ss-expr-file /public/home/agis_xiazq/project/02.YZ/R4.PopVar/quantitative/stage${i}_sum_expression_data_ss_sums.tsv --output-file YZhap.stage${i}.tsv
-done
\ No newline at end of file
+args+=(--so-expr-file /public/home/agis_xiazq/project/02.YZ/R4.PopVar/quantitative/stage${i}_sum_expression_data_so_sums.tsv --ss-expr-file /public/home/agis_xiazq/project/02.YZ/R4.PopVar/quantitative/stage${i}_sum_expression_data_ss_sums.tsv --output-file YZhap.stage${i}.tsv --pair-output-file YZhap_pair.stage${i}.tsv)
+done
+python3 extract_hap_gene_expression.py --cluster-file ~/project/02.YZ/R2.SubGenome/04.allele_defined_subgenome/03.get-allele-table/long_id/cluster.YZhap_long.id "${args[@]}"
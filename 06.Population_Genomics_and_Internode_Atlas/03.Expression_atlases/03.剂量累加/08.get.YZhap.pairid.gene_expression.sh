@@ -1,5 +1,7 @@
 ## 提取同源基因对的表达
+# 已由 06.get.yzhap.gene_expression.sh 的 --pair-output-file 在同一次运行中输出（YZhap_pair.stage${i}.tsv），
+# 单独对 YZhap.pair.id 提取时：
 for i in 1 2 3 4
 do
 python3 extract_hap_gene_expression.py --cluster-file YZhap.pair.id --so-expr-file /public/home/agis_xiazq/project/02.YZ/R4.PopVar/pop_expression/01.quantitative/02.subgenome_gene_expre/stage${i}_sum_expression_data_so_sums.tsv --ss-expr-file /public/home/agis_xiazq/project/02.YZ/R4.PopVar/pop_expression/01.quantitative/02.subgenome_gene_expre/stage${i}_sum_expression_data_ss_sums.tsv --output-file YZhap_pair.stage${i}.tsv
-done
\ No newline at end of file
+done
@@ -1,13 +1,9 @@
 ## 过滤基因
 # TPM > 0.01 定义为表达，保留至少30个样本表达的基因；对过滤后的数据进行 log2(x+1) 转换；进行分位数归一化
+# 4个时期的全部基因和唯一配对基因对在同一次运行中处理（原为 Rscript prepare_gene_expression.R 逐个文件运行）
+args=()
 for i in 1 2 3 4
 do
-Rscript prepare_gene_expression.R YZhap.stage${i}.tsv 50 YZhap.stage${i}.filter.tsv
+args+=(-i YZhap.stage${i}.tsv -o YZhap.stage${i}.filter.tsv -i YZhap_pair.stage${i}.tsv -o YZhap_pair.stage${i}.filter.tsv)
 done
-
-## 过滤基因
-# TPM > 0.01 定义为表达，保留至少30个样本表达的基因；对过滤后的数据进行 log2(x+1) 转换；进行分位数归一化
-for i in 1 2 3 4
-do
-Rscript prepare_gene_expression.R YZhap_pair.stage${i}.tsv 50 YZhap_pair.stage${i}.filter.tsv
-done
\ No newline at end of file
+python3 prepare_gene_expression.py "${args[@]}" -m 50
@@ -1,105 +1,275 @@
 import pandas as pd
 import click
 import numpy as np
-import re
+import os
+import hashlib
+import glob
+import sys
+import multiprocessing as mp
+from scipy import sparse
 
-@click.command()
-@click.option('--cluster-file', required=True, help='Input TSV file with cluster gene lists')
-@click.option('--expression-file', required=True, help='Input TSV file with expression data')
-@click.option('--output-prefix', default='cluster', help='Prefix for output files')
-@click.option('--chunk-size', default=1000, help='Number of clusters to process at once')
-def process_clusters(cluster_file, expression_file, output_prefix, chunk_size):
-    """Process clusters with prefix removal and expression-based deduplication."""
-    
-    # 1. 加载表达数据
-    click.echo("Loading expression data...")
+# 表达图谱模块位于 02.定量统计
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '02.定量统计'))
+
+SO_COLUMN = 'so.YZ081609_genes'
+SS_COLUMN = 'ss.YZ081609_genes'
+GROUPS = ['so', 'ss', 'combined']
+HASH_SUFFIX = '_sums.hash.tsv'
+
+def expression_row_keys(expr_matrix):
+    """
+    每个表达行的去重键：表达量四舍五入到4位后完全相同的行得到相同的整数键
+    （与逐个比较 tuple(np.round(vec, 4)) 等价）。
+    """
+    if expr_matrix.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+    rounded = np.ascontiguousarray(np.round(expr_matrix, 4) + np.float32(0))  # -0.0 与 0.0 相同
+    rows = rounded.view(np.dtype((np.void, rounded.itemsize * rounded.shape[1]))).ravel()
+    _, keys = np.unique(rows, return_inverse=True)
+    keys = keys.ravel().astype(np.int64)
+    # NaN 与任何值都不相等，含 NaN 的行各自独立
+    nan_rows = np.flatnonzero(np.isnan(rounded).any(axis=1))
+    keys[nan_rows] = keys.max() + 1 + np.arange(len(nan_rows))
+    return keys
+
+def split_genes(raw):
+    """把基因列表列拆分为 (cluster行号, 原始基因ID) 两列，保持列表内顺序"""
+    genes = raw.dropna().astype(str).str.split('，').explode()
+    return genes.index.values, genes.values.astype(str)
+
+def load_clusters(cluster_file, chunk_size=1000):
+    """
+    读取 cluster 表并解析 so/ss 基因列表，多个时期共用，只解析一次。
+    cluster 编号为在 cluster 文件中的行号；每个不同的基因ID只去掉一次 so./ss. 前缀。
+    """
+    chunks = []
+    for chunk in pd.read_csv(cluster_file, sep='\t', chunksize=chunk_size):
+        chunks.append(chunk[[SO_COLUMN, SS_COLUMN]].astype(object))
+    cluster_df = pd.concat(chunks) if chunks else pd.DataFrame(columns=[SO_COLUMN, SS_COLUMN])
+    cluster_df = cluster_df.reset_index(drop=True)
+
+    so_ix, so_genes = split_genes(cluster_df[SO_COLUMN])
+    ss_ix, ss_genes = split_genes(cluster_df[SS_COLUMN])
+    codes, uniques = pd.factorize(np.r_[so_genes, ss_genes])
+    # 处理形如 so.YZ081609401660 的ID格式：去掉 so. 或 ss. 前缀
+    normalized = pd.Series(uniques, dtype=object).str.replace(r'^(so|ss)\.', '', regex=True).values
+
+    # 合并列表为 so 基因在前、ss 基因在后
+    combined_ix = np.r_[so_ix, ss_ix]
+    order = np.argsort(combined_ix, kind='stable')
+    return {
+        'n': len(cluster_df),
+        'so_raw': cluster_df[SO_COLUMN].where(cluster_df[SO_COLUMN].notna(), 'NA').astype(str).values,
+        'ss_raw': cluster_df[SS_COLUMN].where(cluster_df[SS_COLUMN].notna(), 'NA').astype(str).values,
+        'codes': codes,
+        'normalized': normalized,
+        'groups': {
+            'so': (so_ix, slice(0, len(so_genes))),
+            'ss': (ss_ix, slice(len(so_genes), len(codes))),
+            'combined': (combined_ix[order], order),
+        },
+    }
+
+def membership_matrix(cluster_ix, rows, n_clusters, row_keys):
+    """
+    cluster × 表达行 的 0/1 稀疏矩阵：每个 cluster 按基因列表顺序，
+    只保留表达向量（四舍五入后）首次出现的基因。
+    """
+    found = rows >= 0
+    cluster_ix, rows = cluster_ix[found], rows[found]
+
+    # 同一 cluster 内相同去重键只保留第一个
+    n_keys = int(row_keys.max()) + 1 if len(row_keys) else 1
+    _, first = np.unique(cluster_ix * n_keys + row_keys[rows], return_index=True)
+    first.sort()
+    cluster_ix, rows = cluster_ix[first], rows[first]
+
+    indptr = np.r_[0, np.cumsum(np.bincount(cluster_ix, minlength=n_clusters))]
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), rows, indptr),
+                             shape=(n_clusters, len(row_keys)))
+
+def load_expression(expression_file, atlas_dir=None):
+    """
+    读取表达矩阵，返回 (float32 表达矩阵, 基因ID -> 行号, 样品名)。
+    atlas_dir 不为空时 expression_file 为时期名，从表达图谱内存映射读取。
+    """
+    if atlas_dir is not None:
+        from expression_atlas import ExpressionAtlas
+        expr_matrix, genes, samples = ExpressionAtlas(atlas_dir).matrix(expression_file)
+        return expr_matrix, pd.Series(np.arange(len(genes)), index=genes), list(samples)
     expr_df = pd.read_csv(expression_file, sep='\t')
-    
     if 'target_id' not in expr_df.columns:
-        click.echo("ERROR: Expression data must contain 'target_id' column")
-        return
-    
+        return None
     expr_df.set_index('target_id', inplace=True)
     expr_matrix = expr_df.values.astype(np.float32)
-    gene_index = {str(gene): idx for idx, gene in enumerate(expr_df.index)}
-    varieties = expr_df.columns.tolist()
-    
-    # 2. 初始化输出文件
-    writers = {
-        'so': open(f'{output_prefix}_so_sums.tsv', 'w'),
-        'ss': open(f'{output_prefix}_ss_sums.tsv', 'w'),
-        'combined': open(f'{output_prefix}_combined_sums.tsv', 'w')
-    }
-    
-    # 写入表头
-    headers = ['Cluster', 'so.Hap_genes', 'ss.Hap_genes'] + varieties
-    for writer in writers.values():
-        writer.write('\t'.join(headers) + '\n')
-    
-    # 3. 改进的ID标准化函数
-    def normalize_gene_id(raw_id):
-        """处理形如 so.YZ081609401660 的ID格式"""
-        # 匹配前缀格式：so. 或 ss. 开头
-        match = re.match(r'^(so|ss)\.(.*)$', raw_id)
-        if match:
-            return match.group(2)  # 返回前缀后的部分
-        return raw_id  # 如果没有前缀则原样返回
-    
-    # 4. 基于表达量的去重函数
-    def get_unique_vectors(genes):
-        seen = set()
-        unique_vectors = []
-        for raw_gene in genes:
-            # 进行ID标准化
-            norm_gene = normalize_gene_id(raw_gene)
-            
-            # 匹配表达矩阵
-            if norm_gene in gene_index:
-                vec = expr_matrix[gene_index[norm_gene]]
-                vec_rounded = tuple(np.round(vec, 4))
-                if vec_rounded not in seen:
-                    seen.add(vec_rounded)
-                    unique_vectors.append(vec)
-        return unique_vectors
-    
-    # 5. 处理每个cluster
-    click.echo("Processing clusters with prefix removal...")
-    for chunk in pd.read_csv(cluster_file, sep='\t', chunksize=chunk_size):
-        for _, row in chunk.iterrows():
-            cluster_id = row.name
-            
-            # 获取原始基因列表
-            so_genes_raw = row['so.YZ081609_genes'] if pd.notna(row['so.YZ081609_genes']) else 'NA'
-            ss_genes_raw = row['ss.YZ081609_genes'] if pd.notna(row['ss.YZ081609_genes']) else 'NA'
-            
-            # 分割基因列表
-            so_genes = so_genes_raw.split('，') if so_genes_raw != 'NA' else []
-            ss_genes = ss_genes_raw.split('，') if ss_genes_raw != 'NA' else []
-            
-            # 计算各组总和
-            base_data = [f'cluster{cluster_id}', so_genes_raw, ss_genes_raw]
-            
-            # SO总和计算
-            so_unique = get_unique_vectors(so_genes)
-            so_sums = np.sum(so_unique, axis=0) if so_unique else np.zeros(len(varieties))
-            writers['so'].write('\t'.join(map(str, base_data + [f"{x:.4f}" for x in so_sums])) + '\n')
-            
-            # SS总和计算
-            ss_unique = get_unique_vectors(ss_genes)
-            ss_sums = np.sum(ss_unique, axis=0) if ss_unique else np.zeros(len(varieties))
-            writers['ss'].write('\t'.join(map(str, base_data + [f"{x:.4f}" for x in ss_sums])) + '\n')
-            
-            # 合并总和计算
-            combined_genes = so_genes + ss_genes
-            combined_unique = get_unique_vectors(combined_genes)
-            combined_sums = np.sum(combined_unique, axis=0) if combined_unique else np.zeros(len(varieties))
-            writers['combined'].write('\t'.join(map(str, base_data + [f"{x:.4f}" for x in combined_sums])) + '\n')
-    
-    # 关闭文件
-    for writer in writers.values():
-        writer.close()
-    
-    click.echo(f"Processing complete! Results saved to {output_prefix}_*_sums.tsv")
+    # 重复的 target_id 以最后一行为准
+    gene_index = pd.Series({str(gene): idx for idx, gene in enumerate(expr_df.index)}, dtype=np.int64)
+    return expr_matrix, gene_index, expr_df.columns.tolist()
+
+def format_sums(cluster_ids, so_raw, ss_raw, sums):
+    """按原格式生成一批 cluster 的输出行"""
+    row_format = '\t'.join(['{:.4f}'] * sums.shape[1])
+    return [f'cluster{cluster_id}\t{so}\t{ss}' + ('\t' + row_format.format(*values) if len(values) else '') + '\n'
+            for cluster_id, so, ss, values in zip(cluster_ids, so_raw, ss_raw, sums.tolist())]
+
+def cluster_hashes(clusters, rows, expr_matrix):
+    """
+    每个 cluster 的内容哈希：基因列表原文 + 每个基因匹配到的表达行（float32 原始字节）。
+    输出只由这些内容决定，哈希相同的 cluster 可以直接复用上次的结果。
+    """
+    # 末尾的 '-' 对应未匹配到表达行的基因（行号 -1）
+    row_digests = np.array([hashlib.sha1(row.tobytes()).hexdigest() for row in expr_matrix] + ['-'], dtype=object)
+    combined_ix, order = clusters['groups']['combined']
+    member_digests = pd.Series(row_digests[rows[order]], dtype=object).groupby(combined_ix).agg(','.join)
+    member_digests = member_digests.reindex(range(clusters['n']), fill_value='')
+    return [hashlib.sha1(f'{so}\t{ss}\t{digests}'.encode()).hexdigest()
+            for so, ss, digests in zip(clusters['so_raw'], clusters['ss_raw'], member_digests.values)]
+
+def load_previous(output_prefix, header_line):
+    """
+    读取上次运行的输出和 cluster 哈希，返回 (哈希 -> 上次的行号, {组: 上次各行去掉cluster编号后的内容})；
+    文件缺失、表头（样品）不同或行数不一致时返回 None，全部重新计算。
+    """
+    hash_file = f'{output_prefix}{HASH_SUFFIX}'
+    if not os.path.exists(hash_file):
+        return None
+    old_hashes = pd.read_csv(hash_file, sep='\t')['hash'].tolist()
+    bodies = {}
+    for name in GROUPS:
+        path = f'{output_prefix}_{name}_sums.tsv'
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            if f.readline() != header_line:
+                return None
+            lines = f.readlines()
+        if len(lines) != len(old_hashes):
+            return None
+        bodies[name] = [line.split('\t', 1)[1] for line in lines]
+    old_index = {}
+    for i, h in enumerate(old_hashes):
+        old_index.setdefault(h, i)
+    return old_index, bodies
+
+def stage_sums(clusters, expression_file, output_prefix, chunk_size=1000, incremental=False, atlas_dir=None):
+    """
+    计算一个时期（一个表达矩阵）所有 cluster 的 so、ss 和合并表达总和。
+    incremental 时只重新计算基因列表或成员表达行有变化的 cluster，其余行沿用上次的输出。
+    """
+    click.echo(f"Loading expression data: {expression_file}")
+    expression = load_expression(expression_file, atlas_dir)
+    if expression is None:
+        click.echo(f"ERROR: Expression data must contain 'target_id' column: {expression_file}")
+        return None
+    expr_matrix, gene_index, varieties = expression
+    # 每个表达行的去重键只计算一次
+    row_keys = expression_row_keys(expr_matrix)
+    rows = gene_index.reindex(clusters['normalized']).fillna(-1).values.astype(np.int64)[clusters['codes']]
+    n_clusters = clusters['n']
+    header_line = '\t'.join(['Cluster', 'so.Hap_genes', 'ss.Hap_genes'] + varieties) + '\n'
+
+    # 与上次运行对比，old_rows 为每个 cluster 可复用的旧行号（-1 为需要重新计算）
+    previous = None
+    recompute = np.arange(n_clusters)
+    if incremental:
+        hashes = cluster_hashes(clusters, rows, expr_matrix)
+        previous = load_previous(output_prefix, header_line)
+        if previous is not None:
+            old_index, old_bodies = previous
+            old_rows = np.array([old_index.get(h, -1) for h in hashes], dtype=np.int64)
+            recompute = np.flatnonzero(old_rows < 0)
+        click.echo(f"Incremental: {len(recompute)}/{n_clusters} clusters to recompute for {output_prefix}")
+
+    # 稀疏成员矩阵 × float32 表达矩阵，按列表顺序逐行累加，与逐个向量求和的结果完全相同
+    matrices = {name: membership_matrix(ix, rows[select], n_clusters, row_keys)
+                for name, (ix, select) in clusters['groups'].items()}
+
+    # 替换任何输出之前先删除旧的哈希文件：非增量运行或中途失败后，旧哈希不会再与新输出配对
+    hash_file = f'{output_prefix}{HASH_SUFFIX}'
+    if os.path.exists(hash_file):
+        os.remove(hash_file)
+
+    for name in GROUPS:
+        path = f'{output_prefix}_{name}_sums.tsv'
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as writer:
+            writer.write(header_line)
+            new_lines = {}
+            for start in range(0, len(recompute), chunk_size):
+                ix = recompute[start:start + chunk_size]
+                lines = format_sums(ix, clusters['so_raw'][ix], clusters['ss_raw'][ix], matrices[name][ix] @ expr_matrix)
+                if previous is None:
+                    writer.write(''.join(lines))
+                else:
+                    new_lines.update(zip(ix.tolist(), lines))
+            if previous is not None:
+                # 复用的行只需替换 cluster 编号（行号可能因增删 cluster 而改变）
+                writer.write(''.join(new_lines[i] if old_row < 0 else f'cluster{i}\t{old_bodies[name][old_row]}'
+                                     for i, old_row in enumerate(old_rows.tolist())))
+        os.replace(tmp_path, path)
+    if incremental:
+        # 所有输出就位后才写出新的哈希文件
+        tmp_hash = f'{hash_file}.tmp{os.getpid()}'
+        pd.DataFrame({'Cluster': [f'cluster{i}' for i in range(n_clusters)], 'hash': hashes}).to_csv(
+            tmp_hash, sep='\t', index=False)
+        os.replace(tmp_hash, hash_file)
+    click.echo(f"Results saved to {output_prefix}_*_sums.tsv")
+    return output_prefix
+
+def _stage_task(args):
+    return stage_sums(*args)
+
+def expand_inputs(expression_files, output_prefixes, use_glob=True):
+    """
+    展开表达文件通配符并确定每个时期的输出前缀：前缀个数与文件数相同时一一对应；
+    只有一个前缀时，{name} 替换为表达文件名（不含扩展名），不含 {name} 且有多个文件时追加 _<name>。
+    """
+    files = []
+    for pattern in expression_files:
+        matched = sorted(glob.glob(pattern)) if use_glob and glob.has_magic(pattern) else [pattern]
+        if not matched:
+            raise click.BadParameter(f"No files match: {pattern}", param_hint='--expression-file')
+        files.extend(matched)
+    if len(output_prefixes) == len(files):
+        return list(zip(files, output_prefixes))
+    if len(output_prefixes) != 1:
+        raise click.BadParameter("Give one --output-prefix, or one per expression file", param_hint='--output-prefix')
+    prefix = output_prefixes[0]
+    names = [os.path.splitext(os.path.basename(f))[0] for f in files]
+    if '{name}' in prefix:
+        return [(f, prefix.format(name=name)) for f, name in zip(files, names)]
+    return [(f, f'{prefix}_{name}') for f, name in zip(files, names)]
+
+@click.command()
+@click.option('--cluster-file', required=True, help='Input TSV file with cluster gene lists')
+@click.option('--expression-file', required=True, multiple=True,
+              help='Input TSV file with expression data; can be given multiple times or as a glob (one per stage)')
+@click.option('--output-prefix', default=['cluster'], multiple=True, show_default=True,
+              help='Prefix for output files; one per expression file, or one prefix ({name} = expression file name)')
+@click.option('--chunk-size', default=1000, help='Number of clusters to process at once')
+@click.option('--workers', default=1, show_default=True, help='Worker processes (stages run in parallel)')
+@click.option('--atlas', default=None,
+              help='Expression atlas directory (expression_atlas.py); --expression-file values are then stage names')
+@click.option('--incremental', is_flag=True,
+              help='Keep per-cluster content hashes next to the outputs and recompute only changed clusters')
+def process_clusters(cluster_file, expression_file, output_prefix, chunk_size, workers, atlas, incremental):
+    """Process clusters with prefix removal and expression-based deduplication."""
+    stages = expand_inputs(expression_file, output_prefix, use_glob=atlas is None)
+
+    # 1. cluster 表只读取和解析一次
+    click.echo("Loading cluster table...")
+    clusters = load_clusters(cluster_file, chunk_size)
+
+    # 2. 逐个时期计算（可多进程并行），输出仍按时期分开
+    click.echo(f"Processing clusters with prefix removal for {len(stages)} expression file(s)...")
+    tasks = [(clusters, f, prefix, chunk_size, incremental, atlas) for f, prefix in stages]
+    if workers > 1 and len(tasks) > 1:
+        with mp.get_context('fork').Pool(min(workers, len(tasks))) as pool:
+            results = pool.map(_stage_task, tasks)
+    else:
+        results = [_stage_task(task) for task in tasks]
+
+    click.echo(f"Processing complete! {sum(r is not None for r in results)}/{len(tasks)} stage(s) written")
 
 if __name__ == '__main__':
     process_clusters()
@@ -1,55 +1,99 @@
 import click
-import csv
+import numpy as np
+import pandas as pd
+
+def load_gene_clusters(cluster_file):
+    """
+    读取 cluster 表，展开为每个基因一行（按 cluster 顺序，每个 cluster 内先 so 后 ss），只解析一次。
+    返回 DataFrame: Gene, Cluster, group (so/ss), pair（该 cluster 为唯一配对的基因对，
+    即 so 和 ss 均非空且只含一个基因，同 07.get.YZhap.pairid.sh 的 awk 条件）。
+    """
+    cluster_df = pd.read_csv(cluster_file, sep='\t', dtype=str, keep_default_na=False)
+    cluster_df = cluster_df.reindex(columns=['Cluster', 'so.Hap_genes', 'ss.Hap_genes']).fillna('')
+    so_raw, ss_raw = cluster_df['so.Hap_genes'], cluster_df['ss.Hap_genes']
+    pair = (so_raw != '') & (ss_raw != '') & ~so_raw.str.contains('[,，]') & ~ss_raw.str.contains('[,，]')
+
+    parts = []
+    for group, raw in [('so', so_raw), ('ss', ss_raw)]:
+        genes = raw.str.replace('，', ',').str.split(',').explode().str.strip()
+        parts.append(pd.DataFrame({'Gene': genes.values, 'row': genes.index.values, 'group': group}))
+    gene_df = pd.concat(parts, ignore_index=True)
+    gene_df = gene_df[gene_df['Gene'].notna() & (gene_df['Gene'] != '')]
+    # 每个 cluster 内先 so 后 ss，各自保持列表顺序
+    gene_df = gene_df.sort_values('row', kind='stable').reset_index(drop=True)
+    gene_df['Cluster'] = cluster_df['Cluster'].values[gene_df['row'].values]
+    gene_df['pair'] = pair.values[gene_df['row'].values]
+    return gene_df.drop(columns='row')
+
+def load_sums(file_path, columns=None):
+    """
+    读取 cal_sum_uniq.py 输出的总和矩阵，返回 (cluster -> 行号, 数值矩阵, Cul 样品列)。
+    重复的 cluster 以最后一行为准；columns 不为空时按该列顺序取列，缺少的列为 0。
+    """
+    header = pd.read_csv(file_path, sep='\t', nrows=0).columns
+    cul_cols = [col for col in header if col.startswith("Cul")]
+    # float64 才能精确保留 4 位小数的总和
+    sums_df = pd.read_csv(file_path, sep='\t', usecols=['Cluster'] + cul_cols, dtype={'Cluster': str},
+                          keep_default_na=False, float_precision='round_trip')
+    sums_df = sums_df.drop_duplicates('Cluster', keep='last')
+    if columns is not None:
+        sums_df = sums_df.reindex(columns=['Cluster'] + list(columns), fill_value=0)
+        cul_cols = list(columns)
+    cluster_index = pd.Index(sums_df['Cluster'].values)
+    return cluster_index, sums_df[cul_cols].values.astype(np.float64), cul_cols
+
+def gather_expression(gene_df, so_file, ss_file):
+    """按基因所在的 cluster 从 so/ss 总和矩阵中一次性取出表达值，返回 (保留的基因行, 表达矩阵, 样品列)"""
+    so_index, so_matrix, cul_columns = load_sums(so_file)
+    ss_index, ss_matrix, _ = load_sums(ss_file, columns=cul_columns)
+
+    is_so = (gene_df['group'] == 'so').values
+    rows = np.where(is_so, so_index.get_indexer(gene_df['Cluster']), ss_index.get_indexer(gene_df['Cluster']))
+    # 总和矩阵中没有的 cluster 不输出
+    keep = rows >= 0
+    matrix = np.empty((int(keep.sum()), len(cul_columns)), dtype=np.float64)
+    is_so, rows = is_so[keep], rows[keep]
+    matrix[is_so] = so_matrix[rows[is_so]]
+    matrix[~is_so] = ss_matrix[rows[~is_so]]
+    return gene_df[keep].reset_index(drop=True), matrix, cul_columns
+
+def write_expression(output_file, genes, matrix, cul_columns):
+    """写出基因表达表（与 csv.writer 的默认格式相同，行尾为 \\r\\n）"""
+    row_format = '\t'.join(['{:.4f}'] * len(cul_columns))
+    with open(output_file, 'w', newline='') as f:
+        f.write('\t'.join(["Gene"] + cul_columns) + '\r\n')
+        f.write(''.join(f'{gene}\t{row_format.format(*values)}\r\n' if cul_columns else f'{gene}\r\n'
+                        for gene, values in zip(genes, matrix.tolist())))
 
 @click.command()
 @click.option('--cluster-file', required=True, help='Hap_gene_cluster.tsv')
-@click.option('--so-expr-file', required=True, help='stage1_sum_expression_data_so_sums.tsv')
-@click.option('--ss-expr-file', required=True, help='stage1_sum_expression_data_ss_sums.tsv')
-@click.option('--output-file', default='hap_gene_expression_values.tsv', help='Output file name')
-def extract(cluster_file, so_expr_file, ss_expr_file, output_file):
+@click.option('--so-expr-file', required=True, multiple=True,
+              help='stage1_sum_expression_data_so_sums.tsv (can be given multiple times, one per stage)')
+@click.option('--ss-expr-file', required=True, multiple=True,
+              help='stage1_sum_expression_data_ss_sums.tsv (can be given multiple times, one per stage)')
+@click.option('--output-file', default=['hap_gene_expression_values.tsv'], multiple=True, show_default=True,
+              help='Output file name (one per stage)')
+@click.option('--pair-output-file', multiple=True,
+              help='Also write genes of uniquely paired clusters (one so and one ss gene) to this file (one per stage)')
+def extract(cluster_file, so_expr_file, ss_expr_file, output_file, pair_output_file):
     """Extract gene-wise expression values from cluster-based expression matrices."""
+    n_stages = len(so_expr_file)
+    if len(ss_expr_file) != n_stages or len(output_file) != n_stages:
+        raise click.BadParameter("--so-expr-file, --ss-expr-file and --output-file must be given once per stage")
+    if pair_output_file and len(pair_output_file) != n_stages:
+        raise click.BadParameter("--pair-output-file must be given once per stage", param_hint='--pair-output-file')
 
-    def load_expr(file_path):
-        expr = {}
-        with open(file_path, newline='') as f:
-            reader = csv.DictReader(f, delimiter='\t')
-            cul_cols = [col for col in reader.fieldnames if col.startswith("Cul")]
-            for row in reader:
-                cid = f"cluster{row['Cluster']}"
-                expr[cid] = {col: row[col] for col in cul_cols}
-        return expr, cul_cols
-
-    so_expr, cul_columns = load_expr(so_expr_file)
-    ss_expr, _ = load_expr(ss_expr_file)
-
-    records = []
-    with open(cluster_file, newline='') as f:
-        reader = csv.DictReader(f, delimiter='\t')
-        for row in reader:
-            cluster_id = f"cluster{row['Cluster']}"
-            # 处理 so.Hap_genes
-            so_genes = row.get("so.Hap_genes", "")
-            if so_genes:
-                for gene in so_genes.replace('，', ',').split(','):
-                    gene = gene.strip()
-                    if gene and cluster_id in so_expr:
-                        expr = so_expr[cluster_id]
-                        records.append([gene] + [expr.get(col, "0") for col in cul_columns])
-            # 处理 ss.Hap_genes
-            ss_genes = row.get("ss.Hap_genes", "")
-            if ss_genes:
-                for gene in ss_genes.replace('，', ',').split(','):
-                    gene = gene.strip()
-                    if gene and cluster_id in ss_expr:
-                        expr = ss_expr[cluster_id]
-                        records.append([gene] + [expr.get(col, "0") for col in cul_columns])
-
-    with open(output_file, 'w', newline='') as f:
-        writer = csv.writer(f, delimiter='\t')
-        writer.writerow(["Gene"] + cul_columns)
-        writer.writerows(records)
+    # 基因 -> cluster 映射只建立一次，各时期共用
+    gene_df = load_gene_clusters(cluster_file)
 
-    click.echo(f"[✓] 输出完成：{output_file}")
+    for i in range(n_stages):
+        genes_df, matrix, cul_columns = gather_expression(gene_df, so_expr_file[i], ss_expr_file[i])
+        write_expression(output_file[i], genes_df['Gene'].values, matrix, cul_columns)
+        click.echo(f"[✓] 输出完成：{output_file[i]}")
+        if pair_output_file:
+            pair = genes_df['pair'].values
+            write_expression(pair_output_file[i], genes_df['Gene'].values[pair], matrix[pair], cul_columns)
+            click.echo(f"[✓] 输出完成：{pair_output_file[i]}")
 
 if __name__ == '__main__':
-    extract()
\ No newline at end of file
+    extract()
@@ -0,0 +1,147 @@
+import os
+import sys
+import click
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# 表达图谱模块位于 02.定量统计
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '02.定量统计'))
+
+# 定义表达阈值 TPM > 0.01 为表达
+EXPRESSION_THRESHOLD = 0.01
+
+def read_expression(input_file, atlas_dir=None):
+    """
+    读取表达矩阵，行为基因，列为样本（同 read.delim(row.names = 1, check.names = FALSE)）。
+    atlas_dir 不为空时 input_file 为时期名，从表达图谱内存映射读取（float32）。
+    """
+    if atlas_dir is not None:
+        from expression_atlas import ExpressionAtlas
+        return ExpressionAtlas(atlas_dir).frame(input_file)
+    return pd.read_csv(input_file, sep='\t', index_col=0, float_precision='round_trip')
+
+def expression_filter(expr_df, min_samples_expr, threshold=EXPRESSION_THRESHOLD):
+    """保留在至少 min_samples_expr 个样本中表达（TPM > threshold）的基因"""
+    expressed_counts = (expr_df.values > threshold).sum(axis=1)
+    return expr_df[expressed_counts >= min_samples_expr]
+
+def _r_mean_rows(sorted_matrix):
+    """
+    逐行均值，与 R 的 mean() 相同：long double 顺序累加后再做一次残差修正，
+    保证与 prepare_gene_expression.R 的 apply(df_sorted, 1, mean) 结果一致。
+    """
+    n_samples = sorted_matrix.shape[1]
+    s = np.zeros(sorted_matrix.shape[0], dtype=np.longdouble)
+    for j in range(n_samples):
+        s += sorted_matrix[:, j]
+    s /= n_samples
+    t = np.zeros_like(s)
+    for j in range(n_samples):
+        t += sorted_matrix[:, j] - s
+    finite = np.isfinite(s)
+    s[finite] += t[finite] / n_samples
+    return s.astype(np.float64)
+
+def quantile_normalize(matrix, threads=None):
+    """
+    分位数归一化（同 R 中 rank(ties.method = "min") + 各列排序后的行均值）：
+    每列只做一次 argsort，同时得到排序结果和并列取最小的秩，按列在线程池中并行。
+    """
+    matrix = np.asfortranarray(matrix)
+    n_genes, n_samples = matrix.shape
+    order = np.empty((n_genes, n_samples), dtype=np.int64, order='F')
+    sorted_matrix = np.empty_like(matrix, order='F')
+    normalized = np.empty_like(matrix, order='F')
+
+    def sort_column(j):
+        order[:, j] = np.argsort(matrix[:, j], kind='stable')
+        sorted_matrix[:, j] = matrix[order[:, j], j]
+
+    def map_column(j):
+        # 并列值取该组第一个位置（即最小秩）对应的均值
+        s = sorted_matrix[:, j]
+        starts = np.r_[True, s[1:] != s[:-1]]
+        first = np.maximum.accumulate(np.where(starts, np.arange(n_genes), 0))
+        normalized[order[:, j], j] = mean[first]
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(sort_column, range(n_samples)))
+        mean = _r_mean_rows(sorted_matrix)
+        list(pool.map(map_column, range(n_samples)))
+    return normalized
+
+def prepare_expression(expr_df, min_samples_expr, normalize=True, threads=None, dtype=None):
+    """
+    过滤 + log2(x+1) + 分位数归一化（normalize=False 时只过滤，同 prepare_gene_expression_onlyfilter.R），
+    返回以基因为行的 DataFrame，Python 端的后续步骤可直接使用其 .values。
+    dtype 不为空时把结果转换为该类型（如 np.float32）。
+    """
+    expr_filtered = expression_filter(expr_df, min_samples_expr)
+    if normalize and len(expr_filtered):
+        values = quantile_normalize(np.log2(expr_filtered.values.astype(np.float64) + 1), threads)
+        expr_filtered = pd.DataFrame(values, index=expr_filtered.index, columns=expr_filtered.columns)
+    if dtype is not None:
+        expr_filtered = expr_filtered.astype(dtype)
+    return expr_filtered
+
+def _r_format_number(x):
+    """按 R write.table 的方式格式化一个数：15 位有效数字，去掉末尾的 0，定点与科学计数法取较短者"""
+    if np.isnan(x):
+        return 'NA'
+    if np.isinf(x):
+        return 'Inf' if x > 0 else '-Inf'
+    if x == 0:
+        return '0'
+    mantissa, exponent = f'{x:.14e}'.split('e')
+    e = int(exponent)
+    nsig = len(mantissa.lstrip('-').replace('.', '').rstrip('0'))
+    neg = int(x < 0)
+    rgt = max(0, nsig - e - 1)
+    fixed_width = neg + (e + 1 if e >= 0 else 1) + (rgt + 1 if rgt > 0 else 0)
+    sci_width = neg + (nsig + 1 if nsig > 1 else 1) + (4 if abs(e) < 100 else 5)
+    if fixed_width <= sci_width:
+        return f'{x:.{rgt}f}'
+    return f'{x:.{nsig - 1}e}'
+
+def write_r_table(expr_df, output_file):
+    """同 write.table(sep = "\\t", quote = FALSE, row.names = TRUE, col.names = NA)"""
+    values = expr_df.values
+    # 每个不同的数值只格式化一次（归一化后每列的取值都来自同一个均值向量）
+    uniques, inverse = np.unique(values, return_inverse=True)
+    if uniques.dtype == np.float32:
+        # 来自表达图谱的 float32 值按其最短十进制表示输出
+        uniques = np.array([float(str(x)) for x in uniques])
+    formatted = np.array([_r_format_number(x) for x in uniques], dtype=object)[inverse.reshape(values.shape)]
+    with open(output_file, 'w') as f:
+        f.write('\t'.join([''] + [str(c) for c in expr_df.columns]) + '\n')
+        f.write(''.join(f'{gene}\t' + '\t'.join(row) + '\n' for gene, row in zip(expr_df.index, formatted.tolist())))
+
+@click.command()
+@click.option('--input', '-i', 'input_files', required=True, multiple=True,
+              help='Input expression file, genes x samples (can be given multiple times, e.g. one per stage)')
+@click.option('--output', '-o', 'output_files', required=True, multiple=True, help='Output file (one per input)')
+@click.option('--min-samples', '-m', type=int, required=True, help='Keep genes expressed (TPM > 0.01) in at least this many samples')
+@click.option('--only-filter', is_flag=True, help='Only filter genes, write the raw TPM values (prepare_gene_expression_onlyfilter.R)')
+@click.option('--threads', '-t', type=int, default=None, help='Threads for quantile normalization (default: all cores)')
+@click.option('--atlas', default=None,
+              help='Expression atlas directory (expression_atlas.py); --input values are then stage names')
+def main(input_files, output_files, min_samples, only_filter, threads, atlas):
+    """
+    基因表达过滤、log2(x+1) 转换和分位数归一化，替代 prepare_gene_expression.R /
+    prepare_gene_expression_onlyfilter.R，输出格式与 R 的 write.table 相同。
+    """
+    if len(input_files) != len(output_files):
+        raise click.BadParameter("--input and --output must be given the same number of times")
+    for input_file, output_file in zip(input_files, output_files):
+        expr = read_expression(input_file, atlas)
+        click.echo(f"Read expression matrix: {expr.shape[0]} {expr.shape[1]}")
+        result = prepare_expression(expr, min_samples, normalize=not only_filter, threads=threads)
+        click.echo(f"Genes retained after filtering: {len(result)}")
+        if len(result) == 0:
+            raise click.ClickException("No genes pass the expression filter. Please lower the threshold or check data.")
+        write_r_table(result, output_file)
+        click.echo(f"{'Filtered expression matrix' if only_filter else 'Normalized data'} saved to: {output_file}")
+
+if __name__ == '__main__':
+    main()
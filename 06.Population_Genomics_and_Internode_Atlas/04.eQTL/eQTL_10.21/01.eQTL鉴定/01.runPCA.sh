@@ -13,15 +13,15 @@ cd ${work_dir}
 mkdir 02.PCA
 cd 02.PCA
 
-~/miniconda3/bin/python3 ../pca_analysis_common.py \
-    --input1 ${work_dir}/../01.quantitative/03.subgenome_long_gene_expre/YZhap.stage1.filter.tsv \
-    --input2 ${work_dir}/../01.quantitative/03.subgenome_long_gene_expre/YZhap.stage2.filter.tsv \
-    --input3 ${work_dir}/../01.quantitative/03.subgenome_long_gene_expre/YZhap.stage3.filter.tsv \
-    --input4 ${work_dir}/../01.quantitative/03.subgenome_long_gene_expre/YZhap.stage4.filter.tsv \
-    --output_dir ${work_dir}/02.PCA
-
+# 每个时期的表达文件按基因分块读入（float32）并直接写入合并矩阵，随机化SVD求前3个主成分；
+# 直接写出 Period${i}_pca_results.tsv 和协变量文件 PCA_qcovar.Stage${i}.txt（只保留 Cul 样本），
+# 不再需要 grep 拆分以及 07.pre_All_data.sh 中的 awk
+args=()
 for i in 1 2 3 4
 do
-    head -n 1 combined_pca_results.tsv > Period${i}_pca_results.tsv
-    grep Period${i} combined_pca_results.tsv >> Period${i}_pca_results.tsv
-done
\ No newline at end of file
+    args+=(--input ${work_dir}/../01.quantitative/03.subgenome_long_gene_expre/YZhap.stage${i}.filter.tsv --stage Stage${i})
+done
+~/miniconda3/bin/python3 ../pca_analysis_common.py "${args[@]}" \
+    --n_components 3 \
+    --qcovar_pattern Cul \
+    --output_dir ${work_dir}/02.PCA
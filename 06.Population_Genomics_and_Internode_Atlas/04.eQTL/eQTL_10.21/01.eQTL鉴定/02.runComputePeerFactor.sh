@@ -5,35 +5,39 @@ work_dir=/public/home/agis_xiazq/project/02.YZ/R4.PopVar/pop_expression/02.eQTL.
 cd ${work_dir}
 mkdir 03.peer_interface
 cd 03.peer_interface
-# 为每个stage创建一个独立的sbatch任务
+# 每个stage一个sbatch任务：hidden_factors.py 一次拟合得到所有K的结果
+# （K从小到大热启动，输出与 peer.r 相同的 results/stage_${i}/factors_K.txt、residuals_K.txt），
+# 原为 4个stage × 8个K 共32个任务，每个任务单独运行 peer.r
+# 快速探索K时可加 --method pca
+k_args=""
 for j in 5 10 15 20 25 30 35 40
 do
+    k_args="${k_args} -k ${j}"
+done
+
+# 创建日志目录（如果不存在）
+mkdir -p logs
+
 for i in 1 2 3 4
 do
-    job_script="peer_stage_${i}_${j}.sh"
+    job_script="peer_stage_${i}.sh"
 
     # 生成sbatch脚本文件
     cat > $job_script <<EOF
 #!/bin/bash
-#SBATCH --job-name=peer_stage_${i}_${j}
-#SBATCH --output=logs/peer_stage_${i}_${j}.out
-#SBATCH --error=logs/peer_stage_${i}_${j}.err
+#SBATCH --job-name=peer_stage_${i}
+#SBATCH --output=logs/peer_stage_${i}.out
+#SBATCH --error=logs/peer_stage_${i}.err
 #SBATCH --nodes=1
 #SBATCH --ntasks=1
 #SBATCH --cpus-per-task=20
 #SBATCH --partition=hebhcnormal01
 
-source ~/miniconda3/bin/activate r_peer
 cd ${work_dir}/03.peer_interface
-/public/home/agis_xiazq/miniconda3/envs/r_peer/bin/Rscript /public/home/agis_xiazq/Script/eQTL/peer.r ${exp_data}/YZhap.stage${i}.filter.tsv ${j} results/stage_${i}
+~/miniconda3/bin/python3 ${work_dir}/hidden_factors.py -i ${exp_data}/YZhap.stage${i}.filter.tsv -o results/stage_${i}${k_args} --threads 20
 EOF
 
-    # 创建日志目录（如果不存在）
-    mkdir -p logs
-
     # 提交生成的sbatch脚本
     sbatch $job_script
-    sleep 5
-    echo "Submitted stage ${i}_${j} to sbatch."
+    echo "Submitted stage ${i} to sbatch."
 done
-done
\ No newline at end of file
@@ -0,0 +1,29 @@
+#!/bin/bash
+#SBATCH --ntasks=1
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=10
+#SBATCH --partition=hebhcnormal01
+
+# PEER残差 -> RINT -> tensorQTL表型BED（bgzip + tabix）一步完成，替代 03.runRINT.sh + 06.runTSS.sh
+
+BASE_DIR="/public/home/agis_xiazq/project/02.YZ/R4.PopVar/pop_expression/04.eQTL"
+PEER_DIR="${BASE_DIR}/04.phe"
+BED_DIR="${BASE_DIR}/04.bed"
+PYTHON="/public/home/agis_xiazq/miniconda3/bin/python3"
+GENE_BED="${BED_DIR}/filtered_YZhap_gene.bed"
+RES_DIR=/public/home/agis_xiazq/project/02.YZ/R4.PopVar/pop_expression/02.eQTL.10.22/03.peer_interface/results
+EXP_DIR=/public/home/agis_xiazq/project/02.YZ/R4.PopVar/pop_expression/01.quantitative/03.subgenome_long_gene_expre
+
+mkdir -p ${PEER_DIR}
+cd ${PEER_DIR}
+
+for peer in 5 10 15 20 25 30 35 40; do
+    for stage in 1 2 3 4; do
+        ${PYTHON} ${BASE_DIR}/residuals_to_bed.py \
+            --peer_file ${RES_DIR}/stage_${stage}/residuals_${peer}.txt \
+            --expre_file ${EXP_DIR}/YZhap.stage${stage}.filter.tsv \
+            --gene_bed ${GENE_BED} \
+            --out_file ${PEER_DIR}/stage-${stage}_residuals-${peer}.bed.gz
+    done
+done
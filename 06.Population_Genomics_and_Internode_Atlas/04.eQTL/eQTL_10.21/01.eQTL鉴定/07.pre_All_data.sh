@@ -10,8 +10,5 @@ mkdir 07.pre.all.data && cd 07.pre.all.data
 cp ${GWAS_SOURCE}/GWAS* .
 cp ${EXPR_SOURCE}/*bed.gz* .
 
-for i in 1 2 3 4
-do
-    grep "Cul" ${PCA_SOURCE}/Period${i}_pca_results.tsv | \
-    awk '{print $1"\t"$1"\t"$2"\t"$3"\t"$4}' > PCA_qcovar.Stage${i}.txt
-done
+# PCA协变量文件由 pca_analysis_common.py --qcovar_pattern Cul 直接生成
+cp ${PCA_SOURCE}/PCA_qcovar.Stage*.txt .
@@ -9,6 +9,9 @@ stages=(1 2 3 4)
 modes=("p" "t")
 factors=(5 10 15 20 25 30 35 40)
 # factors=(5 10 40)
+# 预先构建基因型缓存（计算一次 PLINK 文件全文哈希并只解码一次，之后各任务按文件状态查到缓存并内存映射读取）
+# genotype_cache.py 位于 02.eQTL过滤（同 QTL_mapping.py 中的 sys.path 设置）
+python3 "$(dirname "$0")/../02.eQTL过滤/genotype_cache.py" --plink_prefix /data0/agis_xiazhongqiang/Project/04.eQTL/06.YZ.qtl_mapping/01.data/07.pre.all.data/GWAS
 # 遍历每个阶段、模式和因子数量的组合
 for stage in "${stages[@]}"; do
   for mode in "${modes[@]}"; do
@@ -11,8 +11,15 @@ import torch
 import click
 import pandas as pd
 import tensorqtl
-from tensorqtl import genotypeio, cis, trans
-from statsmodels.stats.multitest import multipletests
+from tensorqtl import cis, trans
+
+# 基因型缓存模块与 qtl_analysis.py 放在一起（部署时与本脚本位于同一目录）
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '02.eQTL过滤'))
+import genotype_cache
+from trans_engine import map_trans_cpu, count_maf_variants
+from cis_engine import map_cis_adaptive, map_cis_sharded
+from nominal_store import build_store
+from fdr import bh_qvalues, add_qvalues_to_file
 
 # 设置 CUDA 设备
 os.environ['CUDA_VISIBLE_DEVICES'] = "0"
@@ -41,21 +48,35 @@ def load_covariates(covariates_file, samples):
     return covariates_df
 
 
-def perform_cis_analysis(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, nperm, maf_threshold, window):
-    cis_df = cis.map_cis(
-        genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
-        nperm=nperm, maf_threshold=maf_threshold, window=window, seed=2022
-    )
+def perform_cis_analysis(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, nperm, maf_threshold, window, adaptive=False, workers=1):
+    if workers > 1:
+        # 多进程：按cis变异数均衡分块，各进程从基因型缓存内存映射自己的区间，结果与单进程相同
+        cache_path = genotype_cache.build_cache(PLINK_PREFIX_PATH)
+        cis_df = map_cis_sharded(
+            cache_path, phenotype_df, phenotype_pos_df, covariates_df, window=window,
+            workers=workers, n_chunks=workers, adaptive=adaptive,
+            nperm=nperm, maf_threshold=maf_threshold, seed=2022
+        )
+    elif adaptive:
+        # 自适应置换：明显不显著的基因提前停止置换
+        cis_df = map_cis_adaptive(
+            genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
+            nperm=nperm, maf_threshold=maf_threshold, window=window, seed=2022
+        )
+    else:
+        cis_df = cis.map_cis(
+            genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
+            nperm=nperm, maf_threshold=maf_threshold, window=window, seed=2022
+        )
     # 替代calculate_qvalues的FDR校正
     pvals = cis_df['pval_nominal'].values
-    _, qvals, _, _ = multipletests(pvals, method='fdr_bh')
-    cis_df['qval'] = qvals
+    cis_df['qval'] = bh_qvalues(pvals)
     
     cis_df.to_csv(outfile, header=True, index=True, sep="\t")
     print(f"Cis-eQTL analysis results saved to {outfile}")
 
-def perform_nominal_mapping(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, maf_threshold, window):
-    """执行nominal映射分析."""
+def perform_nominal_mapping(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, maf_threshold, window, store_root=None):
+    """执行nominal映射分析，store_root 不为空时同时写入可查询的索引存储."""
     cis.map_nominal(
         genotype_df, variant_df, phenotype_df, phenotype_pos_df,
         prefix=outfile, covariates_df=covariates_df,
@@ -63,9 +84,29 @@ def perform_nominal_mapping(genotype_df, variant_df, phenotype_df, phenotype_pos
         write_top=True, write_stats=True
     )
     print(f"Nominal mapping results saved with prefix {outfile}")
+    if store_root:
+        build_store(outfile, os.path.join(store_root, os.path.basename(outfile)), variant_df)
 
-def perform_trans_analysis(genotype_df, phenotype_df, covariates_df, outfile, pval_threshold, maf_threshold):
+def add_trans_qvalues(genotype_df, phenotype_df, outfile, maf_threshold, all_tests=False):
+    """两遍流式读取trans结果文件，在pval列后加入BH q值（all_tests 时分母为 MAF过滤后变异数 × 基因数）."""
+    n_tests = None
+    if all_tests:
+        n_tests = count_maf_variants(genotype_df, phenotype_df.columns, maf_threshold) * phenotype_df.shape[0]
+        print(f"BH denominator: {n_tests} tests")
+    add_qvalues_to_file(outfile, n_tests=n_tests, sep=',')
+    print(f"Trans-QTL q-values added to {outfile}")
+
+def perform_trans_analysis(genotype_df, phenotype_df, covariates_df, outfile, pval_threshold, maf_threshold, engine='tensorqtl', threads=None):
     """执行trans-QTL分析."""
+    if engine == 'cpu':
+        # CPU分块引擎：通过阈值的位点对直接流式写入文件
+        n_pairs = map_trans_cpu(
+            genotype_df, phenotype_df, covariates_df,
+            pval_threshold=pval_threshold, maf_threshold=maf_threshold, batch_size=20000,
+            n_threads=threads, out_file=outfile, sep=','
+        )
+        print(f"Trans-QTL analysis results ({n_pairs} pairs) saved to {outfile}")
+        return
     trans_df = trans.map_trans(
         genotype_df, phenotype_df, covariates_df,
         return_sparse=True, pval_threshold=pval_threshold, maf_threshold=maf_threshold, batch_size=20000
@@ -82,7 +123,14 @@ def perform_trans_analysis(genotype_df, phenotype_df, covariates_df, outfile, pv
 @click.option('--maf_threshold', type=float, default=0.01, show_default=True, help="Minor allele frequency threshold.")
 @click.option('--window', type=int, default=1000000, show_default=True, help="Window size (in base pairs) for cis-sQTL analysis.")
 @click.option('--pval_threshold', type=float, default=1e-8, show_default=True, help="P-value threshold for trans-QTL analysis.")
-def main(expression_bed, covariates_file, outfile, mode, nperm, maf_threshold, window, pval_threshold):
+@click.option('--engine', type=click.Choice(['tensorqtl', 'cpu']), default='tensorqtl', show_default=True, help="trans-QTL engine: tensorqtl or cpu (tiled NumPy/BLAS engine for CPU-only nodes).")
+@click.option('--threads', type=int, default=None, help="Threads for the cpu trans engine (default: all cores).")
+@click.option('--adaptive', is_flag=True, help="Adaptive permutations for cis-eQTL (stop early for clearly null genes).")
+@click.option('--workers', type=int, default=1, show_default=True, help="Worker processes for cis-eQTL (chunks balanced by cis variant count).")
+@click.option('--nominal_store', type=click.Path(), default=None, help="Also write nominal results to this indexed store root (mode 'n').")
+@click.option('--qvalues', is_flag=True, help="Add BH q-values to the trans-QTL output (streamed, mode 't').")
+@click.option('--fdr_all_tests', is_flag=True, help="With --qvalues, use variants passing MAF x genes as the BH denominator.")
+def main(expression_bed, covariates_file, outfile, mode, nperm, maf_threshold, window, pval_threshold, engine, threads, adaptive, workers, nominal_store, qvalues, fdr_all_tests):
     """
     主函数，用于运行 QTL 分析。
     """
@@ -90,19 +138,24 @@ def main(expression_bed, covariates_file, outfile, mode, nperm, maf_threshold, w
     phenotype_df, phenotype_pos_df = load_expression_data(expression_bed)
     covariates_df = load_covariates(covariates_file, phenotype_df.columns)
 
+    if mode == 'p' and workers > 1:
+        # 各进程自行内存映射基因型区间，不需要加载全部基因型
+        perform_cis_analysis(None, None, phenotype_df, phenotype_pos_df, covariates_df, outfile, nperm, maf_threshold, window, adaptive, workers)
+        return
+
     # 加载基因型数据（使用硬编码路径）
     print(f"Loading PLINK data from: {PLINK_PREFIX_PATH}")
-    pr = genotypeio.PlinkReader(PLINK_PREFIX_PATH, select_samples=phenotype_df.columns)
-    genotype_df = pr.load_genotypes()
-    variant_df = pr.bim.set_index('snp')[['chrom', 'pos']]
+    genotype_df, variant_df = genotype_cache.load_genotypes(PLINK_PREFIX_PATH, select_samples=phenotype_df.columns)
 
     # 根据 mode 运行不同分析
     if mode == 'p':
-        perform_cis_analysis(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, nperm, maf_threshold, window)
+        perform_cis_analysis(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, nperm, maf_threshold, window, adaptive)
     elif mode == 'n':
-        perform_nominal_mapping(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, maf_threshold, window)
+        perform_nominal_mapping(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, maf_threshold, window, nominal_store)
     elif mode == 't':
-        perform_trans_analysis(genotype_df, phenotype_df, covariates_df, outfile, pval_threshold, maf_threshold)
+        perform_trans_analysis(genotype_df, phenotype_df, covariates_df, outfile, pval_threshold, maf_threshold, engine, threads)
+        if qvalues:
+            add_trans_qvalues(genotype_df, phenotype_df, outfile, maf_threshold, fdr_all_tests)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,8 +1,48 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 import pandas as pd
 import click
 
+def load_gene_bed(gene_bed):
+    """
+    读取基因BED文件（chrom, start, end, strand, gene_id），构建以基因ID为索引的注释表，
+    包含染色体（int）、转录起始位点TSS（int）和链方向三列。
+    """
+    gene_bed_df = pd.read_csv(gene_bed, sep="\t", header=None, usecols=[0, 1, 2, 3, 4],
+                              dtype={0: np.int64, 1: np.int64, 2: np.int64, 3: str, 4: str})
+    strand = gene_bed_df[3].to_numpy()
+    # 计算转录起始位点（TSS）：正链取start，负链取end
+    tss = np.where(strand == "+", gene_bed_df[1].to_numpy(), gene_bed_df[2].to_numpy())
+    return pd.DataFrame({'chrom': gene_bed_df[0].to_numpy(), 'tss': tss, 'strand': strand},
+                        index=pd.Index(gene_bed_df[4].to_numpy(), name='gene_id'))
+
+def build_phenotype_bed(peer_residuals_df, gene_annot_df):
+    """
+    将PEER矫正后的数据（行为样本，列为基因）处理为tensorQTL输入格式。
+    """
+    # 按基因ID一次性匹配坐标，跳过scaffold上（不在注释中）的基因
+    idx = gene_annot_df.index.get_indexer(peer_residuals_df.columns)
+    keep = idx >= 0
+    idx = idx[keep]
+    chrom = gene_annot_df['chrom'].to_numpy()[idx]
+    tss = gene_annot_df['tss'].to_numpy()[idx]
+
+    # 按照染色体和起始位置排序（稳定排序，与原始列顺序一致）
+    order = np.lexsort((tss, chrom))
+    cols = np.flatnonzero(keep)[order]
+
+    # 将基因信息和表达数据合并为DataFrame
+    gene_info_df = pd.DataFrame({
+        '#chr': chrom[order],
+        'start': tss[order],
+        'end': tss[order] + 1,
+        'phenotype': peer_residuals_df.columns[cols],
+    })
+    expression_info_df = pd.DataFrame(peer_residuals_df.to_numpy()[:, cols].T,
+                                      columns=peer_residuals_df.index)
+    return pd.concat([gene_info_df, expression_info_df], axis=1)
+
 @click.command()
 @click.option("--peer_residuals", type=click.Path(exists=True), required=True, help="PEER矫正后的残差数据文件路径（CSV格式）。")
 @click.option("--gene_bed", type=click.Path(exists=True), required=True, help="基因的BED文件路径（包含基因坐标信息）。")
@@ -14,35 +54,15 @@ def main(peer_residuals, gene_bed, out_file):
     # 读取PEER矫正后的残差数据
     peer_residuals_df = pd.read_csv(peer_residuals, header=0, index_col=0, sep="\t")
 
-    # 读取基因BED文件
-    gene_bed_df = pd.read_csv(gene_bed, index_col=4, sep="\t", header=None)
-    gene_bed_df[0] = gene_bed_df[0].apply(lambda x: int(x))  
-    gene_bed_df['TSS'] = gene_bed_df.apply(lambda x: x[1] if x[3] == "+" else x[2], axis=1)  # 计算转录起始位点（TSS）
+    # 读取基因BED文件，构建注释索引
+    gene_annot_df = load_gene_bed(gene_bed)
 
     # 处理数据并生成tensorQTL输入格式
-    gene_info = []
-    expression_info = []
-    for gene_id, express_data in peer_residuals_df.T.iterrows():
-        if gene_id not in gene_bed_df.index:
-            # 跳过scaffold上的基因
-            continue
-        else:
-            chrom, start, end, strand, tss = gene_bed_df.loc[gene_id]
-            gene_info.append([int(chrom), tss, tss + 1, gene_id])  # 添加基因坐标信息
-            expression_info.append(express_data.values)  # 添加表达数据
-
-    # 将基因信息和表达数据合并为DataFrame
-    gene_info_df = pd.DataFrame(gene_info)
-    expression_info_df = pd.DataFrame(expression_info)
-    out_df = pd.concat([gene_info_df, expression_info_df], axis=1)
-    out_df.columns = ['#chr', 'start', 'end', 'phenotype'] + list(peer_residuals_df.T.columns)
-
-    # 按照染色体和起始位置排序
-    out_df = out_df.sort_values(by=['#chr', 'start'])
+    out_df = build_phenotype_bed(peer_residuals_df, gene_annot_df)
 
     # 保存结果
     out_df.to_csv(out_file, header=True, index=False, sep="\t")
     print(f"tensorQTL输入格式的数据已保存至: {out_file}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
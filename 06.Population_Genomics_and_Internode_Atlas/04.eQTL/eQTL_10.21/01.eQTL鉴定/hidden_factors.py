@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+'''
+隐藏因子估计（替代 peer.r 对每个 K 单独运行 PEER_update），输出格式与 peer.r 相同：
+    factors_K.txt    K 行 × 样本，行名为 1..K，无表头
+    residuals_K.txt  基因 × 样本，行名为 1..G，无表头（peer_RINT.py / residuals_to_bed.py 直接读取）
+
+每个时期的表达矩阵只读一次，所有 K 共用一次拟合：
+    --method peer  与 PEER 相同的贝叶斯因子模型（因子 ~ N(0, I)，权重带 ARD 先验，每个基因独立噪声精度），
+                   变分 EM 求解，PCA 初始化；
+    --method pca   PCA（样本 Gram 矩阵的特征分解），所有 K 的结果嵌套，适合快速探索 K。
+    --strategy warm    K 从小到大依次拟合，每个 K 以上一个 K 的解为初值，新增因子取自当前残差的主成分；
+    --strategy nested  只拟合最大的 K，较小的 K 取按 ARD 相关性（1/alpha）排序的前 K 个因子。
+按基因的更新在线程池中分块并行。残差为 Y - X W^T（同 PEER_getResiduals，保留基因均值）。
+'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import click
+import numpy as np
+import pandas as pd
+
+# PEER 的默认先验（PEER_setPriorAlpha / PEER_setPriorEps）和迭代参数
+ALPHA_PRIOR = (0.001, 0.1)
+EPS_PRIOR = (0.1, 10.0)
+MAX_ITER = 1000
+TOLERANCE = 1e-5
+DEFAULT_K = (5, 10, 15, 20, 25, 30, 35, 40)
+
+def _gene_blocks(n_genes, threads, block_size=8192):
+    """按基因（列）切分的块，块数不少于线程数"""
+    block_size = max(1, min(block_size, -(-n_genes // max(threads, 1))))
+    return [slice(s, min(s + block_size, n_genes)) for s in range(0, n_genes, block_size)]
+
+def _map_blocks(func, blocks, threads):
+    """在线程池中对每个基因块调用 func（numpy 的矩阵运算会释放 GIL）"""
+    if threads <= 1 or len(blocks) == 1:
+        return [func(b) for b in blocks]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return list(pool.map(func, blocks))
+
+def pca_components(Y, k, threads=1):
+    """
+    中心化矩阵 Y（样本 × 基因）的前 k 个主成分：对 N × N 的 Gram 矩阵做特征分解，
+    返回单位方差的因子 (N × k) 和对应的权重 (G × k)，使 X W^T 为 Y 的最佳秩 k 近似。
+    """
+    n = Y.shape[0]
+    blocks = _gene_blocks(Y.shape[1], threads)
+    gram = sum(_map_blocks(lambda b: Y[:, b] @ Y[:, b].T, blocks, threads))
+    eigval, eigvec = np.linalg.eigh(gram)
+    top = np.argsort(eigval)[::-1][:k]
+    X = eigvec[:, top] * np.sqrt(n)
+    W = np.vstack(_map_blocks(lambda b: Y[:, b].T @ X / n, blocks, threads))
+    return X, W
+
+def fit_peer(Y, k, init=None, max_iter=MAX_ITER, tol=TOLERANCE, threads=1):
+    """
+    变分 EM 拟合 PEER 因子模型 Y = X W^T + E（Y 为中心化的 样本 × 基因 矩阵）。
+
+    参数:
+        init (dict): 上一次拟合的结果（X/W/alpha），不足 k 个因子时用当前残差的主成分补足；为空时用 PCA 初始化。
+    返回:
+        dict: X (N × k)，W (G × k)，alpha (k)，tau (G)，n_iter。
+    """
+    n, g = Y.shape
+    blocks = _gene_blocks(g, threads)
+    if init is None:
+        X, W = pca_components(Y, k, threads)
+        alpha = g / np.maximum((W ** 2).sum(axis=0), 1e-12)
+    else:
+        X, W, alpha = init['X'], init['W'], init['alpha']
+        if X.shape[1] < k:
+            residual = Y - X @ W.T
+            X_new, W_new = pca_components(residual, k - X.shape[1], threads)
+            del residual
+            X, W = np.hstack([X, X_new]), np.hstack([W, W_new])
+            alpha = np.concatenate([alpha, g / np.maximum((W_new ** 2).sum(axis=0), 1e-12)])
+        X, W, alpha = X[:, :k].copy(), W[:, :k].copy(), alpha[:k].copy()
+    tau = 1.0 / np.maximum(np.concatenate(_map_blocks(
+        lambda b: ((Y[:, b] - X @ W[b].T) ** 2).mean(axis=0), blocks, threads)), 1e-12)
+    yy = np.concatenate(_map_blocks(lambda b: (Y[:, b] ** 2).sum(axis=0), blocks, threads))
+    sigma_x = np.zeros((k, k))
+
+    noise = np.mean(1.0 / tau)
+    for it in range(1, max_iter + 1):
+        # 权重 q(W)：Sigma_Wg = (diag(alpha) + tau_g S)^-1 = P diag(1 / (1 + tau_g lam)) P^T，
+        # 其中 S = E[X^T X]，D = diag(alpha)^-1/2，D S D = Q diag(lam) Q^T，P = D Q，所有基因共用一次特征分解
+        S = X.T @ X + n * sigma_x
+        dh = 1.0 / np.sqrt(alpha)
+        lam, Q = np.linalg.eigh(dh[:, None] * S * dh[None, :])
+        lam = np.maximum(lam, 0)
+        P = dh[:, None] * Q
+        P2 = (P ** 2).T
+
+        def update_block(b):
+            C = Y[:, b].T @ X
+            d = 1.0 / (1.0 + tau[b, None] * lam[None, :])
+            W_b = (tau[b, None] * d * (C @ P)) @ P.T
+            # 噪声精度 q(tau)：E||y_g - X w_g||^2 = y'y - 2 y'X w + w' S w + tr(S Sigma_Wg)
+            err = yy[b] - 2 * (C * W_b).sum(axis=1) + ((W_b @ S) * W_b).sum(axis=1) + (d * lam).sum(axis=1)
+            tau_b = (EPS_PRIOR[0] + n / 2) / (EPS_PRIOR[1] + np.maximum(err, 0) / 2)
+            # E[w w^T] = W_b W_b^T + Sigma_Wg 取自同一个 q(W)（即计算 W_b 时的 d），只有 E[tau] 用更新后的值
+            w2 = (W_b ** 2 + d @ P2).sum(axis=0)
+            tau_w = tau_b[:, None] * W_b
+            return W_b, tau_b, w2, tau_w.T @ W_b, (tau_b[:, None] * d).sum(axis=0), Y[:, b] @ tau_w
+
+        parts = _map_blocks(update_block, blocks, threads)
+        W = np.vstack([p[0] for p in parts])
+        tau = np.concatenate([p[1] for p in parts])
+        # ARD 精度 q(alpha)
+        alpha = (ALPHA_PRIOR[0] + g / 2) / (ALPHA_PRIOR[1] + sum(p[2] for p in parts) / 2)
+        # 因子 q(X)：Sigma_X = (I + sum_g tau_g E[w_g w_g^T])^-1，E[x_n] = Sigma_X sum_g tau_g w_g y_ng
+        A = np.eye(k) + sum(p[3] for p in parts) + (P * sum(p[4] for p in parts)) @ P.T
+        sigma_x = np.linalg.inv(A)
+        X = sum(p[5] for p in parts) @ sigma_x
+
+        new_noise = np.mean(1.0 / tau)
+        if abs(new_noise - noise) / noise < tol:
+            break
+        noise = new_noise
+    return {'X': X, 'W': W, 'alpha': alpha, 'tau': tau, 'n_iter': it}
+
+def iter_hidden_factors(expr_df, k_values, method='peer', strategy='warm', max_iter=MAX_ITER, tol=TOLERANCE, threads=None):
+    """
+    对一个时期的表达矩阵（行为基因，列为样本）按 K 从小到大依次返回 (K, 因子, 残差)：
+    因子为 K × 样本 的 DataFrame，残差为 基因 × 样本 的 DataFrame（同 peer.r 中的 factors / residuals）。
+    """
+    if expr_df.isnull().values.any():
+        raise ValueError("Expression matrix contains missing values")
+    threads = threads or os.cpu_count() or 1
+    k_values = sorted(set(k_values))
+    Y = expr_df.to_numpy(dtype=np.float64).T.copy()
+    Y -= Y.mean(axis=0)
+    samples = expr_df.columns
+
+    if method == 'pca':
+        X, W = pca_components(Y, k_values[-1], threads)
+        order = np.arange(k_values[-1])
+    elif strategy == 'nested':
+        fit = fit_peer(Y, k_values[-1], max_iter=max_iter, tol=tol, threads=threads)
+        print(f"  PEER K={k_values[-1]}: {fit['n_iter']} iterations")
+        X, W = fit['X'], fit['W']
+        order = np.argsort(fit['alpha'], kind='stable')
+    else:
+        fit = None
+
+    for k in k_values:
+        if method == 'peer' and strategy == 'warm':
+            fit = fit_peer(Y, k, init=fit, max_iter=max_iter, tol=tol, threads=threads)
+            print(f"  PEER K={k}: {fit['n_iter']} iterations")
+            X, W = fit['X'], fit['W']
+            cols = np.arange(k)
+        else:
+            cols = order[:k]
+        # 残差 = 原始表达 - X W^T（Y 已中心化，加回原始数据即保留基因均值）
+        residuals = expr_df.to_numpy(dtype=np.float64) - W[:, cols] @ X[:, cols].T
+        factors = pd.DataFrame(X[:, cols].T, index=np.arange(1, k + 1), columns=samples)
+        yield k, factors, pd.DataFrame(residuals, index=expr_df.index, columns=samples)
+
+def write_peer_table(df, output_file):
+    """同 peer.r 中 write.table(sep = '\\t', quote = FALSE, col.names = FALSE)，行名为 1..n"""
+    df.set_axis(np.arange(1, len(df) + 1), axis=0).to_csv(output_file, sep='\t', header=False, float_format='%.15g')
+
+@click.command()
+@click.option("--expr_file", "-i", "expr_files", type=click.Path(exists=True), multiple=True, required=True,
+              help="表达数据文件路径（行为基因，列为样本），可重复指定多个时期。")
+@click.option("--output_dir", "-o", "output_dirs", type=click.Path(), multiple=True, required=True,
+              help="输出目录路径（每个表达文件一个），写出 factors_K.txt 和 residuals_K.txt。")
+@click.option("--factors", "-k", "k_values", type=int, multiple=True, default=DEFAULT_K, show_default=True,
+              help="因子数量，可重复指定。")
+@click.option("--method", type=click.Choice(["peer", "pca"]), default="peer", show_default=True,
+              help="peer：PEER 贝叶斯因子模型；pca：主成分（快速探索 K）。")
+@click.option("--strategy", type=click.Choice(["warm", "nested"]), default="warm", show_default=True,
+              help="warm：K 从小到大热启动；nested：只拟合最大的 K（仅 --method peer）。")
+@click.option("--max_iter", type=int, default=MAX_ITER, show_default=True, help="每次拟合的最大迭代次数。")
+@click.option("--tol", type=float, default=TOLERANCE, show_default=True, help="残差方差的相对变化小于该值时停止迭代。")
+@click.option("--threads", "-t", type=int, default=None, help="按基因分块并行的线程数（默认：全部核心）。")
+def main(expr_files, output_dirs, k_values, method, strategy, max_iter, tol, threads):
+    """
+    一次拟合估计所有 K 的隐藏因子，输出与 peer.r 相同格式的因子和残差文件。
+    """
+    if len(expr_files) != len(output_dirs):
+        raise click.BadParameter("--expr_file and --output_dir must be given the same number of times")
+    for expr_file, output_dir in zip(expr_files, output_dirs):
+        expr = pd.read_csv(expr_file, sep="\t", index_col=0)
+        print(f"输入数据的维度：{expr.shape[0]} {expr.shape[1]}")
+        os.makedirs(output_dir, exist_ok=True)
+        for k, factors, residuals in iter_hidden_factors(expr, k_values, method=method, strategy=strategy,
+                                                         max_iter=max_iter, tol=tol, threads=threads):
+            factors_file = os.path.join(output_dir, f"factors_{k}.txt")
+            residuals_file = os.path.join(output_dir, f"residuals_{k}.txt")
+            write_peer_table(factors, factors_file)
+            write_peer_table(residuals, residuals_file)
+            print(f"K={k} 的结果已保存至：{factors_file}, {residuals_file}")
+
+if __name__ == "__main__":
+    main()
@@ -1,97 +1,217 @@
 import pandas as pd
 import numpy as np
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils import gen_batches
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import click
 import os
+import sys
+
+# 表达图谱模块位于 03.Expression_atlases/02.定量统计
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..',
+                             '03.Expression_atlases', '02.定量统计'))
+
+def stage_genes_samples(input_file, atlas=None):
+    """
+    只读取一个时期表达文件的第1列（基因ID）和表头（样本名）。
+    atlas（ExpressionAtlas）不为空时 input_file 为时期名，从图谱的索引文件获取。
+    """
+    if atlas is not None:
+        return atlas.genes[atlas.gene_rows(input_file)], list(atlas.stage_samples(input_file))
+    samples = list(pd.read_csv(input_file, sep="\t", index_col=0, nrows=0).columns)
+    genes = pd.Index(pd.read_csv(input_file, sep="\t", usecols=[0], dtype=str).iloc[:, 0])
+    return genes, samples
+
+def iter_stage_chunks(input_file, chunksize=5000, atlas=None):
+    """按基因分块读取一个时期的表达数据，数值按 float32 读入，依次返回 (基因ID, 基因×样本 矩阵)"""
+    if atlas is not None:
+        yield from atlas.iter_chunks(input_file, chunksize=chunksize)
+        return
+    header = pd.read_csv(input_file, sep="\t", index_col=0, nrows=0)
+    dtypes = {c: np.float32 for c in header.columns}
+    for chunk in pd.read_csv(input_file, sep="\t", index_col=0, dtype=dtypes, chunksize=chunksize):
+        yield chunk.index.astype(str), chunk.to_numpy()
+
+def fill_stage(X, offset, input_file, common_genes, atlas=None):
+    """
+    把一个时期的表达数据逐块写入 样本×基因 矩阵 X 的 [offset, offset + 样本数) 行，
+    列按 common_genes 的顺序；同一时间只有一个基因块在内存中。
+    有缺失值的基因保留为 NaN，由 standardize_inplace 去除（同原来的 dropna 后取共同基因）。
+    """
+    for genes, values in iter_stage_chunks(input_file, atlas=atlas):
+        cols = common_genes.get_indexer(genes)
+        keep = cols >= 0
+        X[offset:offset + values.shape[1], cols[keep]] = values[keep].T
+
+def standardize_inplace(X, block_size=4096):
+    """
+    按基因（列）分块原地标准化样本×基因矩阵（均值为0，方差为1，ddof=1），
+    方差为0或标准化后不为有限值的基因被去除，保留的列原地前移。
+    均值和标准差用 float64 计算，不生成整个矩阵的 float64 副本。
+
+    返回:
+        (np.ndarray, np.ndarray): 保留基因的矩阵视图，以及保留基因的原列号。
+    """
+    n_genes = X.shape[1]
+    kept, dst = [], 0
+    for start in range(0, n_genes, block_size):
+        block = X[:, start:start + block_size].astype(np.float64)
+        block -= block.mean(axis=0)
+        std = np.sqrt((block ** 2).sum(axis=0) / (block.shape[0] - 1))
+        keep = std > 0
+        block[:, keep] /= std[keep]
+        keep &= np.isfinite(block).all(axis=0)
+        n_keep = int(keep.sum())
+        X[:, dst:dst + n_keep] = block[:, keep]
+        kept.append(np.flatnonzero(keep) + start)
+        dst += n_keep
+    return X[:, :dst], np.concatenate(kept) if kept else np.zeros(0, dtype=np.int64)
+
+def run_pca(X, n_components, svd_solver, batch_size=500, random_state=0):
+    """
+    对已标准化的样本×基因矩阵做PCA，返回 (主成分得分, 解释方差比例)。
+
+    svd_solver:
+        full         精确SVD（原 PCA(n_components=3) 的做法）
+        randomized   随机化截断SVD，只求前 n_components 个成分
+        incremental  IncrementalPCA，按样本分批拟合，配合磁盘上的内存映射矩阵使用；
+                     结果为近似解，批次越小、后几个成分的方差越接近，与精确解的差异越大
+    """
+    if svd_solver == "incremental":
+        # 每批至少 n_components 个样本（最后不足的一批并入前一批）
+        batches = list(gen_batches(X.shape[0], max(batch_size, n_components), min_batch_size=n_components))
+        pca = IncrementalPCA(n_components=n_components)
+        for batch in batches:
+            pca.partial_fit(X[batch])
+        result = np.vstack([pca.transform(X[batch]) for batch in batches])
+    else:
+        # 数据已原地标准化，copy=False 时 sklearn 直接在其上去中心化，不再复制
+        pca = PCA(n_components=n_components, svd_solver=svd_solver, copy=False, random_state=random_state)
+        result = pca.fit_transform(X)
+    return result, pca.explained_variance_ratio_
+
+def write_period_files(pca_df, labels, output_dir, stages=None, qcovar_pattern=None):
+    """
+    按时期拆分PCA结果（替代 01.runPCA.sh 中的 grep 循环），
+    并可按样本名关键字写出 GCTA/tensorQTL 协变量文件（替代 07.pre_All_data.sh 中的 awk）。
+    """
+    pc_columns = [c for c in pca_df.columns if c != "Period"]
+    for i, label in enumerate(labels):
+        period_df = pca_df[pca_df["Period"] == label]
+        period_file = os.path.join(output_dir, f"{label}_pca_results.tsv")
+        period_df.to_csv(period_file, sep="\t")
+        if qcovar_pattern is not None:
+            stage = stages[i] if stages else f"Stage{i + 1}"
+            qcovar = period_df.loc[period_df.index.astype(str).str.contains(qcovar_pattern, regex=False), pc_columns]
+            qcovar.insert(0, "IID", qcovar.index)
+            qcovar_file = os.path.join(output_dir, f"PCA_qcovar.{stage}.txt")
+            qcovar.to_csv(qcovar_file, sep="\t", header=False)
+        print(f"{label}: {len(period_df)} 个样本的PCA结果已保存至: {period_file}")
 
 @click.command()
-@click.option("--input1", type=click.Path(exists=True), required=True, help="第一个时期的表达数据文件路径（TSV格式，行为基因，列为样本）。")
-@click.option("--input2", type=click.Path(exists=True), required=True, help="第二个时期的表达数据文件路径（TSV格式，行为基因，列为样本）。")
-@click.option("--input3", type=click.Path(exists=True), required=True, help="第三个时期的表达数据文件路径（TSV格式，行为基因，列为样本）。")
-@click.option("--input4", type=click.Path(exists=True), required=True, help="第四个时期的表达数据文件路径（TSV格式，行为基因，列为样本）。")
+@click.option("--input", "-i", "inputs", multiple=True,
+              help="各时期的表达数据文件路径（TSV格式，行为基因，列为样本），可重复指定任意多个时期；使用 --atlas 时为图谱中的时期名。")
+@click.option("--input1", type=click.Path(exists=True), default=None, help="第一个时期的表达数据文件路径（兼容旧参数）。")
+@click.option("--input2", type=click.Path(exists=True), default=None, help="第二个时期的表达数据文件路径（兼容旧参数）。")
+@click.option("--input3", type=click.Path(exists=True), default=None, help="第三个时期的表达数据文件路径（兼容旧参数）。")
+@click.option("--input4", type=click.Path(exists=True), default=None, help="第四个时期的表达数据文件路径（兼容旧参数）。")
+@click.option("--label", "-l", "labels", multiple=True, help="每个输入的时期标签，默认为 Period1..N。")
+@click.option("--stage", "-s", "stages", multiple=True, help="每个输入的协变量文件名中的时期名，默认为 Stage1..N。")
+@click.option("--atlas", type=click.Path(exists=True), default=None,
+              help="表达图谱目录（expression_atlas.py），按基因分块从内存映射读取，不再解析文本。")
 @click.option("--output_dir", type=click.Path(), required=True, help="输出目录路径，用于保存PCA结果文件和PCA图。")
-def main(input1, input2, input3, input4, output_dir):
+@click.option("--n_components", type=int, default=3, show_default=True, help="主成分个数。")
+@click.option("--svd_solver", type=click.Choice(["randomized", "full", "incremental"]), default="randomized", show_default=True,
+              help="randomized：随机化截断SVD；full：精确SVD；incremental：各时期逐块写入内存映射矩阵 + IncrementalPCA，不把整个矩阵读入内存（适用于全部基因的图谱）。")
+@click.option("--batch_size", type=int, default=500, show_default=True, help="incremental 模式下每批样本数（每批占用 batch_size × 基因数 × 4 字节内存）。")
+@click.option("--qcovar_pattern", default=None,
+              help="写出 PCA_qcovar.<stage>.txt 协变量文件（FID IID PC...），只保留样本名包含该字符串的样本，例如 Cul。")
+def main(inputs, input1, input2, input3, input4, labels, stages, atlas, output_dir, n_components, svd_solver, batch_size, qcovar_pattern):
     """
-    对四个时期的表达数据进行合并标准化，然后进行PCA分析，并绘制三维PCA图，每个时期用不同颜色区分。
+    对任意多个时期的表达数据进行合并标准化，然后进行PCA分析，按时期写出PCA结果，并绘制三维PCA图，每个时期用不同颜色区分。
     """
-    # 定义颜色和标签
-    colors = ['red', 'blue', 'green', 'purple']
-    labels = ['Period1', 'Period2', 'Period3', 'Period4']
-    inputs = [input1, input2, input3, input4]
+    inputs = list(inputs) + [f for f in (input1, input2, input3, input4) if f]
+    if not inputs:
+        raise click.UsageError("请至少提供一个 --input。")
+    labels = list(labels) or [f"Period{i + 1}" for i in range(len(inputs))]
+    if len(labels) != len(inputs) or (stages and len(stages) != len(inputs)):
+        raise click.UsageError("--label / --stage 的个数必须与输入文件个数相同。")
+    if atlas is not None:
+        from expression_atlas import ExpressionAtlas
+        atlas = ExpressionAtlas(atlas)
+        unknown = [i for i in inputs if i not in atlas.stages]
+        if unknown:
+            raise click.UsageError(f"图谱中没有这些时期: {unknown}")
+    else:
+        for input_file in inputs:
+            if not os.path.exists(input_file):
+                raise click.FileError(input_file, hint="文件不存在")
 
     # 创建输出目录
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    # 读取所有文件并提取共同的基因集
-    datasets = []
+    # 第一遍只读基因ID列和表头，确定共同基因（排序）和各时期的样本
+    common_genes, samples, counts = None, [], []
     for input_file in inputs:
-        data = pd.read_csv(input_file, sep="\t", index_col=0)
-        # 去掉有缺失值的基因行
-        data = data.dropna()
-        datasets.append(data)
-        print(f"已读取文件: {input_file}, 样本数: {data.shape[1]}, 基因数: {data.shape[0]}")
-
-    # 找到所有数据集中共同的基因
-    common_genes = set(datasets[0].index)
-    for data in datasets[1:]:
-        common_genes.intersection_update(data.index)
+        genes, stage_samples = stage_genes_samples(input_file, atlas)
+        common_genes = set(genes) if common_genes is None else common_genes & set(genes)
+        samples += stage_samples
+        counts.append(len(stage_samples))
+        print(f"已读取文件: {input_file}, 样本数: {len(stage_samples)}, 基因数: {len(genes)}")
+    common_genes = pd.Index(sorted(common_genes))
     print(f"共同基因数: {len(common_genes)}")
 
-    # 将共同基因转换为列表并排序
-    common_genes = sorted(common_genes)
-
-    # 合并所有时期的数据
-    combined_data = pd.concat([data.loc[common_genes] for data in datasets], axis=1)
-    print(f"合并后的数据, 样本数: {combined_data.shape[1]}, 基因数: {combined_data.shape[0]}")
-
-    # 转置数据，使行为样本，列为基因
-    combined_data = combined_data.T
-
-    # 去除方差为0的基因
-    combined_data = combined_data.loc[:, combined_data.std() > 0]
-    print(f"去除方差为0的基因后, 基因数: {combined_data.shape[1]}")
-
-    # 标准化数据（均值为0，方差为1）
-    combined_data_standardized = (combined_data - combined_data.mean()) / combined_data.std()
-
-    # 检查是否存在NaN
-    if combined_data_standardized.isnull().any().any():
-        print("标准化后存在NaN，将去除包含NaN的样本或基因。")
-        combined_data_standardized = combined_data_standardized.dropna(axis=0)  # 去除包含NaN的样本
-        combined_data_standardized = combined_data_standardized.dropna(axis=1)  # 去除包含NaN的基因
+    # 第二遍逐时期、逐基因块直接写入 样本×基因 的 float32 矩阵，不保留各时期的 DataFrame
+    # （incremental 模式下为输出目录中的内存映射文件，写入时内存中只有一个基因块）
+    shape = (len(samples), len(common_genes))
+    memmap_file = os.path.join(output_dir, "combined_standardized.npy")
+    if svd_solver == "incremental":
+        X = np.lib.format.open_memmap(memmap_file, mode="w+", dtype=np.float32, shape=shape)
+    else:
+        X = np.empty(shape, dtype=np.float32)
+    offset = 0
+    for input_file, n in zip(inputs, counts):
+        fill_stage(X, offset, input_file, common_genes, atlas)
+        offset += n
+    print(f"合并后的数据, 样本数: {X.shape[0]}, 基因数: {X.shape[1]}")
+
+    # 原地标准化，并去除方差为0或有缺失值的基因
+    X, _ = standardize_inplace(X)
+    print(f"去除方差为0或有缺失值的基因后, 基因数: {X.shape[1]}")
 
     # 执行PCA
-    pca = PCA(n_components=3)
-    pca_result = pca.fit_transform(combined_data_standardized)
+    pca_result, explained = run_pca(X, n_components, svd_solver, batch_size=batch_size)
+    print("各主成分解释方差比例: " + ", ".join(f"PC{i + 1}={r:.4f}" for i, r in enumerate(explained)))
+    del X
+    if svd_solver == "incremental":
+        os.remove(memmap_file)
 
-    # 将PCA结果保存为DataFrame
-    pca_df = pd.DataFrame(data=pca_result, columns=[f"PC{i+1}" for i in range(3)])
-    pca_df.index = combined_data.index  # 保留样本名称
-
-    # 为每个样本添加时期标签
-    sample_periods = []
-    for i, input_file in enumerate(inputs):
-        data = pd.read_csv(input_file, sep="\t", index_col=0)
-        sample_periods.extend([labels[i]] * data.shape[1])
-    pca_df['Period'] = sample_periods
+    # 将PCA结果保存为DataFrame，并为每个样本添加时期标签
+    pca_df = pd.DataFrame(data=pca_result, columns=[f"PC{i+1}" for i in range(n_components)], index=samples)
+    pca_df["Period"] = np.repeat(labels, counts)
 
     # 保存PCA结果
     output_file = os.path.join(output_dir, "combined_pca_results.tsv")
     pca_df.to_csv(output_file, sep="\t")
     print(f"合并后的PCA结果已保存至: {output_file}")
+    write_period_files(pca_df, labels, output_dir, stages=list(stages), qcovar_pattern=qcovar_pattern)
+
+    if n_components < 3:
+        print("主成分个数少于3，不绘制三维PCA图。")
+        return
 
     # 绘制三维PCA图
     fig = plt.figure(figsize=(10, 8))
     ax = fig.add_subplot(111, projection='3d')
 
     # 为每个时期绘制散点图
+    colors = ['red', 'blue', 'green', 'purple'] + list(plt.get_cmap("tab20").colors)
     for i, label in enumerate(labels):
         period_data = pca_df[pca_df['Period'] == label]
-        ax.scatter(period_data['PC1'], period_data['PC2'], period_data['PC3'], 
-                   s=50, c=colors[i], label=label)
+        ax.scatter(period_data['PC1'], period_data['PC2'], period_data['PC3'],
+                   s=50, color=colors[i % len(colors)], label=label)
 
     # 设置坐标轴标签
     ax.set_xlabel("PC1")
@@ -99,7 +219,7 @@ def main(input1, input2, input3, input4, output_dir):
     ax.set_zlabel("PC3")
 
     # 设置标题和图例
-    ax.set_title("3D PCA Plot of Four Periods (Combined Standardization)")
+    ax.set_title(f"3D PCA Plot of {len(labels)} Periods (Combined Standardization)")
     ax.legend()
 
     # 保存为PDF
@@ -108,4 +228,4 @@ def main(input1, input2, input3, input4, output_dir):
     print(f"合并后的三维PCA图已保存至: {plot_file}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
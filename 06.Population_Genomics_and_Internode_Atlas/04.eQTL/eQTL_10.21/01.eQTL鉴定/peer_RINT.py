@@ -65,6 +65,73 @@ def rank_to_normal(rank, c, n):
     x = (rank - c) / (n - 2 * c + 1)
     return ss.norm.ppf(x)
 
+def rank_INT_matrix(data, c=0.5, stochastic=False, seed=123, dtype=np.float32):
+    """
+    对整个矩阵（行为样本，列为基因）按列一次性进行基于秩的逆正态变换。
+    与逐列调用 rank_INT 结果一致，NaN 值被忽略，每列的 n 为该列非缺失值个数。
+
+    参数:
+        data (pd.DataFrame): 需要变换的矩阵，行为样本，列为基因。
+        c (float): Blom 常数，默认值为 0.5。
+        stochastic (bool): 是否对相同值的秩进行随机处理，默认值为 False。
+        seed (int): stochastic 模式下的随机种子，每列使用由其派生的独立随机流。
+        dtype: 输出数据类型，默认值为 np.float32。
+
+    返回:
+        pd.DataFrame: 变换后的矩阵，索引和列与输入一致。
+    """
+    assert isinstance(data, pd.DataFrame), "输入必须为 pandas DataFrame"
+    assert isinstance(c, float), "c 必须为浮点数"
+    assert isinstance(stochastic, bool), "stochastic 必须为布尔值"
+
+    values = data.to_numpy(dtype=np.float64)
+    mask = np.isnan(values)
+    # 每列的有效样本数
+    n = (~mask).sum(axis=0)
+
+    if stochastic:
+        # 每列一个独立且可复现的随机流，用随机键打破相同值
+        streams = np.random.SeedSequence(seed).spawn(values.shape[1])
+        keys = np.empty_like(values)
+        for j, ss_j in enumerate(streams):
+            keys[:, j] = np.random.default_rng(ss_j).random(values.shape[0])
+        # 先按值排序，相同值按随机键排序（NaN 排在最后）
+        order = np.lexsort((keys, values), axis=0)
+        rank = np.empty_like(values)
+        ranks_sorted = np.broadcast_to(np.arange(1, values.shape[0] + 1, dtype=np.float64)[:, None], values.shape)
+        np.put_along_axis(rank, order, ranks_sorted, axis=0)
+        rank[mask] = np.nan
+    else:
+        # 使用平均法计算秩（相同值共享平均秩），NaN 保持为 NaN
+        rank = ss.rankdata(values, method="average", axis=0, nan_policy="omit")
+
+    # 将秩一次性转换为正态分布的分位数
+    with np.errstate(invalid="ignore", divide="ignore"):
+        transformed = ss.norm.ppf((rank - c) / (n - 2 * c + 1))
+
+    return pd.DataFrame(transformed.astype(dtype, copy=False), index=data.index, columns=data.columns)
+
+def load_peer_residuals(peer_file, expre_file):
+    """
+    读取 peer.r 输出的残差文件（行为基因，无表头），转置为行是样本、列是基因，
+    并使用表达数据文件的样本ID和基因名作为索引和列名。表达数据文件只读取表头和第一列。
+    """
+    # 读取 PEER 结果文件，并转置数据（行是样本，列是基因）
+    peer_data = pd.read_csv(peer_file, header=None, index_col=0, sep="\t")
+    peer_data = peer_data.T
+
+    # 只读取表达数据文件的表头（样本ID）和第一列（基因名）
+    samples = pd.read_csv(expre_file, header=0, index_col=0, sep="\t", nrows=0).columns
+    genes = pd.read_csv(expre_file, header=0, usecols=[0], sep="\t").iloc[:, 0]
+
+    # 修改索引和列，匹配表达数据的行名和列名
+    peer_data.index = samples  # 样本ID
+    peer_data.columns = genes.values  # 基因名
+
+    # 设置行和列名
+    peer_data.index.name = 'IID'
+    return peer_data
+
 @click.command()
 @click.option("--peer_file", type=click.Path(exists=True), required=True, help="PEER 结果文件路径（CSV格式，行为样本，列为基因）。")
 @click.option("--expre_file", type=click.Path(exists=True), required=True, help="expre结果文件路径（CSV格式，行为样本，列为基因）。")
@@ -74,22 +141,11 @@ def main(peer_file, expre_file, output, stochastic):
     """
     对 PEER 结果文件进行逆正态变换，并保存结果。
     """
-    # 读取 PEER 结果文件，并转置数据（行是基因，列是样本）
-    peer_data = pd.read_csv(peer_file, header=None, index_col=0, sep="\t")
-    peer_data = peer_data.T  # 转置，使得行是样本，列是基因
-
-    # 读取表达数据文件
-    SampleList = pd.read_csv(expre_file, header=0, index_col=0, sep="\t")
+    # 读取 PEER 结果文件，并匹配样本ID和基因名
+    peer_data = load_peer_residuals(peer_file, expre_file)
 
-    # 对每列（基因）进行逆正态变换
-    peer_data_transformed = peer_data.apply(lambda x: rank_INT(x, stochastic=stochastic), axis=0)
-
-    # 修改索引和列，匹配表达数据的行名和列名
-    peer_data_transformed.index = SampleList.columns  # 样本ID
-    peer_data_transformed.columns = SampleList.index  # 基因名
-
-    # 设置行和列名
-    peer_data_transformed.index.name = 'IID'
+    # 对整个矩阵按列（基因）一次性进行逆正态变换
+    peer_data_transformed = rank_INT_matrix(peer_data, stochastic=stochastic)
 
     # 保存逆正态变换后的数据
     peer_data_transformed.to_csv(output, sep="\t", header=True, index=True)
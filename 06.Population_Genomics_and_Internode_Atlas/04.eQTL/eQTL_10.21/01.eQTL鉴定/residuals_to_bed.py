@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+'''
+PEER残差 -> 逆正态变换 -> tensorQTL表型BED（bgzip + tabix）一步完成，
+中间结果在内存中传递，不再写出/重新解析TSV。
+'''
+
+import os
+import subprocess
+import click
+from peer_RINT import load_peer_residuals, rank_INT_matrix
+from gene_TSS import load_gene_bed, build_phenotype_bed
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+def write_bgzip_bed(out_df, out_file):
+    """将表型BED写为bgzip压缩文件并建立tabix索引。"""
+    text = out_df.to_csv(header=True, index=False, sep="\t")
+    if pysam is not None:
+        # 进程内写出BGZF块压缩文件并建立索引
+        with pysam.BGZFile(out_file, "wb") as f:
+            f.write(text.encode())
+        pysam.tabix_index(out_file, preset="bed", force=True, keep_original=True)
+    else:
+        # 没有pysam时退回到命令行bgzip/tabix
+        with open(out_file, "wb") as f:
+            subprocess.run(["bgzip", "-c"], input=text.encode(), stdout=f, check=True)
+        subprocess.run(["tabix", "-f", "-p", "bed", out_file], check=True)
+    return out_file
+
+@click.command()
+@click.option("--peer_file", type=click.Path(exists=True), required=True, help="peer.r 输出的残差文件路径（residuals_K.txt）。")
+@click.option("--expre_file", type=click.Path(exists=True), required=True, help="表达数据文件路径，用于获取样本ID和基因名。")
+@click.option("--gene_bed", type=click.Path(exists=True), required=True, help="基因的BED文件路径（包含基因坐标信息）。")
+@click.option("--out_file", type=click.Path(), required=True, help="输出文件路径（.bed.gz，同时生成 .tbi 索引）。")
+@click.option("--rint_file", type=click.Path(), default=None, help="可选：同时保存逆正态变换后的TSV。")
+@click.option("--stochastic", is_flag=True, help="是否对相同值的秩进行随机处理。")
+def main(peer_file, expre_file, gene_bed, out_file, rint_file, stochastic):
+    """
+    将PEER残差直接处理为排序、压缩并建立索引的tensorQTL表型BED文件。
+    """
+    # 读取残差并进行逆正态变换
+    peer_data = load_peer_residuals(peer_file, expre_file)
+    peer_data_transformed = rank_INT_matrix(peer_data, stochastic=stochastic)
+    if rint_file:
+        peer_data_transformed.to_csv(rint_file, sep="\t", header=True, index=True)
+        print(f"逆正态变换后的数据已保存至: {rint_file}")
+
+    # 生成tensorQTL输入格式并写出
+    gene_annot_df = load_gene_bed(gene_bed)
+    out_df = build_phenotype_bed(peer_data_transformed, gene_annot_df)
+    if not out_file.endswith(".gz"):
+        out_file = f"{out_file}.gz"
+    write_bgzip_bed(out_df, out_file)
+    print(f"tensorQTL输入格式的数据已保存至: {out_file}（索引: {os.path.basename(out_file)}.tbi）")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+'''
+cis-eQTL 置换检验引擎
+
+map_cis_adaptive: 自适应置换的 cis 映射。每个基因按轮次进行置换，
+当经验 p 值的置信下限已明显高于显著区域（stop_pval）时提前停止；
+需要完整分辨率的基因跑满 nperm 次置换，结果与 tensorqtl.cis.map_cis 相同（含 pval_beta）。
+
+map_cis_sharded: 按染色体分片的 cis 映射。预先计算每个基因的 cis 窗口变异下标区间
+[first_variant, last_variant) 并保存；每个分片在独立进程中只内存映射自己的基因型区间，
+各分片使用相同的随机种子（置换与整体运行一致），最后按原顺序合并。
+分片也可以按 cis 变异数均衡划分（n_chunks），用于单条染色体内的多进程并行。
+'''
+
+import os
+import time
+import hashlib
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import torch
+from scipy import stats
+from tensorqtl import genotypeio, cis
+from tensorqtl.core import Residualizer, impute_mean, calculate_maf, center_normalize, \
+    calculate_beta_approx_pval, output_dtype_dict
+from tensorqtl.cis import calculate_cis_permutations, prepare_cis_output
+import genotype_cache
+
+def _permutation_r2_max(genotypes_t, phenotype_t, permutation_ix_t, residualizer):
+    """计算一轮置换中每次置换的最大 r2（genotypes_t 已残差化并标准化）"""
+    permutations_t = phenotype_t[permutation_ix_t]
+    if residualizer is not None:
+        permutations_t = residualizer.transform(permutations_t)
+    permutations_t = center_normalize(permutations_t, dim=1)
+    r2_t = torch.mm(genotypes_t, permutations_t.t()).pow(2)
+    return r2_t.max(0)[0].cpu().numpy()
+
+def map_cis_adaptive(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df=None,
+                     maf_threshold=0, nperm=10000, round_size=1000, stop_pval=0.05, confidence=0.99,
+                     window=1000000, seed=None, verbose=True):
+    """
+    自适应置换的 cis-QTL 映射，输出列与 tensorqtl.cis.map_cis 相同，另加 nperm 列（实际置换次数）。
+
+    参数:
+        nperm (int): 最大置换次数。
+        round_size (int): 每轮置换次数，第一轮也至少进行这么多次。
+        stop_pval (float): 经验 p 值的单侧置信下限超过该值时停止置换。
+        confidence (float): 置信水平（Clopper-Pearson）。
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    if covariates_df is not None:
+        assert covariates_df.index.equals(phenotype_df.columns), 'Sample names in phenotype matrix columns and covariate matrix rows do not match!'
+        residualizer = Residualizer(torch.tensor(covariates_df.values, dtype=torch.float32).to(device))
+        dof = phenotype_df.shape[1] - 2 - covariates_df.shape[1]
+    else:
+        residualizer = None
+        dof = phenotype_df.shape[1] - 2
+
+    if verbose:
+        print(f"cis-QTL mapping (adaptive permutations, up to {nperm}, rounds of {round_size}): "
+              f"{phenotype_df.shape[1]} samples, {phenotype_df.shape[0]} phenotypes, {genotype_df.shape[0]} variants")
+
+    genotype_ix = genotype_df.columns.get_indexer(phenotype_df.columns)
+    genotype_ix_t = torch.from_numpy(genotype_ix).to(device)
+
+    # 置换下标与 map_cis 相同（相同种子下前 n 次置换一致）
+    n_samples = phenotype_df.shape[1]
+    ix = np.arange(n_samples)
+    if seed is not None:
+        np.random.seed(seed)
+    permutation_ix_t = torch.LongTensor(np.array([np.random.permutation(ix) for i in range(nperm)])).to(device)
+
+    res_df = []
+    n_full = 0
+    igc = genotypeio.InputGeneratorCis(genotype_df, variant_df, phenotype_df, phenotype_pos_df, window=window)
+    if igc.n_phenotypes == 0:
+        raise ValueError('No valid phenotypes found.')
+    start_time = time.time()
+    for phenotype, genotypes, genotype_range, phenotype_id in igc.generate_data(verbose=verbose):
+        genotypes_t = torch.tensor(genotypes, dtype=torch.float).to(device)
+        genotypes_t = genotypes_t[:, genotype_ix_t]
+        impute_mean(genotypes_t)
+
+        if maf_threshold > 0:
+            mask_t = calculate_maf(genotypes_t) >= maf_threshold
+            genotypes_t = genotypes_t[mask_t]
+            genotype_range = genotype_range[mask_t.cpu().numpy().astype(bool)]
+
+        # 去除单态变异
+        mono_t = (genotypes_t == genotypes_t[:, [0]]).all(1)
+        if mono_t.any():
+            genotypes_t = genotypes_t[~mono_t]
+            genotype_range = genotype_range[~mono_t.cpu().numpy()]
+
+        if genotypes_t.shape[0] == 0:
+            print(f'WARNING: skipping {phenotype_id} (no valid variants)')
+            continue
+
+        # 第一轮：名义关联和前 round_size 次置换
+        phenotype_t = torch.tensor(phenotype, dtype=torch.float).to(device)
+        res = calculate_cis_permutations(genotypes_t, phenotype_t, permutation_ix_t[:round_size],
+                                         residualizer=residualizer)
+        r_nominal, std_ratio, var_ix, r2_perm, g = [i.cpu().numpy() for i in res]
+        r2_nominal = r_nominal * r_nominal
+        r2_perms = [r2_perm]
+        n_done = len(r2_perm)
+        n_exceed = int(np.sum(r2_perm >= r2_nominal))
+
+        # 后续轮次：基因型只残差化和标准化一次
+        if n_done < nperm:
+            genotypes_res_t = residualizer.transform(genotypes_t) if residualizer is not None else genotypes_t
+            genotypes_res_t = center_normalize(genotypes_res_t, dim=1)
+            genotypes_res_t = genotypes_res_t[~torch.isnan(genotypes_res_t).any(1)]
+        while n_done < nperm:
+            # 经验 p 值的置信下限已高于显著区域，停止置换
+            if n_exceed > 0 and stats.beta.ppf(1 - confidence, n_exceed, n_done - n_exceed + 1) > stop_pval:
+                break
+            r2_perm = _permutation_r2_max(genotypes_res_t, phenotype_t,
+                                          permutation_ix_t[n_done:n_done + round_size], residualizer)
+            r2_perms.append(r2_perm)
+            n_done += len(r2_perm)
+            n_exceed += int(np.sum(r2_perm >= r2_nominal))
+        n_full += n_done == nperm
+
+        r2_perm = np.concatenate(r2_perms)
+        var_ix = genotype_range[var_ix]
+        variant_id = variant_df.index[var_ix]
+        start_distance = variant_df['pos'].values[var_ix] - igc.phenotype_start[phenotype_id]
+        end_distance = variant_df['pos'].values[var_ix] - igc.phenotype_end[phenotype_id]
+        res_s = prepare_cis_output(r_nominal, r2_perm, std_ratio, g, genotypes_t.shape[0], dof, variant_id,
+                                   start_distance, end_distance, phenotype_id, nperm=n_done)
+        res_s[['pval_beta', 'beta_shape1', 'beta_shape2', 'true_df', 'pval_true_df']] = \
+            calculate_beta_approx_pval(r2_perm, r2_nominal, dof)
+        res_s['nperm'] = n_done
+        res_df.append(res_s)
+
+    res_df = pd.concat(res_df, axis=1, sort=False).T
+    res_df.index.name = 'phenotype_id'
+    if verbose:
+        print(f"  * {n_full} / {len(res_df)} phenotypes ran all {nperm} permutations")
+        print(f"  Time elapsed: {(time.time() - start_time) / 60:.2f} min")
+    return res_df.astype({**output_dtype_dict, 'nperm': np.int32}).infer_objects()
+
+def build_cis_index(variant_df, phenotype_pos_df, window):
+    """
+    计算每个基因 cis 窗口对应的全局变异下标区间 [start_ix, end_ix)（与 tensorqtl 的窗口定义一致）。
+    要求变异按染色体连续存放、染色体内按位置排序。没有 cis 变异的基因不在结果中。
+    """
+    chroms = variant_df['chrom'].values
+    positions = variant_df['pos'].values
+    # 每条染色体在变异表中的连续区间
+    change = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+    starts = np.r_[0, change]
+    ends = np.r_[change, len(chroms)]
+    assert len(set(chroms[starts])) == len(starts), "Variants must be grouped by chromosome."
+    bounds = {c: (lo, hi) for c, lo, hi in zip(chroms[starts], starts, ends)}
+
+    if 'pos' in phenotype_pos_df:
+        pos_df = phenotype_pos_df.rename(columns={'pos': 'start'})
+        pos_df['end'] = pos_df['start']
+    else:
+        pos_df = phenotype_pos_df
+
+    index = []
+    for chrom, g in pos_df.groupby('chr', sort=False):
+        if chrom not in bounds:
+            continue
+        lo, hi = bounds[chrom]
+        chrom_pos = positions[lo:hi]
+        assert np.all(chrom_pos[1:] >= chrom_pos[:-1]), f"Variants on {chrom} must be sorted by position."
+        start_ix = lo + np.searchsorted(chrom_pos, g['start'].values - window, side='left')
+        end_ix = lo + np.searchsorted(chrom_pos, g['end'].values + window, side='right')
+        index.append(pd.DataFrame({'chr': chrom, 'start_ix': start_ix, 'end_ix': end_ix}, index=g.index))
+    index_df = pd.concat(index) if index else pd.DataFrame(columns=['chr', 'start_ix', 'end_ix'])
+    index_df = index_df[index_df['end_ix'] > index_df['start_ix']]
+    index_df.index.name = 'phenotype_id'
+    return index_df
+
+def load_cis_index(cache_path, variant_df, phenotype_pos_df, window):
+    """读取或计算并保存 cis 窗口下标（按基因型缓存、基因位置和窗口大小缓存，同一时期不同K共用）"""
+    key = hashlib.sha1(pd.util.hash_pandas_object(phenotype_pos_df).values.tobytes()
+                       + str(window).encode()).hexdigest()[:16]
+    index_file = os.path.join(cache_path, f"cis_index_{key}.tsv")
+    if os.path.exists(index_file):
+        return pd.read_csv(index_file, sep='\t', index_col=0, dtype={'chr': str})
+    index_df = build_cis_index(variant_df, phenotype_pos_df, window)
+    tmp_file = f"{index_file}.tmp{os.getpid()}"
+    index_df.to_csv(tmp_file, sep='\t')
+    os.replace(tmp_file, index_file)
+    print(f"cis window index saved to: {index_file}")
+    return index_df
+
+def _map_cis_shard(args):
+    """在子进程中运行一个分片：只内存映射 [lo, hi) 区间的基因型"""
+    cache_path, lo, hi, phenotype_df, phenotype_pos_df, covariates_df, adaptive, kwargs = args
+    dosages, variant_df, samples = genotype_cache.open_cache(cache_path)
+    sample_ix = genotype_cache.sample_indexer(samples, phenotype_df.columns)
+    genotype_df = pd.DataFrame(np.take(dosages[lo:hi], sample_ix, axis=1),
+                               index=variant_df.index[lo:hi], columns=phenotype_df.columns)
+    map_fn = map_cis_adaptive if adaptive else cis.map_cis
+    return map_fn(genotype_df, variant_df.iloc[lo:hi], phenotype_df, phenotype_pos_df, covariates_df,
+                  verbose=False, **kwargs)
+
+def make_cis_shards(index_df):
+    """按染色体划分分片，返回 [(分片名, 基因ID列表, lo, hi)]"""
+    shards = []
+    for chrom, g in index_df.groupby('chr', sort=False):
+        shards.append((chrom, g.index, int(g['start_ix'].min()), int(g['end_ix'].max())))
+    return shards
+
+def make_balanced_shards(index_df, n_chunks):
+    """按 cis 变异数（而不是基因数）把基因均衡划分为 n_chunks 个分块，每块在基因组上连续"""
+    order = np.argsort(index_df['start_ix'].values, kind='stable')
+    n_cis = (index_df['end_ix'].values - index_df['start_ix'].values)[order]
+    cum = np.cumsum(n_cis)
+    cuts = np.searchsorted(cum, cum[-1] * np.arange(1, n_chunks) / n_chunks, side='right')
+    shards = []
+    for i, chunk in enumerate(np.split(order, cuts)):
+        if len(chunk) == 0:
+            continue
+        g = index_df.iloc[chunk]
+        shards.append((f"chunk{i}", g.index, int(g['start_ix'].min()), int(g['end_ix'].max())))
+    return shards
+
+def _init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+def map_cis_sharded(cache_path, phenotype_df, phenotype_pos_df, covariates_df=None, window=1000000,
+                    workers=1, adaptive=False, shards=None, n_chunks=None, **kwargs):
+    """
+    分片 cis-QTL 映射，结果与在全部基因型上运行 map_cis（或 map_cis_adaptive）相同。
+
+    参数:
+        cache_path (str): genotype_cache 的缓存目录。
+        workers (int): 并行进程数。
+        adaptive (bool): 是否使用自适应置换。
+        shards (list): 自定义分片 [(名称, 基因ID列表, lo, hi)]，默认按染色体分片。
+        n_chunks (int): 不为空时按 cis 变异数均衡划分为 n_chunks 个分块（代替按染色体分片）。
+        kwargs: 传给 map_cis 的其他参数（nperm, maf_threshold, seed 等）。
+    """
+    _, variant_df, samples = genotype_cache.open_cache(cache_path)
+    # 在分发分片之前检查表型样本都在基因型缓存中
+    genotype_cache.sample_indexer(samples, phenotype_df.columns)
+    index_df = load_cis_index(cache_path, variant_df, phenotype_pos_df, window)
+    if shards is None:
+        shards = make_balanced_shards(index_df, n_chunks) if n_chunks else make_cis_shards(index_df)
+    print(f"cis-QTL mapping: {len(index_df)} phenotypes in {len(shards)} shards, {workers} worker(s)")
+
+    jobs = [(cache_path, lo, hi, phenotype_df.loc[ids], phenotype_pos_df.loc[ids], covariates_df,
+             adaptive, dict(kwargs, window=window)) for _, ids, lo, hi in shards]
+    start_time = time.time()
+    if workers > 1:
+        # 各进程平分CPU核，避免线程过量
+        n_threads = max(1, (os.cpu_count() or 1) // workers)
+        with mp.get_context('fork').Pool(workers, initializer=_init_worker, initargs=(n_threads,)) as pool:
+            results = pool.map(_map_cis_shard, jobs, chunksize=1)
+    else:
+        results = [_map_cis_shard(job) for job in jobs]
+    print(f"  Time elapsed: {(time.time() - start_time) / 60:.2f} min")
+
+    # 按原始基因顺序合并
+    cis_df = pd.concat([r for r in results if len(r)])
+    return cis_df.loc[[i for i in phenotype_df.index if i in cis_df.index]]
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+'''
+Benjamini-Hochberg FDR（q 值）计算
+
+bh_qvalues: 内存中计算，n_tests 为空时与 multipletests(pvals, method='fdr_bh') 相同。
+
+StreamingBH: 外存两遍计算，适用于放不进内存的 trans 结果。
+第一遍逐块接收 p 值，按 log10(p) 分箱（直方图）并把每箱的 p 值追加写入临时文件；
+汇总时各箱分别排序，由大到小计算 BH 的累积最小值；
+第二遍逐块查询 q 值（每箱只加载一次）。结果与对全部 p 值一次性计算相同。
+
+n_tests 可设为实际检验数（如 变异数 × 基因数）：未输出的检验 p 值都高于映射阈值，
+按 p = 1 计入分母（排在所有输出 p 值之后）。
+'''
+
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+def _bh_sorted(sorted_p, n_tests, rank_offset=0):
+    """已排序 p 值的 BH 原始值 p * n / rank（与 statsmodels 相同的计算方式）"""
+    ranks = np.arange(rank_offset + 1, rank_offset + len(sorted_p) + 1)
+    return sorted_p / (ranks / float(n_tests))
+
+def bh_qvalues(pvals, n_tests=None):
+    """计算 BH q 值，n_tests 默认为 p 值个数"""
+    pvals = np.asarray(pvals, dtype=np.float64)
+    n_tests = n_tests or len(pvals)
+    assert n_tests >= len(pvals), "n_tests must be at least the number of p-values"
+    order = np.argsort(pvals)
+    q_sorted = np.minimum.accumulate(_bh_sorted(pvals[order], n_tests)[::-1])[::-1]
+    q_sorted[q_sorted > 1] = 1
+    q = np.empty_like(q_sorted)
+    q[order] = q_sorted
+    return q
+
+class StreamingBH:
+    """
+    外存两遍 BH 校正：
+
+        bh = StreamingBH(n_tests=n_variants * n_genes)
+        for chunk in chunks: bh.add(chunk['pval'])
+        bh.finalize()
+        for chunk in chunks: chunk['qval'] = bh.qvalues(chunk['pval'])
+
+    参数:
+        n_tests (int): BH 分母，默认为接收到的 p 值个数。
+        n_bins (int): log10(p) 分箱数，箱越细每箱需要加载的 p 值越少。
+        min_pval (float): 最小的箱边界，更小的 p 值（含 0）都放入第一箱。
+        tmp_dir (str): 临时文件目录。
+    """
+
+    def __init__(self, n_tests=None, n_bins=4096, min_pval=1e-300, tmp_dir=None):
+        self.n_tests = n_tests
+        self.n_bins = n_bins
+        self.log_min = np.log10(min_pval)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.tmp_dir = tempfile.mkdtemp(prefix='bh_', dir=tmp_dir)
+        self.finalized = False
+        self._cache = {}
+
+    def _bin(self, pvals):
+        with np.errstate(divide='ignore'):
+            logp = np.log10(pvals)
+        b = np.floor((logp - self.log_min) / -self.log_min * self.n_bins)
+        return np.clip(np.nan_to_num(b, nan=0, neginf=0), 0, self.n_bins - 1).astype(np.int64)
+
+    def _path(self, b, kind):
+        return os.path.join(self.tmp_dir, f"{kind}_{b}.{'bin' if kind == 'spill' else 'npy'}")
+
+    def add(self, pvals):
+        """第一遍：把一块 p 值按箱追加写入临时文件"""
+        assert not self.finalized, "add() after finalize()"
+        pvals = np.asarray(pvals, dtype=np.float64)
+        bins = self._bin(pvals)
+        order = np.argsort(bins, kind='stable')
+        bins, pvals = bins[order], pvals[order]
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]]) if len(bins) else []
+        ends = np.r_[starts[1:], len(bins)] if len(bins) else []
+        for start, end in zip(starts, ends):
+            b = bins[start]
+            with open(self._path(b, 'spill'), 'ab') as f:
+                pvals[start:end].tofile(f)
+            self.counts[b] += end - start
+
+    def finalize(self):
+        """各箱排序并由大到小计算 BH 累积最小值"""
+        n_observed = int(self.counts.sum())
+        n_tests = self.n_tests or n_observed
+        assert n_tests >= n_observed, "n_tests must be at least the number of p-values"
+        rank_offsets = np.r_[0, np.cumsum(self.counts)[:-1]]
+        running_min = np.inf
+        for b in np.flatnonzero(self.counts)[::-1]:
+            p = np.sort(np.fromfile(self._path(b, 'spill'), dtype=np.float64))
+            os.remove(self._path(b, 'spill'))
+            q = np.minimum.accumulate(_bh_sorted(p, n_tests, rank_offsets[b])[::-1])[::-1]
+            q = np.minimum(q, running_min)
+            running_min = q[0]
+            q[q > 1] = 1
+            np.save(self._path(b, 'p'), p)
+            np.save(self._path(b, 'q'), q)
+        self.finalized = True
+
+    def qvalues(self, pvals):
+        """第二遍：查询一块 p 值（必须是 add 过的值）的 q 值"""
+        assert self.finalized, "call finalize() first"
+        pvals = np.asarray(pvals, dtype=np.float64)
+        bins = self._bin(pvals)
+        q = np.empty(len(pvals), dtype=np.float64)
+        for b in np.unique(bins):
+            if b not in self._cache:
+                # 只缓存最近使用的箱，控制内存
+                if len(self._cache) >= 16:
+                    self._cache.pop(next(iter(self._cache)))
+                self._cache[b] = (np.load(self._path(b, 'p'), mmap_mode='r'),
+                                  np.load(self._path(b, 'q'), mmap_mode='r'))
+            p_sorted, q_sorted = self._cache[b]
+            m = bins == b
+            # 相同 p 值取最大秩处的 q 值
+            q[m] = q_sorted[np.searchsorted(p_sorted, pvals[m], side='right') - 1]
+        return q
+
+    def close(self):
+        self._cache.clear()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def add_qvalues_to_file(in_file, out_file=None, n_tests=None, pval_col='pval', sep='\t',
+                        chunksize=1000000, fdr_threshold=None):
+    """
+    两遍读取结果文件，逐块写出带 qval 列的结果（保持输入顺序），内存与文件大小无关。
+    out_file 为空时覆盖 in_file；fdr_threshold 不为空时只写出 qval 小于阈值的行。
+    返回写出的行数。
+    """
+    out_file = out_file or in_file
+    tmp_file = f"{out_file}.tmp{os.getpid()}"
+    n_written = 0
+    with StreamingBH(n_tests=n_tests) as bh:
+        for chunk in pd.read_csv(in_file, sep=sep, usecols=[pval_col], chunksize=chunksize):
+            bh.add(chunk[pval_col].values)
+        bh.finalize()
+        header = True
+        for chunk in pd.read_csv(in_file, sep=sep, chunksize=chunksize):
+            chunk.insert(chunk.columns.get_loc(pval_col) + 1, 'qval', bh.qvalues(chunk[pval_col].values))
+            if fdr_threshold is not None:
+                chunk = chunk[chunk['qval'] < fdr_threshold]
+            chunk.to_csv(tmp_file, sep=sep, index=False, header=header, mode='w' if header else 'a')
+            header = False
+            n_written += len(chunk)
+        if header:
+            # 空输入：只写表头
+            pd.read_csv(in_file, sep=sep, nrows=0).assign(qval=[]).to_csv(tmp_file, sep=sep, index=False)
+    os.replace(tmp_file, out_file)
+    return n_written
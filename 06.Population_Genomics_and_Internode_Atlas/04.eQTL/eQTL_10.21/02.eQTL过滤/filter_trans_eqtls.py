@@ -8,6 +8,105 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 流式读取时的列类型
+COLUMN_DTYPES = {'phenotype_id': str, 'variant_id': str, 'pval': np.float64, 'qval': np.float64,
+                 'slope': np.float64, 'maf': np.float64}
+REQUIRED_COLS = ['phenotype_id', 'variant_id', 'pval', 'qval', 'slope']
+
+def basic_filter(df, qval_threshold, pval_threshold, effect_size_threshold, min_maf):
+    """q值、p值、效应大小和MAF过滤，返回过滤结果和每一步后的行数"""
+    counts = [len(df)]
+    mask = (df['qval'] < qval_threshold).to_numpy()
+    counts.append(int(mask.sum()))
+    mask = mask & (df['pval'] < pval_threshold).to_numpy()
+    counts.append(int(mask.sum()))
+    mask = mask & (df['slope'].abs() > effect_size_threshold).to_numpy()
+    counts.append(int(mask.sum()))
+    if 'maf' in df.columns:
+        mask = mask & (df['maf'] >= min_maf).to_numpy()
+        counts.append(int(mask.sum()))
+    return df[mask], counts
+
+def log_basic_filter(counts, qval_threshold, pval_threshold, effect_size_threshold, min_maf):
+    logger.info(f"Initial trans-eQTL count: {counts[0]}")
+    logger.info(f"After FDR filter (qval < {qval_threshold}): {counts[1]} / {counts[0]}")
+    logger.info(f"After p-value filter (pval < {pval_threshold}): {counts[2]} / {counts[1]}")
+    logger.info(f"After effect size filter (|slope| > {effect_size_threshold}): {counts[3]} / {counts[2]}")
+    if len(counts) > 4:
+        logger.info(f"After MAF filter (MAF >= {min_maf}): {counts[4]} / {counts[3]}")
+
+def top_snps_per_gene(df, snps_per_gene):
+    """每个基因保留p值最小的 snps_per_gene 个SNP（p值相同按输入顺序）"""
+    df = df.sort_values(['phenotype_id', 'pval'])
+    return df.groupby('phenotype_id').head(snps_per_gene)
+
+def remove_hotspots(df, gene_count_threshold):
+    """去除影响基因数 >= gene_count_threshold 的SNP（trans-eQTL热点，可能是技术假象）"""
+    # 计算每个SNP影响的基因数量
+    snp_gene_counts = df.groupby('variant_id')['phenotype_id'].nunique()
+    hotspot_snps = snp_gene_counts[snp_gene_counts >= gene_count_threshold].index
+    return df[~df['variant_id'].isin(hotspot_snps)]
+
+def save_filtered(filtered_df, columns, input, output):
+    """按p值排序保存过滤结果和简要统计；没有结果时输出只有表头的文件"""
+    if not filtered_df.empty:
+        # 添加效应大小绝对值列
+        filtered_df['abs_slope'] = filtered_df['slope'].abs()
+        
+        # 按p值排序
+        filtered_df = filtered_df.sort_values(['pval', 'abs_slope'], ascending=[True, False])
+        
+        # 计算基本统计
+        logger.info(f"Final trans-eQTL count: {len(filtered_df)}")
+        logger.info(f"Unique genes: {filtered_df['phenotype_id'].nunique()}")
+        logger.info(f"Unique SNPs: {filtered_df['variant_id'].nunique()}")
+        logger.info(f"Median |effect size|: {filtered_df['abs_slope'].median():.4f}")
+        logger.info(f"Min p-value: {filtered_df['pval'].min():.2e}")
+        
+        # 保存结果
+        filtered_df.to_csv(output, sep='\t', index=False)
+        logger.info(f"Filtered trans-eQTLs saved to: {output}")
+        
+        # 保存简要统计
+        stats_output = output.replace('.txt', '_stats.txt')
+        with open(stats_output, 'w') as f:
+            f.write(f"Trans-eQTL Filtering Statistics\n")
+            f.write(f"==============================\n")
+            f.write(f"Input file: {input}\n")
+            f.write(f"Output file: {output}\n")
+            f.write(f"Final associations: {len(filtered_df)}\n")
+            f.write(f"Unique genes: {filtered_df['phenotype_id'].nunique()}\n")
+            f.write(f"Unique SNPs: {filtered_df['variant_id'].nunique()}\n")
+            f.write(f"Median |effect size|: {filtered_df['abs_slope'].median():.4f}\n")
+            f.write(f"Min p-value: {filtered_df['pval'].min():.2e}\n")
+            f.write(f"Max p-value: {filtered_df['pval'].max():.2e}\n")
+        
+    else:
+        logger.warning("No trans-eQTLs passed filtering criteria")
+        # 创建空文件保持一致性
+        pd.DataFrame(columns=columns).to_csv(output, sep='\t', index=False)
+
+def read_filtered_chunks(input, chunksize, qval_threshold, pval_threshold, effect_size_threshold,
+                         min_maf, snps_per_gene):
+    """
+    分块读取并过滤，只保留每个基因当前的前 snps_per_gene 个SNP，
+    内存占用由 基因数 × snps_per_gene 决定，与输入大小无关。
+    返回 (每个基因前N个SNP, 累计过滤行数, 输入列名)。
+    """
+    columns = pd.read_csv(input, sep='\t', nrows=0).columns
+    dtypes = {col: dtype for col, dtype in COLUMN_DTYPES.items() if col in columns}
+    top_df, total_counts = None, None
+    for chunk in pd.read_csv(input, sep='\t', dtype=dtypes, chunksize=chunksize):
+        chunk, counts = basic_filter(chunk, qval_threshold, pval_threshold, effect_size_threshold, min_maf)
+        total_counts = counts if total_counts is None else [a + b for a, b in zip(total_counts, counts)]
+        # 已保留的行都在当前块之前，合并后稳定排序与整体排序的结果相同
+        top_df = chunk if top_df is None else pd.concat([top_df, chunk])
+        top_df = top_snps_per_gene(top_df, snps_per_gene)
+    if top_df is None:
+        top_df = pd.DataFrame(columns=columns)
+        total_counts = [0] * (5 if 'maf' in columns else 4)
+    return top_df, total_counts, columns
+
 @click.command()
 @click.option('--input', '-i', required=True, help='Input trans-eQTL file (TSV format)')
 @click.option('--output', '-o', required=True, help='Output file path')
@@ -19,8 +118,9 @@ logger = logging.getLogger(__name__)
 @click.option('--snps-per-gene', default=5, show_default=True, help='Maximum SNPs per gene to keep (top by p-value)')
 @click.option('--filter-hotspots', is_flag=True, help='Filter out trans-eQTL hotspots')
 @click.option('--filter-cis-acting', is_flag=True, help='Filter out cis-acting trans-eQTLs')
+@click.option('--chunksize', default=0, show_default=True, help='Stream the input in chunks of this many rows (0 = read whole file)')
 def filter_trans_eqtls(input, output, qval_threshold, pval_threshold, effect_size_threshold, 
-                      min_maf, gene_count_threshold, snps_per_gene, filter_hotspots, filter_cis_acting):
+                      min_maf, gene_count_threshold, snps_per_gene, filter_hotspots, filter_cis_acting, chunksize):
     """
     过滤 trans-eQTL 结果，减少假阳性并提高结果质量
     """
@@ -28,102 +128,48 @@ def filter_trans_eqtls(input, output, qval_threshold, pval_threshold, effect_siz
     logger.info(f"Loading trans-eQTL data from: {input}")
     
     try:
-        # 读取数据
-        df = pd.read_csv(input, sep='\t')
-        
         # 检查必要的列
-        required_cols = ['phenotype_id', 'variant_id', 'pval', 'qval', 'slope']
-        missing_cols = [col for col in required_cols if col not in df.columns]
+        columns = pd.read_csv(input, sep='\t', nrows=0).columns
+        missing_cols = [col for col in REQUIRED_COLS if col not in columns]
         if missing_cols:
             logger.error(f"Missing required columns: {missing_cols}")
             return
         
-        logger.info(f"Initial trans-eQTL count: {len(df)}")
-        
-        # 第一步：基本过滤
-        filtered_df = df.copy()
-        
-        # FDR 过滤
-        initial_count = len(filtered_df)
-        filtered_df = filtered_df[filtered_df['qval'] < qval_threshold]
-        logger.info(f"After FDR filter (qval < {qval_threshold}): {len(filtered_df)} / {initial_count}")
-        
-        # p-value 过滤
-        initial_count = len(filtered_df)
-        filtered_df = filtered_df[filtered_df['pval'] < pval_threshold]
-        logger.info(f"After p-value filter (pval < {pval_threshold}): {len(filtered_df)} / {initial_count}")
-        
-        # 效应大小过滤
-        initial_count = len(filtered_df)
-        filtered_df = filtered_df[filtered_df['slope'].abs() > effect_size_threshold]
-        logger.info(f"After effect size filter (|slope| > {effect_size_threshold}): {len(filtered_df)} / {initial_count}")
-        
-        # 第二步：MAF 过滤（如果有MAF列）
-        if 'maf' in df.columns:
+        if chunksize > 0:
+            # 流式模式：第一步到第三步在分块读取时完成
+            filtered_df, counts, columns = read_filtered_chunks(
+                input, chunksize, qval_threshold, pval_threshold, effect_size_threshold, min_maf, snps_per_gene
+            )
+            log_basic_filter(counts, qval_threshold, pval_threshold, effect_size_threshold, min_maf)
+            logger.info(f"After limiting to {snps_per_gene} SNPs per gene: {len(filtered_df)} / {counts[-1]}")
+        else:
+            # 读取数据
+            df = pd.read_csv(input, sep='\t')
+            
+            # 第一步和第二步：基本过滤和MAF过滤（如果有MAF列）
+            filtered_df, counts = basic_filter(df, qval_threshold, pval_threshold, effect_size_threshold, min_maf)
+            log_basic_filter(counts, qval_threshold, pval_threshold, effect_size_threshold, min_maf)
+            
+            # 第三步：限制每个基因的SNP数量
             initial_count = len(filtered_df)
-            filtered_df = filtered_df[filtered_df['maf'] >= min_maf]
-            logger.info(f"After MAF filter (MAF >= {min_maf}): {len(filtered_df)} / {initial_count}")
-        
-        # 第三步：限制每个基因的SNP数量
-        initial_count = len(filtered_df)
-        filtered_df = filtered_df.sort_values(['phenotype_id', 'pval'])
-        filtered_df = filtered_df.groupby('phenotype_id').head(snps_per_gene)
-        logger.info(f"After limiting to {snps_per_gene} SNPs per gene: {len(filtered_df)} / {initial_count}")
+            filtered_df = top_snps_per_gene(filtered_df, snps_per_gene)
+            logger.info(f"After limiting to {snps_per_gene} SNPs per gene: {len(filtered_df)} / {initial_count}")
         
         # 第四步：过滤 trans-eQTL 热点（可选）
         if filter_hotspots:
             initial_count = len(filtered_df)
-            # 计算每个SNP影响的基因数量
-            snp_gene_counts = filtered_df.groupby('variant_id')['phenotype_id'].nunique()
-            # 过滤掉影响过多基因的SNP（可能是技术假象）
-            hotspot_snps = snp_gene_counts[snp_gene_counts >= gene_count_threshold].index
-            filtered_df = filtered_df[~filtered_df['variant_id'].isin(hotspot_snps)]
+            filtered_df = remove_hotspots(filtered_df, gene_count_threshold)
             logger.info(f"After hotspot filter (SNPs affecting >={gene_count_threshold} genes): {len(filtered_df)} / {initial_count}")
         
         # 第五步：过滤 cis-acting trans-eQTL（可选）
-        if filter_cis_acting and 'phenotype_chr' in df.columns and 'variant_chr' in df.columns:
+        if filter_cis_acting and 'phenotype_chr' in columns and 'variant_chr' in columns:
             initial_count = len(filtered_df)
             # 识别染色体相同的关联（可能是cis泄漏）
             filtered_df = filtered_df[filtered_df['phenotype_chr'] != filtered_df['variant_chr']]
             logger.info(f"After removing cis-acting trans-eQTLs: {len(filtered_df)} / {initial_count}")
         
-        # 第六步：计算统计量并排序
-        if not filtered_df.empty:
-            # 添加效应大小绝对值列
-            filtered_df['abs_slope'] = filtered_df['slope'].abs()
-            
-            # 按p值排序
-            filtered_df = filtered_df.sort_values(['pval', 'abs_slope'], ascending=[True, False])
-            
-            # 计算基本统计
-            logger.info(f"Final trans-eQTL count: {len(filtered_df)}")
-            logger.info(f"Unique genes: {filtered_df['phenotype_id'].nunique()}")
-            logger.info(f"Unique SNPs: {filtered_df['variant_id'].nunique()}")
-            logger.info(f"Median |effect size|: {filtered_df['abs_slope'].median():.4f}")
-            logger.info(f"Min p-value: {filtered_df['pval'].min():.2e}")
-            
-            # 保存结果
-            filtered_df.to_csv(output, sep='\t', index=False)
-            logger.info(f"Filtered trans-eQTLs saved to: {output}")
-            
-            # 保存简要统计
-            stats_output = output.replace('.txt', '_stats.txt')
-            with open(stats_output, 'w') as f:
-                f.write(f"Trans-eQTL Filtering Statistics\n")
-                f.write(f"==============================\n")
-                f.write(f"Input file: {input}\n")
-                f.write(f"Output file: {output}\n")
-                f.write(f"Final associations: {len(filtered_df)}\n")
-                f.write(f"Unique genes: {filtered_df['phenotype_id'].nunique()}\n")
-                f.write(f"Unique SNPs: {filtered_df['variant_id'].nunique()}\n")
-                f.write(f"Median |effect size|: {filtered_df['abs_slope'].median():.4f}\n")
-                f.write(f"Min p-value: {filtered_df['pval'].min():.2e}\n")
-                f.write(f"Max p-value: {filtered_df['pval'].max():.2e}\n")
-            
-        else:
-            logger.warning("No trans-eQTLs passed filtering criteria")
-            # 创建空文件保持一致性
-            pd.DataFrame(columns=df.columns).to_csv(output, sep='\t', index=False)
+        # 第六步：计算统计量、排序并保存
+        save_filtered(filtered_df, columns, input, output)
             
     except Exception as e:
         logger.error(f"Error processing trans-eQTL file: {e}")
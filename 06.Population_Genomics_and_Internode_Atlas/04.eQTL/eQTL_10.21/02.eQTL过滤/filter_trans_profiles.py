@@ -0,0 +1,148 @@
+import click
+import pandas as pd
+import numpy as np
+import logging
+from filter_trans_eqtls import REQUIRED_COLS, top_snps_per_gene, remove_hotspots, save_filtered
+from filter_true_trans_eqtls import load_gene_positions, annotate_positions, save_true_trans
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# 阈值档案中可用的参数及类型
+PROFILE_KEYS = {'qval': float, 'pval': float, 'slope': float, 'maf': float, 'distance': int,
+                'hotspot': int, 'snps_per_gene': int, 'cis_acting': int}
+# 不带 distance 的档案与 filter_trans_eqtls.py 的默认值一致，带 distance 的与 filter_true_trans_eqtls.py 一致
+STRICT_DEFAULTS = {'qval': 0.05, 'pval': 1e-8, 'slope': 0.1, 'maf': 0.05, 'snps_per_gene': 5}
+TRUE_TRANS_DEFAULTS = {'qval': 0.05, 'pval': 1e-8, 'slope': 0.1, 'snps_per_gene': 5}
+
+def parse_profile(text):
+    """解析 'name:key=value,...' 格式的阈值档案"""
+    name, _, spec = text.partition(':')
+    values = {}
+    for item in filter(None, spec.split(',')):
+        key, _, value = item.partition('=')
+        key = key.strip().replace('-', '_')
+        if key not in PROFILE_KEYS:
+            raise click.BadParameter(f"Unknown key '{key}' in profile '{name}'", param_hint='--profile')
+        cast = PROFILE_KEYS[key]
+        values[key] = cast(float(value)) if cast is int else cast(value)
+    defaults = TRUE_TRANS_DEFAULTS if 'distance' in values else STRICT_DEFAULTS
+    return name.strip(), {**defaults, **values}
+
+def profile_mask(df, profile):
+    """档案的 q值、p值、效应大小和MAF过滤"""
+    mask = (df['qval'] < profile['qval']).to_numpy()
+    mask = mask & (df['pval'] < profile['pval']).to_numpy()
+    mask = mask & (df['slope'].abs() > profile['slope']).to_numpy()
+    if 'maf' in profile and 'maf' in df.columns:
+        mask = mask & (df['maf'] >= profile['maf']).to_numpy()
+    return mask
+
+def write_empty_stats(output, input, true_trans):
+    """没有关联通过档案时写出计数为0的统计文件（格式同 save_filtered / save_true_trans）"""
+    with open(output.replace('.txt', '_stats.txt'), 'w') as f:
+        if true_trans:
+            f.write("True Trans-eQTL Statistics\n")
+            f.write("==========================\n")
+            f.write("Total true trans-eQTLs: 0\n")
+            f.write("Different chromosome: 0\n")
+            f.write("Same chromosome >5Mb: 0\n")
+            f.write("Unique genes: 0\n")
+            f.write("Unique SNPs: 0\n")
+            f.write("Median distance (same chrom): NA\n")
+        else:
+            f.write("Trans-eQTL Filtering Statistics\n")
+            f.write("==============================\n")
+            f.write(f"Input file: {input}\n")
+            f.write(f"Output file: {output}\n")
+            f.write("Final associations: 0\n")
+            f.write("Unique genes: 0\n")
+            f.write("Unique SNPs: 0\n")
+            f.write("Median |effect size|: NA\n")
+            f.write("Min p-value: NA\n")
+            f.write("Max p-value: NA\n")
+
+def write_empty_profiles(output_prefix, profiles, columns, input):
+    """输入没有任何关联时，为每个档案写出只有表头的结果文件和计数为0的统计文件"""
+    for name, profile in profiles:
+        output = f"{output_prefix}_{name}.txt"
+        pd.DataFrame(columns=columns).to_csv(output, sep='\t', index=False)
+        write_empty_stats(output, input, true_trans='distance' in profile)
+        logger.info(f"Profile {name}: 0 trans-eQTLs -> {output}")
+
+@click.command()
+@click.option('--input', '-i', required=True, help='Input trans-eQTL file (TSV format)')
+@click.option('--output-prefix', '-o', required=True, help='Output prefix; writes <prefix>_<profile>.txt and <prefix>_<profile>_stats.txt')
+@click.option('--gene-bed', '-g', default=None, help='Gene BED file with positions (required for profiles with distance)')
+@click.option('--profile', '-p', 'profiles', multiple=True, required=True,
+              help="Threshold profile 'name:key=value,...' with keys qval, pval, slope, maf, distance, "
+                   "hotspot, snps_per_gene, cis_acting (can be given multiple times)")
+def filter_trans_profiles(input, output_prefix, gene_bed, profiles):
+    """
+    一次读取 trans-eQTL 结果，按多组阈值档案分别过滤并输出。
+
+    不带 distance 的档案按 filter_trans_eqtls.py 的流程过滤（hotspot=N 相当于
+    --filter-hotspots --gene-count-threshold N）；带 distance 的档案按
+    filter_true_trans_eqtls.py 的流程只保留真正的 trans-eQTL。
+    """
+    profiles = [parse_profile(p) for p in profiles]
+    if any('distance' in p for _, p in profiles) and gene_bed is None:
+        raise click.BadParameter("--gene-bed is required for profiles with distance", param_hint='--gene-bed')
+
+    logger.info(f"Loading trans-eQTL data from: {input}")
+    try:
+        df = pd.read_csv(input, sep='\t')
+    except pd.errors.EmptyDataError:
+        df = pd.DataFrame()
+    missing_cols = [col for col in REQUIRED_COLS if col not in df.columns]
+    if df.empty:
+        # qtl_analysis.py 没有显著关联时写出的是无表头的占位文件
+        logger.warning("Input file is empty")
+        write_empty_profiles(output_prefix, profiles, [] if missing_cols else df.columns, input)
+        return
+    if missing_cols:
+        logger.error(f"Missing required columns: {missing_cols}")
+        return
+    logger.info(f"Initial trans-eQTL count: {len(df)}")
+
+    # 各档案的基本过滤只是比较运算，只保留至少通过一个档案的行
+    masks = [profile_mask(df, p) for _, p in profiles]
+    union = np.logical_or.reduce(masks)
+    base_df = df[union]
+    masks = [m[union] for m in masks]
+    logger.info(f"Passing at least one profile's basic filters: {len(base_df)}")
+
+    # 基因/变异位置只计算一次
+    if gene_bed is not None:
+        gene_pos_df = load_gene_positions(gene_bed)
+        annotated_df = annotate_positions(base_df, gene_pos_df)
+        annotated_ix = base_df.index.get_indexer(annotated_df.index)
+
+    for (name, profile), mask in zip(profiles, masks):
+        output = f"{output_prefix}_{name}.txt"
+        snps_per_gene = profile['snps_per_gene']
+        if 'distance' in profile:
+            filtered_df = annotated_df[mask[annotated_ix]]
+            filtered_df = filtered_df[filtered_df['distance'] > profile['distance']]
+            filtered_df = top_snps_per_gene(filtered_df, snps_per_gene)
+            if 'hotspot' in profile:
+                filtered_df = remove_hotspots(filtered_df, profile['hotspot'])
+            if filtered_df.empty:
+                # 没有结果时输出只有输入表头的文件
+                pd.DataFrame(columns=df.columns).to_csv(output, sep='\t', index=False)
+                write_empty_stats(output, input, true_trans=True)
+            else:
+                save_true_trans(filtered_df, output)
+        else:
+            filtered_df = top_snps_per_gene(base_df[mask], snps_per_gene)
+            if 'hotspot' in profile:
+                filtered_df = remove_hotspots(filtered_df, profile['hotspot'])
+            if profile.get('cis_acting') and 'phenotype_chr' in df.columns and 'variant_chr' in df.columns:
+                filtered_df = filtered_df[filtered_df['phenotype_chr'] != filtered_df['variant_chr']]
+            save_filtered(filtered_df, df.columns, input, output)
+            if filtered_df.empty:
+                write_empty_stats(output, input, true_trans=False)
+        logger.info(f"Profile {name}: {len(filtered_df)} trans-eQTLs -> {output}")
+
+if __name__ == '__main__':
+    filter_trans_profiles()
@@ -25,11 +25,80 @@ def parse_variant_id(variant_id):
     except:
         return None, None
 
-def parse_gene_id(gene_id, gene_pos_dict):
-    """从基因ID获取基因位置"""
-    if gene_id in gene_pos_dict:
-        return gene_pos_dict[gene_id]
-    return None, None
+def parse_variant_ids(variant_ids):
+    """
+    向量化解析变异ID（规则同 parse_variant_id），返回 (chrom, pos, 是否解析成功)。
+    """
+    ids = pd.Series(variant_ids).reset_index(drop=True)
+    # "chr1_100500_A_G"：取前两段；"chr1:100500"：不含下划线且只有一个冒号
+    parts = ids.str.extract(r'^([^_]*)_([^_]*)')
+    colon = ids.str.extract(r'^([^:_]*):([^:_]*)$')
+    parts = parts.fillna(colon)
+    valid = parts[1].str.fullmatch(r'\s*[+-]?[0-9]+\s*').eq(True).values
+    chrom = parts[0].str.replace('chr', '', regex=False).values
+    pos = np.zeros(len(ids), dtype=np.int64)
+    pos[valid] = parts[1].values[valid].astype(str).astype(np.int64)
+    return chrom, pos, valid
+
+def load_gene_positions(gene_bed):
+    """读取基因BED，返回以基因ID为索引的 (chrom, pos) 表，位置为区间中点"""
+    gene_pos_df = pd.read_csv(gene_bed, sep='\t', header=None, 
+                             names=['chrom', 'start', 'end', 'gene_id'])
+    gene_pos_df = gene_pos_df.drop_duplicates('gene_id', keep='last').set_index('gene_id')
+    return pd.DataFrame({
+        'chrom': gene_pos_df['chrom'].str.replace('chr', '', regex=False),
+        'pos': (gene_pos_df['start'] + gene_pos_df['end']) // 2,  # 使用TSS
+    })
+
+def annotate_positions(df, gene_pos_df):
+    """
+    为每个关联添加基因/变异位置、距离和 trans 类型（不同染色体的距离为 inf），
+    去掉基因位置未知或变异ID无法解析的关联。
+    """
+    gene_ix = gene_pos_df.index.get_indexer(df['phenotype_id'])
+    var_chrom, var_pos, var_valid = parse_variant_ids(df['variant_id'])
+    keep = (gene_ix >= 0) & var_valid
+    gene_ix, var_chrom, var_pos = gene_ix[keep], var_chrom[keep], var_pos[keep]
+    gene_chrom = gene_pos_df['chrom'].values[gene_ix]
+    gene_pos = gene_pos_df['pos'].values[gene_ix]
+    
+    same_chrom = gene_chrom == var_chrom
+    abs_distance = np.abs(gene_pos - var_pos)
+    annotated_df = df[keep].copy()
+    annotated_df['gene_chrom'] = gene_chrom
+    annotated_df['gene_pos'] = gene_pos
+    annotated_df['var_chrom'] = var_chrom
+    annotated_df['var_pos'] = var_pos
+    annotated_df['distance'] = np.where(same_chrom, abs_distance, np.inf)
+    annotated_df['trans_type'] = np.where(
+        same_chrom, 'same_chrom_' + abs_distance.astype(str).astype(object) + 'bp', 'different_chrom'
+    )
+    return annotated_df
+
+def classify_trans(filtered_df, gene_pos_df, distance_threshold):
+    """
+    只保留真正的 trans-eQTL：不同染色体，或同一染色体但距离大于 distance_threshold。
+    """
+    annotated_df = annotate_positions(filtered_df, gene_pos_df)
+    return annotated_df[annotated_df['distance'] > distance_threshold]
+
+def save_true_trans(true_trans_df, output):
+    """按p值排序保存真正的 trans-eQTL 及统计信息"""
+    true_trans_df = true_trans_df.sort_values(['pval', 'distance'], ascending=[True, False])
+    true_trans_df.to_csv(output, sep='\t', index=False)
+    logger.info(f"True trans-eQTLs saved to: {output}")
+    
+    # 保存统计信息
+    stats_file = output.replace('.txt', '_stats.txt')
+    with open(stats_file, 'w') as f:
+        f.write("True Trans-eQTL Statistics\n")
+        f.write("==========================\n")
+        f.write(f"Total true trans-eQTLs: {len(true_trans_df)}\n")
+        f.write(f"Different chromosome: {len(true_trans_df[true_trans_df['trans_type'] == 'different_chrom'])}\n")
+        f.write(f"Same chromosome >5Mb: {len(true_trans_df[true_trans_df['trans_type'].str.startswith('same_chrom')])}\n")
+        f.write(f"Unique genes: {true_trans_df['phenotype_id'].nunique()}\n")
+        f.write(f"Unique SNPs: {true_trans_df['variant_id'].nunique()}\n")
+        f.write(f"Median distance (same chrom): {true_trans_df[true_trans_df['distance'] < float('inf')]['distance'].median():,.0f} bp\n")
 
 @click.command()
 @click.option('--input', '-i', required=True, help='Input trans-eQTL file')
@@ -52,14 +121,9 @@ def filter_true_trans_eqtls(input, output, gene_bed, distance_threshold,
     
     logger.info("Loading gene position data...")
     # 加载基因位置信息
-    gene_pos_df = pd.read_csv(gene_bed, sep='\t', header=None, 
-                             names=['chrom', 'start', 'end', 'gene_id'])
-    gene_pos_dict = {}
-    for _, row in gene_pos_df.iterrows():
-        gene_pos_dict[row['gene_id']] = (row['chrom'].replace('chr', ''), 
-                                        (row['start'] + row['end']) // 2)  # 使用TSS
+    gene_pos_df = load_gene_positions(gene_bed)
     
-    logger.info(f"Loaded {len(gene_pos_dict)} gene positions")
+    logger.info(f"Loaded {len(gene_pos_df)} gene positions")
     
     # 加载 trans-eQTL 结果
     logger.info(f"Loading trans-eQTL data from: {input}")
@@ -95,50 +159,9 @@ def filter_true_trans_eqtls(input, output, gene_bed, distance_threshold,
     # 第二步：识别真正的 trans-eQTL
     logger.info("Identifying true trans-eQTLs...")
     
-    true_trans_eqtls = []
-    
-    for _, row in filtered_df.iterrows():
-        gene_id = row['phenotype_id']
-        variant_id = row['variant_id']
-        
-        # 获取基因位置
-        gene_chrom, gene_pos = parse_gene_id(gene_id, gene_pos_dict)
-        if gene_chrom is None:
-            continue
-        
-        # 获取变异位置
-        var_chrom, var_pos = parse_variant_id(variant_id)
-        if var_chrom is None:
-            continue
-        
-        # 判断是否为真正的 trans-eQTL
-        is_true_trans = False
-        trans_type = "unknown"
-        
-        if gene_chrom != var_chrom:
-            # 不同染色体 - 肯定是 trans
-            is_true_trans = True
-            trans_type = "different_chrom"
-        else:
-            # 同一染色体，检查距离
-            distance = abs(gene_pos - var_pos)
-            if distance > distance_threshold:
-                is_true_trans = True
-                trans_type = f"same_chrom_{distance}bp"
-        
-        if is_true_trans:
-            new_row = row.copy()
-            new_row['gene_chrom'] = gene_chrom
-            new_row['gene_pos'] = gene_pos
-            new_row['var_chrom'] = var_chrom
-            new_row['var_pos'] = var_pos
-            new_row['distance'] = abs(gene_pos - var_pos) if gene_chrom == var_chrom else float('inf')
-            new_row['trans_type'] = trans_type
-            true_trans_eqtls.append(new_row)
+    true_trans_df = classify_trans(filtered_df, gene_pos_df, distance_threshold)
     
-    # 转换为DataFrame
-    if true_trans_eqtls:
-        true_trans_df = pd.DataFrame(true_trans_eqtls)
+    if not true_trans_df.empty:
         logger.info(f"True trans-eQTLs identified: {len(true_trans_df)}")
         
         # 按染色体对类型分类
@@ -153,21 +176,7 @@ def filter_true_trans_eqtls(input, output, gene_bed, distance_threshold,
         logger.info(f"After limiting to {snps_per_gene} SNPs per gene: {len(true_trans_df)}")
         
         # 排序并保存
-        true_trans_df = true_trans_df.sort_values(['pval', 'distance'], ascending=[True, False])
-        true_trans_df.to_csv(output, sep='\t', index=False)
-        logger.info(f"True trans-eQTLs saved to: {output}")
-        
-        # 保存统计信息
-        stats_file = output.replace('.txt', '_stats.txt')
-        with open(stats_file, 'w') as f:
-            f.write("True Trans-eQTL Statistics\n")
-            f.write("==========================\n")
-            f.write(f"Total true trans-eQTLs: {len(true_trans_df)}\n")
-            f.write(f"Different chromosome: {len(true_trans_df[true_trans_df['trans_type'] == 'different_chrom'])}\n")
-            f.write(f"Same chromosome >5Mb: {len(true_trans_df[true_trans_df['trans_type'].str.startswith('same_chrom')])}\n")
-            f.write(f"Unique genes: {true_trans_df['phenotype_id'].nunique()}\n")
-            f.write(f"Unique SNPs: {true_trans_df['variant_id'].nunique()}\n")
-            f.write(f"Median distance (same chrom): {true_trans_df[true_trans_df['distance'] < float('inf')]['distance'].median():,.0f} bp\n")
+        save_true_trans(true_trans_df, output)
         
     else:
         logger.warning("No true trans-eQTLs found")
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+'''
+PLINK 基因型内存映射缓存
+
+第一次使用时把 PLINK .bed 解码为 int8 剂量矩阵（行为变异，列为样本，缺失为 -9，
+与 tensorqtl 的 int8 编码一致）保存为 .npy，并附带变异/样本索引文件；
+之后每次运行直接内存映射打开，各时期的样本通过索引数组选取，不再重复解码。
+缓存按 .bed/.bim/.fam 全文哈希区分，PLINK 文件重新生成后会自动建立新的缓存。
+'''
+
+import os
+import shutil
+import hashlib
+import click
+import numpy as np
+import pandas as pd
+
+# 计算指纹时每次读取的字节数
+FINGERPRINT_BLOCK = 1 << 20
+# 缓存目录中记录 文件状态 -> 内容指纹 的索引文件
+FINGERPRINT_INDEX = 'fingerprints.tsv'
+PLINK_EXTS = ('.bed', '.bim', '.fam')
+
+def plink_stat_key(plink_prefix):
+    """.bed/.bim/.fam 的大小、修改时间（ns）和 inode；文件被重新生成后必然改变。"""
+    parts = []
+    for ext in PLINK_EXTS:
+        st = os.stat(plink_prefix + ext)
+        parts.append(f"{st.st_size}:{st.st_mtime_ns}:{st.st_ino}")
+    return ','.join([os.path.abspath(plink_prefix)] + parts)
+
+def plink_content_hash(plink_prefix):
+    """.bed/.bim/.fam 全文的 SHA1（取前16位）。"""
+    h = hashlib.sha1()
+    for ext in PLINK_EXTS:
+        with open(plink_prefix + ext, 'rb') as f:
+            for block in iter(lambda: f.read(FINGERPRINT_BLOCK), b''):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+def plink_fingerprint(plink_prefix, cache_dir=None, verify=False):
+    """
+    缓存键为 PLINK 三个文件全文的哈希。全文哈希只在文件状态（大小/修改时间/inode）
+    未记录过或 verify=True 时计算一次，记录在缓存目录的索引中，之后的任务按文件状态直接查到。
+    """
+    cache_dir = cache_dir or default_cache_dir(plink_prefix)
+    index_file = os.path.join(cache_dir, FINGERPRINT_INDEX)
+    stat_key = plink_stat_key(plink_prefix)
+    index = {}
+    if os.path.exists(index_file):
+        index = dict(pd.read_csv(index_file, sep='\t', dtype=str).itertuples(index=False, name=None))
+        if not verify and stat_key in index:
+            return index[stat_key]
+
+    fingerprint = plink_content_hash(plink_prefix)
+    index[stat_key] = fingerprint
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_file = f"{index_file}.tmp{os.getpid()}"
+    pd.DataFrame(list(index.items()), columns=['stat_key', 'fingerprint']).to_csv(tmp_file, sep='\t', index=False)
+    os.replace(tmp_file, index_file)
+    return fingerprint
+
+def default_cache_dir(plink_prefix):
+    return f"{plink_prefix}.gtcache"
+
+def build_cache(plink_prefix, cache_dir=None, chunk_size=50000, verify=False):
+    """解码 PLINK 文件并写入缓存目录，已存在则直接返回缓存路径；verify=True 时重新计算全文哈希。"""
+    cache_dir = cache_dir or default_cache_dir(plink_prefix)
+    cache_path = os.path.join(cache_dir, plink_fingerprint(plink_prefix, cache_dir=cache_dir, verify=verify))
+    if os.path.exists(os.path.join(cache_path, 'dosages.npy')):
+        return cache_path
+
+    from tensorqtl import genotypeio
+
+    print(f"Building genotype cache from: {plink_prefix}")
+    pr = genotypeio.PlinkReader(plink_prefix)
+    n_variants, n_samples = pr.bed.shape
+
+    # 先写到临时目录，完成后再改名，避免并发任务读到不完整的缓存
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    dosages = np.lib.format.open_memmap(os.path.join(tmp_path, 'dosages.npy'), mode='w+',
+                                        dtype=np.int8, shape=(n_variants, n_samples))
+    for start in range(0, n_variants, chunk_size):
+        end = min(start + chunk_size, n_variants)
+        dosages[start:end] = np.asarray(pr.bed[start:end].compute(), dtype=np.int8)
+    dosages.flush()
+    del dosages
+
+    pr.bim[['snp', 'chrom', 'pos']].to_csv(os.path.join(tmp_path, 'variants.tsv'), sep='\t', index=False)
+    pr.fam[['iid']].to_csv(os.path.join(tmp_path, 'samples.tsv'), sep='\t', index=False)
+
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # 其他进程已经先建好了缓存
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    print(f"Genotype cache saved to: {cache_path} ({n_variants} variants x {n_samples} samples)")
+    return cache_path
+
+def open_cache(cache_path):
+    """内存映射打开缓存，返回 (dosages, variant_df, samples)。"""
+    dosages = np.load(os.path.join(cache_path, 'dosages.npy'), mmap_mode='r')
+    variant_df = pd.read_csv(os.path.join(cache_path, 'variants.tsv'), sep='\t',
+                             dtype={'snp': str, 'chrom': str, 'pos': np.int64}).set_index('snp')
+    samples = pd.read_csv(os.path.join(cache_path, 'samples.tsv'), sep='\t', dtype=str)['iid']
+    return dosages, variant_df, pd.Index(samples)
+
+def sample_indexer(samples, select_samples):
+    """select_samples 在缓存样本中的列号；有样本不在基因型数据中时报错，而不是得到 -1（取到最后一个样本）"""
+    idx = samples.get_indexer(select_samples)
+    if (idx < 0).any():
+        missing = list(pd.Index(select_samples)[idx < 0][:5])
+        raise ValueError(f"Samples not found in genotype data: {missing}")
+    return idx
+
+def load_genotypes(plink_prefix, select_samples=None, cache_dir=None):
+    """
+    从缓存加载基因型，返回与 PlinkReader 相同的 (genotype_df, variant_df)。
+    select_samples 不为空时按给定顺序选取样本；选取全部样本且顺序一致时不复制数据。
+    """
+    cache_path = build_cache(plink_prefix, cache_dir=cache_dir)
+    dosages, variant_df, samples = open_cache(cache_path)
+    if select_samples is None or samples.equals(pd.Index(select_samples)):
+        values, columns = dosages, samples
+    else:
+        idx = sample_indexer(samples, select_samples)
+        values, columns = np.take(dosages, idx, axis=1), pd.Index(select_samples)
+    genotype_df = pd.DataFrame(values, index=variant_df.index, columns=columns, copy=False)
+    return genotype_df, variant_df
+
+@click.command()
+@click.option('--plink_prefix', required=True, help="PLINK file prefix (.bed/.bim/.fam).")
+@click.option('--cache_dir', default=None, help="Cache directory (default: <plink_prefix>.gtcache).")
+def main(plink_prefix, cache_dir):
+    """预先构建基因型缓存（重新计算 PLINK 文件全文哈希），之后的 QTL 分析直接内存映射读取。"""
+    build_cache(plink_prefix, cache_dir=cache_dir, verify=True)
+
+if __name__ == "__main__":
+    main()
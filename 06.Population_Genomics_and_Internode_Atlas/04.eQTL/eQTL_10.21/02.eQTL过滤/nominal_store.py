@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+nominal cis-eQTL 结果索引存储
+
+把 tensorqtl.cis.map_nominal 输出的 {prefix}.cis_qtl_pairs.{chr}.parquet 整理为按
+(基因, 变异位置) 排序的单个 parquet 文件（带行组统计），并附带两个小索引文件：
+    genes.tsv       每个基因所在的行组区间
+    row_groups.tsv  每个行组的染色体和位置范围
+查询时只读取需要的行组。存储目录结构为 <store_root>/<数据集>/，数据集名沿用
+QTL_mapping.py 的输出前缀（如 1_n_5，即 {stage}_{mode}_{factor}）。
+'''
+
+import os
+import glob
+import re
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+ROW_GROUP_SIZE = 50000
+PAIRS_FILE = 'pairs.parquet'
+GENES_FILE = 'genes.tsv'
+ROW_GROUPS_FILE = 'row_groups.tsv'
+
+def _chrom_sort_key(path):
+    """按染色体编号排序 map_nominal 的输出文件"""
+    chrom = path.rsplit('.cis_qtl_pairs.', 1)[1][:-len('.parquet')]
+    digits = re.findall(r'\d+', chrom)
+    return [int(d) for d in digits] + [chrom]
+
+def build_store(prefix, store_dir, variant_df, row_group_size=ROW_GROUP_SIZE):
+    """
+    将一个 map_nominal 前缀的所有染色体结果写入 store_dir。
+
+    参数:
+        prefix (str): map_nominal 的输出前缀（文件为 {prefix}.cis_qtl_pairs.{chr}.parquet）。
+        variant_df (DataFrame): 以 variant_id 为索引，包含 chrom 和 pos 列。
+        row_group_size (int): 每个行组的行数。
+    """
+    files = sorted(glob.glob(f"{prefix}.cis_qtl_pairs.*.parquet"), key=_chrom_sort_key)
+    if not files:
+        raise FileNotFoundError(f"No nominal results found for prefix: {prefix}")
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_file = os.path.join(store_dir, f"{PAIRS_FILE}.tmp{os.getpid()}")
+
+    writer, empty_schema = None, None
+    genes, row_groups = [], []
+    for path in files:
+        df = pd.read_parquet(path)
+        variant_ix = variant_df.index.get_indexer(df['variant_id'])
+        if (variant_ix < 0).any():
+            raise ValueError(f"{path}: variants not found in genotype data, e.g. {df['variant_id'].values[variant_ix < 0][0]}")
+        df.insert(2, 'chrom', variant_df['chrom'].values[variant_ix].astype(str))
+        df.insert(3, 'pos', variant_df['pos'].values[variant_ix].astype(np.int64))
+        if df.empty:
+            # 所有变异都未通过MAF过滤或窗口内没有基因的染色体，不占行组也不进入基因索引
+            empty_schema = empty_schema or pa.Table.from_pandas(df, preserve_index=False).schema
+            continue
+
+        # 基因保持 map_nominal 中的顺序（即BED中的基因组顺序），基因内按变异位置排序
+        gene_codes, gene_ids = pd.factorize(df['phenotype_id'])
+        order = np.lexsort((df['pos'].values, gene_codes))
+        df = df.iloc[order].reset_index(drop=True)
+        gene_codes = gene_codes[order]
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_file, table.schema, write_statistics=True)
+        # 行组不跨染色体，逐块写出以确定行组边界
+        for start in range(0, len(df), row_group_size):
+            end = min(start + row_group_size, len(df))
+            writer.write_table(table.slice(start, end - start), row_group_size=row_group_size)
+            pos = df['pos'].values[start:end]
+            row_groups.append((len(row_groups), df['chrom'].values[start], pos.min(), pos.max()))
+
+        # 每个基因的行范围 -> 行组范围
+        rg_offset = row_groups[-1][0] - (len(df) - 1) // row_group_size
+        bounds = np.flatnonzero(np.r_[True, gene_codes[1:] != gene_codes[:-1], True])
+        first, last = bounds[:-1], bounds[1:] - 1
+        genes.append(pd.DataFrame({
+            'phenotype_id': gene_ids[gene_codes[first]],
+            'chrom': df['chrom'].values[first],
+            'rg_first': rg_offset + first // row_group_size,
+            'rg_last': rg_offset + last // row_group_size,
+        }))
+    if writer is None:
+        # 全部结果为空时写出只有表结构的存储
+        writer = pq.ParquetWriter(tmp_file, empty_schema, write_statistics=True)
+    writer.close()
+    os.replace(tmp_file, os.path.join(store_dir, PAIRS_FILE))
+
+    genes = genes or [pd.DataFrame(columns=['phenotype_id', 'chrom', 'rg_first', 'rg_last'])]
+    pd.concat(genes).to_csv(os.path.join(store_dir, GENES_FILE), sep='\t', index=False)
+    pd.DataFrame(row_groups, columns=['row_group', 'chrom', 'pos_min', 'pos_max']).to_csv(
+        os.path.join(store_dir, ROW_GROUPS_FILE), sep='\t', index=False)
+    print(f"Nominal store saved to: {store_dir} ({len(row_groups)} row groups)")
+    return store_dir
+
+class NominalStore:
+    """
+    nominal 结果查询接口，可跨时期和PEER因子数查询：
+
+        store = NominalStore(store_root, variant_df=variant_df)
+        store.by_gene('gene1', stages=['1', '2'])
+        store.by_variant('chr1_12345', factors=['5'])
+        store.by_region('1', 100000, 200000)
+    """
+
+    def __init__(self, store_root, variant_df=None):
+        self.store_root = store_root
+        self.variant_df = variant_df
+        self.datasets = sorted(d for d in os.listdir(store_root)
+                               if os.path.exists(os.path.join(store_root, d, PAIRS_FILE)))
+        self._cache = {}
+
+    def _open(self, dataset):
+        """打开一个数据集（parquet 文件句柄和索引），结果缓存"""
+        if dataset not in self._cache:
+            path = os.path.join(self.store_root, dataset)
+            genes = pd.read_csv(os.path.join(path, GENES_FILE), sep='\t', dtype={'chrom': str},
+                                index_col='phenotype_id')
+            row_groups = pd.read_csv(os.path.join(path, ROW_GROUPS_FILE), sep='\t', dtype={'chrom': str})
+            self._cache[dataset] = (pq.ParquetFile(os.path.join(path, PAIRS_FILE)), genes, row_groups)
+        return self._cache[dataset]
+
+    def _select(self, stages, factors):
+        """按时期和因子数选择数据集（数据集名为 {stage}_{mode}_{factor}）"""
+        selected = []
+        for dataset in self.datasets:
+            parts = dataset.split('_')
+            if stages is not None and parts[0] not in map(str, stages):
+                continue
+            if factors is not None and parts[-1] not in map(str, factors):
+                continue
+            selected.append((dataset, parts[0], parts[-1]))
+        return selected
+
+    def _query(self, stages, factors, select_row_groups, mask):
+        results = []
+        for dataset, stage, factor in self._select(stages, factors):
+            pf, genes, row_groups = self._open(dataset)
+            rgs = select_row_groups(genes, row_groups)
+            if len(rgs) == 0:
+                continue
+            df = pf.read_row_groups(list(rgs)).to_pandas()
+            df = df[mask(df)]
+            df.insert(0, 'stage', stage)
+            df.insert(1, 'factor', factor)
+            results.append(df)
+        if not results:
+            return pd.DataFrame()
+        return pd.concat(results, ignore_index=True)
+
+    def by_gene(self, phenotype_id, stages=None, factors=None):
+        """查询一个基因的所有 cis 关联"""
+        def select_row_groups(genes, row_groups):
+            if phenotype_id not in genes.index:
+                return []
+            g = genes.loc[phenotype_id]
+            return range(int(g['rg_first']), int(g['rg_last']) + 1)
+        return self._query(stages, factors, select_row_groups, lambda df: df['phenotype_id'] == phenotype_id)
+
+    def by_region(self, chrom, start, end, stages=None, factors=None):
+        """查询 chrom:start-end（闭区间）内所有变异的关联"""
+        chrom = str(chrom)
+        def select_row_groups(genes, row_groups):
+            m = (row_groups['chrom'] == chrom) & (row_groups['pos_max'] >= start) & (row_groups['pos_min'] <= end)
+            return row_groups.loc[m, 'row_group'].values
+        return self._query(stages, factors, select_row_groups,
+                           lambda df: (df['chrom'] == chrom) & (df['pos'] >= start) & (df['pos'] <= end))
+
+    def by_variant(self, variant_id, stages=None, factors=None):
+        """查询一个变异与所有 cis 基因的关联（需要 variant_df 提供位置）"""
+        if self.variant_df is None:
+            raise ValueError("variant_df is required for variant queries")
+        chrom, pos = self.variant_df.loc[variant_id, ['chrom', 'pos']]
+        df = self.by_region(chrom, pos, pos, stages=stages, factors=factors)
+        return df[df['variant_id'] == variant_id].reset_index(drop=True)
+
+@click.command()
+@click.option('--nominal_prefix', required=True, multiple=True,
+              help="map_nominal output prefix, e.g. .../05.pair_eqtl/1_n_5 (can be given multiple times)")
+@click.option('--store_root', required=True, help="Root directory of the nominal store")
+@click.option('--plink_prefix', required=True, help="PLINK prefix used for mapping (variant positions from the genotype cache)")
+@click.option('--row_group_size', type=int, default=ROW_GROUP_SIZE, show_default=True, help="Rows per parquet row group")
+def main(nominal_prefix, store_root, plink_prefix, row_group_size):
+    """
+    将 map_nominal 结果整理为可按基因/变异/区间快速查询的存储。
+    """
+    import genotype_cache
+    _, variant_df, _ = genotype_cache.open_cache(genotype_cache.build_cache(plink_prefix))
+    for prefix in nominal_prefix:
+        build_store(prefix, os.path.join(store_root, os.path.basename(prefix)), variant_df,
+                    row_group_size=row_group_size)
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,13 @@ import torch
 import click
 import pandas as pd
 import tensorqtl
-from tensorqtl import genotypeio, cis, trans
-from statsmodels.stats.multitest import multipletests
+from tensorqtl import cis, trans
+import genotype_cache
+from trans_engine import map_trans_multi, map_trans_cpu, count_maf_variants
+from cis_engine import map_cis_adaptive, map_cis_sharded
+from trans_filter import TransFilterSink
+from filter_true_trans_eqtls import save_true_trans
+from fdr import bh_qvalues
 
 # 设置 CUDA
 os.environ['CUDA_VISIBLE_DEVICES'] = "0"
@@ -18,67 +23,96 @@ print(f'Using device: {device}')
 
 class Config:
     PLINK_PREFIX_PATH = "/data0/agis_xiazhongqiang/Project/04.eQTL/06.YZ.qtl_mapping/01.data/07.pre.all.data/GWAS"
+    GENOTYPE_CACHE_DIR = None  # 默认 <PLINK_PREFIX_PATH>.gtcache
     CIS_NPERM = 10000
+    CIS_ADAPTIVE = False  # 自适应置换：明显不显著的基因提前停止置换
+    CIS_PERM_ROUND = 1000
+    CIS_SHARD_WORKERS = 0  # >0 时按染色体分片并行运行cis映射
+    CIS_WORKERS = 1  # >1 时按cis变异数均衡分块，多进程运行cis映射
     CIS_WINDOW = 1000000
     MAF_THRESHOLD = 0.05
     FDR_THRESHOLD = 0.05
     TRANS_PVAL_THRESHOLD = 1e-5
+    TRANS_ENGINE = 'tensorqtl'  # tensorqtl 或 cpu（NumPy/BLAS 分块引擎）
+    TRANS_THREADS = None  # cpu 引擎线程数，默认全部核
+    TRANS_FDR_ALL_TESTS = False  # BH 分母使用实际检验数（MAF过滤后变异数 × 基因数），而非初筛输出的位点对数
+    # 映射过程中直接过滤（与 filter_true_trans_eqtls.py 的默认阈值一致）
+    TRANS_FILTER_PVAL = 1e-8
+    TRANS_FILTER_SLOPE = 0.1
+    TRANS_FILTER_MAF = 0.05
+    TRANS_FILTER_DISTANCE = 5000000
+    TRANS_SNPS_PER_GENE = 5
     SEED = 2022
 
-def load_data(expression_bed, covariates_file):
-    """加载所有必需数据"""
+def load_phenotypes(expression_bed, covariates_df):
+    """加载表达数据，并与协变量匹配共同样本（按表达数据中的样本顺序）"""
     phenotype_df, phenotype_pos_df = tensorqtl.read_phenotype_bed(expression_bed)
     print(f"Loaded expression data: {phenotype_df.shape[1]} samples, {phenotype_df.shape[0]} genes")
     
-    # 加载协变量
-    covariates_df = pd.read_csv(covariates_file, sep='\t', index_col=0)
-    common_samples = list(set(phenotype_df.columns) & set(covariates_df.index))
+    common_samples = [s for s in phenotype_df.columns if s in covariates_df.index]
     covariates_df = covariates_df.loc[common_samples]
     phenotype_df = phenotype_df[common_samples]
     print(f"Loaded covariates: {covariates_df.shape[1]} covariates for {len(common_samples)} samples")
+    return phenotype_df, phenotype_pos_df, covariates_df
+
+def load_data(expression_bed, covariates_file):
+    """加载所有必需数据"""
+    # 加载表达数据和协变量
+    covariates_df = pd.read_csv(covariates_file, sep='\t', index_col=0)
+    phenotype_df, phenotype_pos_df, covariates_df = load_phenotypes(expression_bed, covariates_df)
     
     # 加载基因型
     print(f"Loading genotype data from: {Config.PLINK_PREFIX_PATH}")
-    pr = genotypeio.PlinkReader(Config.PLINK_PREFIX_PATH, select_samples=phenotype_df.columns)
-    genotype_df = pr.load_genotypes()
-    variant_df = pr.bim.set_index('snp')[['chrom', 'pos']]
+    genotype_df, variant_df = genotype_cache.load_genotypes(
+        Config.PLINK_PREFIX_PATH, select_samples=phenotype_df.columns, cache_dir=Config.GENOTYPE_CACHE_DIR
+    )
     print(f"Loaded genotype data: {genotype_df.shape[1]} samples, {genotype_df.shape[0]} variants")
     
     return phenotype_df, phenotype_pos_df, covariates_df, genotype_df, variant_df
 
+def save_cis_results(cis_df, output_prefix):
+    """对cis-eQTL结果（每个基因一个lead SNP）进行FDR校正并输出显著基因"""
+    # FDR校正
+    cis_df = cis.calculate_qvalues(cis_df, fdr=Config.FDR_THRESHOLD)
+    
+    # 过滤显著结果 - 每个基因已经是lead SNP
+    significant_cis = cis_df[cis_df['qval'] < Config.FDR_THRESHOLD].copy()
+    
+    # 添加效应方向
+    significant_cis['effect_direction'] = significant_cis['slope'].apply(
+        lambda x: 'positive' if x > 0 else 'negative'
+    )
+    
+    if not significant_cis.empty:
+        output_file = f"{output_prefix}_cis_lead_snps.txt"
+        significant_cis.to_csv(output_file, sep="\t", index=True)
+        print(f"Cis-eQTL: {len(significant_cis)} significant genes -> {output_file}")
+        return significant_cis
+    else:
+        print("Cis-eQTL: No significant associations")
+        # 创建空文件保持一致性
+        pd.DataFrame().to_csv(f"{output_prefix}_cis_lead_snps.txt", sep="\t")
+        return pd.DataFrame()
+
 def run_cis_eqtl(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, output_prefix):
     """运行cis-eQTL分析，输出每个基因的lead SNP"""
     print("Running cis-eQTL analysis...")
     
     try:
         # cis映射 - 默认返回每个基因最显著的SNP
-        cis_df = cis.map_cis(
-            genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
-            nperm=Config.CIS_NPERM, maf_threshold=Config.MAF_THRESHOLD, 
-            window=Config.CIS_WINDOW, seed=Config.SEED
-        )
-        
-        # FDR校正
-        cis_df = cis.calculate_qvalues(cis_df, fdr=Config.FDR_THRESHOLD)
-        
-        # 过滤显著结果 - 每个基因已经是lead SNP
-        significant_cis = cis_df[cis_df['qval'] < Config.FDR_THRESHOLD].copy()
-        
-        # 添加效应方向
-        significant_cis['effect_direction'] = significant_cis['slope'].apply(
-            lambda x: 'positive' if x > 0 else 'negative'
-        )
-        
-        if not significant_cis.empty:
-            output_file = f"{output_prefix}_cis_lead_snps.txt"
-            significant_cis.to_csv(output_file, sep="\t", index=True)
-            print(f"Cis-eQTL: {len(significant_cis)} significant genes -> {output_file}")
-            return significant_cis
+        if Config.CIS_ADAPTIVE:
+            cis_df = map_cis_adaptive(
+                genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
+                nperm=Config.CIS_NPERM, round_size=Config.CIS_PERM_ROUND, maf_threshold=Config.MAF_THRESHOLD,
+                window=Config.CIS_WINDOW, seed=Config.SEED
+            )
         else:
-            print("Cis-eQTL: No significant associations")
-            # 创建空文件保持一致性
-            pd.DataFrame().to_csv(f"{output_prefix}_cis_lead_snps.txt", sep="\t")
-            return pd.DataFrame()
+            cis_df = cis.map_cis(
+                genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
+                nperm=Config.CIS_NPERM, maf_threshold=Config.MAF_THRESHOLD, 
+                window=Config.CIS_WINDOW, seed=Config.SEED
+            )
+        return save_cis_results(cis_df, output_prefix)
             
     except Exception as e:
         print(f"Error in cis-eQTL analysis: {e}")
@@ -86,51 +120,99 @@ def run_cis_eqtl(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covari
         pd.DataFrame().to_csv(f"{output_prefix}_cis_lead_snps.txt", sep="\t")
         return pd.DataFrame()
 
+def run_cis_eqtl_sharded(phenotype_df, phenotype_pos_df, covariates_df, output_prefix):
+    """
+    分片运行cis-eQTL分析：各分片在独立进程中只内存映射自己的基因型区间，
+    合并后统一进行FDR校正，结果与 run_cis_eqtl 相同。
+    CIS_WORKERS > 1 时按cis变异数均衡分块，否则按染色体分片。
+    """
+    if Config.CIS_WORKERS > 1:
+        workers, n_chunks = Config.CIS_WORKERS, Config.CIS_WORKERS
+    else:
+        workers, n_chunks = Config.CIS_SHARD_WORKERS, None
+    print(f"Running sharded cis-eQTL analysis ({workers} workers)...")
+    
+    try:
+        cache_path = genotype_cache.build_cache(Config.PLINK_PREFIX_PATH, cache_dir=Config.GENOTYPE_CACHE_DIR)
+        kwargs = dict(nperm=Config.CIS_NPERM, maf_threshold=Config.MAF_THRESHOLD, seed=Config.SEED)
+        if Config.CIS_ADAPTIVE:
+            kwargs['round_size'] = Config.CIS_PERM_ROUND
+        cis_df = map_cis_sharded(
+            cache_path, phenotype_df, phenotype_pos_df, covariates_df, window=Config.CIS_WINDOW,
+            workers=workers, n_chunks=n_chunks, adaptive=Config.CIS_ADAPTIVE, **kwargs
+        )
+        return save_cis_results(cis_df, output_prefix)
+    
+    except Exception as e:
+        print(f"Error in cis-eQTL analysis: {e}")
+        pd.DataFrame().to_csv(f"{output_prefix}_cis_lead_snps.txt", sep="\t")
+        return pd.DataFrame()
+
+def trans_n_tests(genotype_df, phenotype_df):
+    """TRANS_FDR_ALL_TESTS 时返回 BH 校正的实际检验数，否则返回 None（使用初筛输出的位点对数）"""
+    if not Config.TRANS_FDR_ALL_TESTS:
+        return None
+    n_variants = count_maf_variants(genotype_df, phenotype_df.columns, Config.MAF_THRESHOLD)
+    print(f"Trans-eQTL FDR: {n_variants} variants x {phenotype_df.shape[0]} genes tested")
+    return n_variants * phenotype_df.shape[0]
+
+def save_trans_results(trans_df, output_prefix, n_tests=None):
+    """对trans-eQTL初筛结果进行FDR校正，输出所有显著SNP-基因对（n_tests 为 BH 分母，默认为位点对数）"""
+    output_file = f"{output_prefix}_trans_all_significant.txt"
+    if trans_df.empty:
+        print("Trans-eQTL: No associations found in initial screening")
+        # 创建空文件
+        pd.DataFrame().to_csv(output_file, sep="\t")
+        return pd.DataFrame()
+    
+    print(f"Trans-eQTL initial screening: {len(trans_df)} associations found")
+    
+    # tensorqtl 输出的效应值列为 b/b_se，统一为 slope/slope_se
+    trans_df = trans_df.rename(columns={'b': 'slope', 'b_se': 'slope_se'})
+    
+    # FDR校正
+    trans_df['qval'] = bh_qvalues(trans_df['pval'].values, n_tests)
+    
+    # 过滤显著结果 - 保留所有显著对
+    significant_trans = trans_df[trans_df['qval'] < Config.FDR_THRESHOLD].copy()
+    
+    if not significant_trans.empty:
+        # 添加效应方向
+        significant_trans['effect_direction'] = significant_trans['slope'].apply(
+            lambda x: 'positive' if x > 0 else 'negative'
+        )
+        
+        # 按p值排序
+        significant_trans = significant_trans.sort_values('pval')
+        
+        significant_trans.to_csv(output_file, sep="\t", index=False)
+        print(f"Trans-eQTL: {len(significant_trans)} significant pairs -> {output_file}")
+        return significant_trans
+    else:
+        print("Trans-eQTL: No significant associations after FDR correction")
+        # 创建空文件
+        pd.DataFrame().to_csv(output_file, sep="\t")
+        return pd.DataFrame()
+
 def run_trans_eqtl(genotype_df, phenotype_df, covariates_df, output_prefix):
     """运行trans-eQTL分析，输出所有显著SNP-基因对"""
     print("Running trans-eQTL analysis...")
     
     try:
         # trans映射 - 返回所有达到阈值的SNP-基因对
-        trans_df = trans.map_trans(
-            genotype_df, phenotype_df, covariates_df,
-            return_sparse=True, pval_threshold=Config.TRANS_PVAL_THRESHOLD,
-            maf_threshold=Config.MAF_THRESHOLD, batch_size=10000
-        )
-        
-        if trans_df.empty:
-            print("Trans-eQTL: No associations found in initial screening")
-            # 创建空文件
-            pd.DataFrame().to_csv(f"{output_prefix}_trans_all_significant.txt", sep="\t")
-            return pd.DataFrame()
-        
-        print(f"Trans-eQTL initial screening: {len(trans_df)} associations found")
-        
-        # FDR校正
-        _, qvals, _, _ = multipletests(trans_df['pval'].values, method='fdr_bh')
-        trans_df['qval'] = qvals
-        
-        # 过滤显著结果 - 保留所有显著对
-        significant_trans = trans_df[trans_df['qval'] < Config.FDR_THRESHOLD].copy()
-        
-        if not significant_trans.empty:
-            # 添加效应方向
-            significant_trans['effect_direction'] = significant_trans['slope'].apply(
-                lambda x: 'positive' if x > 0 else 'negative'
+        if Config.TRANS_ENGINE == 'cpu':
+            trans_df = map_trans_cpu(
+                genotype_df, phenotype_df, covariates_df,
+                pval_threshold=Config.TRANS_PVAL_THRESHOLD,
+                maf_threshold=Config.MAF_THRESHOLD, batch_size=10000, n_threads=Config.TRANS_THREADS
             )
-            
-            # 按p值排序
-            significant_trans = significant_trans.sort_values('pval')
-            
-            output_file = f"{output_prefix}_trans_all_significant.txt"
-            significant_trans.to_csv(output_file, sep="\t", index=False)
-            print(f"Trans-eQTL: {len(significant_trans)} significant pairs -> {output_file}")
-            return significant_trans
         else:
-            print("Trans-eQTL: No significant associations after FDR correction")
-            # 创建空文件
-            pd.DataFrame().to_csv(f"{output_prefix}_trans_all_significant.txt", sep="\t")
-            return pd.DataFrame()
+            trans_df = trans.map_trans(
+                genotype_df, phenotype_df, covariates_df,
+                return_sparse=True, pval_threshold=Config.TRANS_PVAL_THRESHOLD,
+                maf_threshold=Config.MAF_THRESHOLD, batch_size=10000
+            )
+        return save_trans_results(trans_df, output_prefix, trans_n_tests(genotype_df, phenotype_df))
             
     except Exception as e:
         print(f"Error in trans-eQTL analysis: {e}")
@@ -138,13 +220,97 @@ def run_trans_eqtl(genotype_df, phenotype_df, covariates_df, output_prefix):
         pd.DataFrame().to_csv(f"{output_prefix}_trans_all_significant.txt", sep="\t")
         return pd.DataFrame()
 
+def run_trans_eqtl_filtered(genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df,
+                            output_prefix, write_raw=False):
+    """
+    运行trans-eQTL分析，并在映射过程中完成过滤、距离分类注释和每个基因前N个的选取，
+    只输出最终的真正 trans-eQTL 表（write_raw 时另输出未过滤的稀疏结果）。
+    """
+    print("Running trans-eQTL analysis with in-pass filtering...")
+    output_file = f"{output_prefix}_trans_true_trans.txt"
+    try:
+        # 映射中途出错时也删除 BH 校正器的外存目录
+        with TransFilterSink(
+            variant_df, phenotype_pos_df, pval_threshold=Config.TRANS_FILTER_PVAL,
+            effect_size_threshold=Config.TRANS_FILTER_SLOPE, min_maf=Config.TRANS_FILTER_MAF,
+            distance_threshold=Config.TRANS_FILTER_DISTANCE, snps_per_gene=Config.TRANS_SNPS_PER_GENE,
+            raw_file=f"{output_prefix}_trans_raw.txt" if write_raw else None,
+            n_tests=trans_n_tests(genotype_df, phenotype_df)
+        ) as sink:
+            if Config.TRANS_ENGINE == 'cpu':
+                # 每个基因型批次的结果直接交给过滤器，不在内存中累积
+                map_trans_cpu(
+                    genotype_df, phenotype_df, covariates_df,
+                    pval_threshold=Config.TRANS_PVAL_THRESHOLD,
+                    maf_threshold=Config.MAF_THRESHOLD, batch_size=10000, n_threads=Config.TRANS_THREADS,
+                    on_batch=sink
+                )
+            else:
+                trans_df = trans.map_trans(
+                    genotype_df, phenotype_df, covariates_df,
+                    return_sparse=True, pval_threshold=Config.TRANS_PVAL_THRESHOLD,
+                    maf_threshold=Config.MAF_THRESHOLD, batch_size=10000
+                )
+                for start in range(0, len(trans_df), 1000000):
+                    sink(trans_df.iloc[start:start + 1000000])
+        
+            print(f"Trans-eQTL initial screening: {sink.n_pairs} associations found")
+            true_trans_df = sink.finish(Config.FDR_THRESHOLD)
+            if true_trans_df.empty:
+                print("Trans-eQTL: No true trans-eQTLs passed filtering")
+                pd.DataFrame().to_csv(output_file, sep="\t")
+                return pd.DataFrame()
+            save_true_trans(true_trans_df, output_file)
+            print(f"Trans-eQTL: {len(true_trans_df)} true trans pairs -> {output_file}")
+            return true_trans_df
+    
+    except Exception as e:
+        print(f"Error in trans-eQTL analysis: {e}")
+        pd.DataFrame().to_csv(output_file, sep="\t")
+        return pd.DataFrame()
+
+def run_trans_eqtl_multi(genotype_df, phenotype_dfs, covariates_df, output_prefixes):
+    """
+    对同一时期的多组表型（如不同PEER因子数的残差）运行trans-eQTL分析，
+    基因型批次只处理一次。phenotype_dfs 和 output_prefixes 均为以组名为键的字典。
+    """
+    print(f"Running batched trans-eQTL analysis for {len(phenotype_dfs)} phenotype sets...")
+    
+    try:
+        trans_dfs = map_trans_multi(
+            genotype_df, phenotype_dfs, covariates_df,
+            pval_threshold=Config.TRANS_PVAL_THRESHOLD,
+            maf_threshold=Config.MAF_THRESHOLD, batch_size=10000
+        )
+    except Exception as e:
+        print(f"Error in trans-eQTL analysis: {e}")
+        trans_dfs = {name: pd.DataFrame() for name in phenotype_dfs}
+    
+    return {name: save_trans_results(trans_dfs[name], output_prefixes[name],
+                                     trans_n_tests(genotype_df, phenotype_dfs[name]))
+            for name in phenotype_dfs}
+
 @click.command()
 @click.option('--expression_bed', required=True, help="Expression BED file path")
 @click.option('--covariates_file', required=True, help="Covariates file path")
 @click.option('--outfile', required=True, help="Output file prefix")
 @click.option('--mode', type=click.Choice(['p', 't', 'both']), required=True, 
               help="p=cis-eQTL, t=trans-eQTL, both=both analyses")
-def main(expression_bed, covariates_file, outfile, mode):
+@click.option('--trans_engine', type=click.Choice(['tensorqtl', 'cpu']), default=Config.TRANS_ENGINE, show_default=True,
+              help="trans-eQTL engine: tensorqtl or cpu (tiled NumPy/BLAS engine for CPU-only nodes)")
+@click.option('--threads', type=int, default=None, help="Threads for the cpu trans engine (default: all cores)")
+@click.option('--cis_adaptive', is_flag=True, help="Adaptive permutations for cis-eQTL (stop early for clearly null genes)")
+@click.option('--cis_shards', type=int, default=0, show_default=True,
+              help="Run cis-eQTL in per-chromosome shards with this many worker processes (0 = off)")
+@click.option('--workers', type=int, default=1, show_default=True,
+              help="Worker processes for cis-eQTL; phenotypes are split into chunks balanced by cis variant count")
+@click.option('--trans_filter', is_flag=True,
+              help="Filter, annotate (cis/trans distance) and keep top SNPs per gene during trans mapping")
+@click.option('--write_raw', is_flag=True, help="With --trans_filter, also write the unfiltered sparse trans table")
+@click.option('--fdr_all_tests', is_flag=True,
+              help="Use the number of tests (variants passing MAF x genes) as the trans BH denominator")
+def main(expression_bed, covariates_file, outfile, mode, trans_engine, threads, cis_adaptive, cis_shards, workers,
+         trans_filter, write_raw, fdr_all_tests):
     """
     QTL分析脚本:
     - cis-eQTL: 每个基因输出一个lead SNP
@@ -154,6 +320,21 @@ def main(expression_bed, covariates_file, outfile, mode):
     print(f"Expression file: {expression_bed}")
     print(f"Covariates file: {covariates_file}")
     print(f"Output prefix: {outfile}")
+    Config.TRANS_ENGINE = trans_engine
+    Config.TRANS_THREADS = threads
+    Config.TRANS_FDR_ALL_TESTS = fdr_all_tests
+    Config.CIS_ADAPTIVE = cis_adaptive
+    Config.CIS_SHARD_WORKERS = cis_shards
+    Config.CIS_WORKERS = workers
+    sharded = cis_shards > 0 or workers > 1
+    
+    # 分片cis映射时各分片自行读取基因型，只跑cis时不需要加载全部基因型
+    if mode == 'p' and sharded:
+        covariates_df = pd.read_csv(covariates_file, sep='\t', index_col=0)
+        phenotype_df, phenotype_pos_df, covariates_df = load_phenotypes(expression_bed, covariates_df)
+        run_cis_eqtl_sharded(phenotype_df, phenotype_pos_df, covariates_df, outfile)
+        print("QTL analysis completed successfully!")
+        return
     
     # 加载数据
     phenotype_df, phenotype_pos_df, covariates_df, genotype_df, variant_df = load_data(
@@ -162,15 +343,23 @@ def main(expression_bed, covariates_file, outfile, mode):
     
     # 运行指定分析
     if mode in ['p', 'both']:
-        cis_results = run_cis_eqtl(
-            genotype_df, variant_df, phenotype_df, phenotype_pos_df, 
-            covariates_df, outfile
-        )
+        if sharded:
+            cis_results = run_cis_eqtl_sharded(phenotype_df, phenotype_pos_df, covariates_df, outfile)
+        else:
+            cis_results = run_cis_eqtl(
+                genotype_df, variant_df, phenotype_df, phenotype_pos_df, 
+                covariates_df, outfile
+            )
     
     if mode in ['t', 'both']:
-        trans_results = run_trans_eqtl(
-            genotype_df, phenotype_df, covariates_df, outfile
-        )
+        if trans_filter:
+            trans_results = run_trans_eqtl_filtered(
+                genotype_df, variant_df, phenotype_df, phenotype_pos_df, covariates_df, outfile, write_raw
+            )
+        else:
+            trans_results = run_trans_eqtl(
+                genotype_df, phenotype_df, covariates_df, outfile
+            )
     
     print("QTL analysis completed successfully!")
 
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+'''
+单进程 stage × PEER因子数 × mode 批量 QTL 分析，替代 run_qtl_analysis.sh 中的 shell 循环：
+基因型只加载一次，每个时期的协变量只读取一次，各组合在进程内（或进程池中）依次运行，
+输出与 qtl_analysis.py 相同的 {stage}_{mode}_{factor}_* 文件，并额外输出每次运行的耗时表。
+'''
+
+import os
+import time
+import click
+import pandas as pd
+import multiprocessing as mp
+import torch
+import genotype_cache
+from qtl_analysis import Config, load_phenotypes, run_cis_eqtl, run_trans_eqtl, run_trans_eqtl_multi
+
+# 在 fork 的子进程间共享的数据（基因型为内存映射，只读）
+_SHARED = {}
+
+def parse_list(value):
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+def auto_workers(n_runs, bytes_per_run):
+    """根据CPU核数和可用内存确定进程数"""
+    n_cpu = os.cpu_count() or 1
+    try:
+        avail = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        n_mem = max(1, int(avail // max(bytes_per_run, 1)))
+    except (ValueError, OSError):
+        n_mem = n_cpu
+    return max(1, min(n_cpu, n_mem, n_runs))
+
+def _init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+
+def run_one(job):
+    """运行一个 stage × mode × factor 组合（批量trans时为同一时期的多个factor），返回耗时记录"""
+    stage, mode, factors = job
+    genotype_df = _SHARED['genotype_df']
+    variant_df = _SHARED['variant_df']
+    covariates_df = _SHARED['covariates'][stage]
+    output_prefixes = {factor: os.path.join(_SHARED['output_dir'], f"{stage}_{mode}_{factor}") for factor in factors}
+    print(f"Processing: Stage={stage}, Mode={mode}, Factor={','.join(factors)}")
+
+    t0 = time.time()
+    phenotypes = {}
+    for factor in factors:
+        expression_bed = _SHARED['expression_bed'].format(stage=stage, factor=factor)
+        phenotypes[factor] = load_phenotypes(expression_bed, covariates_df)
+    phenotype_df, phenotype_pos_df, stage_covariates_df = phenotypes[factors[0]]
+    stage_genotype_df = genotype_df[phenotype_df.columns]
+    t1 = time.time()
+
+    if mode == 'p':
+        factor = factors[0]
+        results = {factor: run_cis_eqtl(stage_genotype_df, variant_df, phenotype_df, phenotype_pos_df,
+                                        stage_covariates_df, output_prefixes[factor])}
+    elif len(factors) == 1:
+        factor = factors[0]
+        results = {factor: run_trans_eqtl(stage_genotype_df, phenotype_df, stage_covariates_df, output_prefixes[factor])}
+    else:
+        # 同一时期的各组表型共用基因型批次
+        phenotype_dfs = {factor: phenotypes[factor][0] for factor in factors}
+        results = run_trans_eqtl_multi(stage_genotype_df, phenotype_dfs, stage_covariates_df, output_prefixes)
+    t2 = time.time()
+
+    return [{
+        'stage': stage, 'mode': mode, 'factor': factor, 'batch_size': len(factors),
+        'n_samples': phenotypes[factor][0].shape[1], 'n_genes': phenotypes[factor][0].shape[0],
+        'n_results': len(results[factor]),
+        'load_sec': round(t1 - t0, 2), 'run_sec': round(t2 - t1, 2), 'total_sec': round(t2 - t0, 2),
+    } for factor in factors]
+
+@click.command()
+@click.option('--expression_bed', required=True,
+              help="Expression BED path template with {stage} and {factor}, e.g. .../stage-{stage}_residuals-{factor}.bed.gz")
+@click.option('--covariates_file', required=True, help="Covariates path template with {stage}, e.g. .../PCA_qcovar.Stage{stage}.txt")
+@click.option('--output_dir', required=True, help="Output directory")
+@click.option('--stages', default='1,2,3,4', show_default=True, help="Comma-separated stages")
+@click.option('--modes', default='p,t', show_default=True, help="Comma-separated modes (p=cis-eQTL, t=trans-eQTL)")
+@click.option('--factors', default='5,10,15,20,25,30,35,40', show_default=True, help="Comma-separated PEER factor numbers")
+@click.option('--trans_batched/--no-trans_batched', default=True, show_default=True,
+              help="Scan all factors of a stage together in trans mode, sharing genotype batches")
+@click.option('--workers', default=1, show_default=True, help="Number of worker processes (0 = auto from cores/memory)")
+def main(expression_bed, covariates_file, output_dir, stages, modes, factors, trans_batched, workers):
+    """
+    批量运行 stage × mode × factor 的 QTL 分析，基因型和协变量只加载一次。
+    """
+    stages, modes, factors = parse_list(stages), parse_list(modes), parse_list(factors)
+    for mode in modes:
+        if mode not in ('p', 't'):
+            raise click.BadParameter(f"Unknown mode: {mode}", param_hint='--modes')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # 加载基因型（全部样本，内存映射），每次运行再按样本选取
+    print(f"Loading genotype data from: {Config.PLINK_PREFIX_PATH}")
+    genotype_df, variant_df = genotype_cache.load_genotypes(Config.PLINK_PREFIX_PATH, cache_dir=Config.GENOTYPE_CACHE_DIR)
+    print(f"Loaded genotype data: {genotype_df.shape[1]} samples, {genotype_df.shape[0]} variants")
+
+    # 每个时期的协变量只读取一次
+    covariates = {}
+    for stage in stages:
+        covariates[stage] = pd.read_csv(covariates_file.format(stage=stage), sep='\t', index_col=0)
+
+    _SHARED.update(genotype_df=genotype_df, variant_df=variant_df, covariates=covariates,
+                   expression_bed=expression_bed, output_dir=output_dir)
+
+    jobs = []
+    for stage in stages:
+        for mode in modes:
+            if mode == 't' and trans_batched:
+                jobs.append((stage, mode, factors))
+            else:
+                jobs.extend((stage, mode, [factor]) for factor in factors)
+    if workers == 0:
+        # 每个任务约复制一份时期基因型并转换为浮点批次
+        workers = auto_workers(len(jobs), genotype_df.shape[0] * genotype_df.shape[1] * 4)
+    print(f"Running {len(jobs)} jobs with {workers} worker(s)")
+
+    if workers == 1:
+        timings = [run_one(job) for job in jobs]
+    else:
+        n_threads = max(1, (os.cpu_count() or 1) // workers)
+        with mp.get_context('fork').Pool(workers, initializer=_init_worker, initargs=(n_threads,)) as pool:
+            timings = pool.map(run_one, jobs, chunksize=1)
+
+    timing_file = os.path.join(output_dir, "sweep_timing.tsv")
+    timings = [row for rows in timings for row in rows]
+    pd.DataFrame(timings).to_csv(timing_file, sep='\t', index=False)
+    print(f"Timing table saved to {timing_file}")
+    print("所有QTL分析完成！")
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ python3 filter_trans_eqtls.py \
   --min-maf 0.1 \
   --snps-per-gene 3 \
   --filter-hotspots \
-  --filter-cis-acting
+  --filter-cis-acting \
+  --chunksize 1000000
 
 # >5mb 或者不同染色体
 python filter_true_trans_eqtls.py \
@@ -18,3 +19,11 @@ python filter_true_trans_eqtls.py \
   --qval-threshold 0.05 \
   --pval-threshold 1e-8
 
+
+# 一次读取，同时输出多组阈值的结果（每组一个结果文件和统计文件）
+python filter_trans_profiles.py \
+  --input stage1_t_5_trans_all_significant.txt \
+  --output-prefix stage1_t_5_trans \
+  --gene-bed /path/to/gene_positions.bed \
+  --profile "strict:qval=0.01,pval=1e-10,slope=0.2,maf=0.1,snps_per_gene=3,hotspot=3,cis_acting=1" \
+  --profile "true:distance=5000000,qval=0.05,pval=1e-8"
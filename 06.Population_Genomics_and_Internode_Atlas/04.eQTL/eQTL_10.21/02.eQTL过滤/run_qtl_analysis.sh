@@ -12,6 +12,9 @@ factors=(5 10 15 20 25 30 35 40)
 output_base="/data0/agis_xiazhongqiang/Project/04.eQTL/06.YZ.qtl_mapping/05.pair_eqtl"
 mkdir -p $output_base
 
+# 预先构建基因型缓存（计算一次 PLINK 文件全文哈希并只解码一次，之后各任务按文件状态查到缓存并内存映射读取）
+python3 genotype_cache.py --plink_prefix /data0/agis_xiazhongqiang/Project/04.eQTL/06.YZ.qtl_mapping/01.data/07.pre.all.data/GWAS
+
 # 遍历所有组合
 for stage in "${stages[@]}"; do
   for mode in "${modes[@]}"; do
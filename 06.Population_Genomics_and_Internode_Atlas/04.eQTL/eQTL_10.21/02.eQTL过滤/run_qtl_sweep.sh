@@ -0,0 +1,18 @@
+#!/bin/bash
+# QTL批量分析调用脚本（单进程加载基因型，替代 run_qtl_analysis.sh 中的逐个调用）
+
+source ~/miniconda3/bin/activate tensorqtl_env
+
+data_dir="/data0/agis_xiazhongqiang/Project/04.eQTL/06.YZ.qtl_mapping/01.data/07.pre.all.data"
+output_base="/data0/agis_xiazhongqiang/Project/04.eQTL/06.YZ.qtl_mapping/05.pair_eqtl"
+
+python3 qtl_sweep.py \
+  --expression_bed "${data_dir}/stage-{stage}_residuals-{factor}.bed.gz" \
+  --covariates_file "${data_dir}/PCA_qcovar.Stage{stage}.txt" \
+  --output_dir ${output_base} \
+  --stages 1,2,3,4 \
+  --modes p,t \
+  --factors 5,10,15,20,25,30,35,40 \
+  --workers 1
+
+echo "所有QTL分析完成！耗时统计: ${output_base}/sweep_timing.tsv"
@@ -0,0 +1,61 @@
+import os
+import sys
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from filter_trans_eqtls import filter_trans_eqtls
+
+# 玩具 trans-eQTL 表：g1 有 6 个通过过滤的 SNP（只保留前5个），其余行各被一个阈值过滤掉
+TOY_ROWS = [
+    ('g1', 'chr1_100_A_G', 1e-12, 0.001, 0.50, 0.20),
+    ('g1', 'chr1_200_A_G', 1e-11, 0.001, -0.40, 0.20),
+    ('g1', 'chr1_300_A_G', 1e-10, 0.001, 0.30, 0.20),
+    ('g1', 'chr1_400_A_G', 2e-10, 0.001, 0.30, 0.20),
+    ('g1', 'chr1_500_A_G', 3e-10, 0.001, 0.30, 0.20),
+    ('g1', 'chr1_600_A_G', 4e-10, 0.001, 0.30, 0.20),
+    ('g2', 'chr2_100_A_G', 1e-9, 0.10, 0.50, 0.20),   # qval
+    ('g2', 'chr2_200_A_G', 1e-7, 0.001, 0.50, 0.20),  # pval
+    ('g2', 'chr2_300_A_G', 1e-9, 0.001, 0.05, 0.20),  # slope
+    ('g2', 'chr2_400_A_G', 1e-9, 0.001, 0.50, 0.01),  # maf
+    ('g3', 'chr3_100_A_G', 5e-9, 0.001, -0.20, 0.30),
+]
+
+@pytest.fixture
+def toy_input(tmp_path):
+    path = tmp_path / 'trans.txt'
+    pd.DataFrame(TOY_ROWS, columns=['phenotype_id', 'variant_id', 'pval', 'qval', 'slope', 'maf']).to_csv(
+        path, sep='\t', index=False)
+    return path
+
+@pytest.mark.parametrize('chunksize', [0, 3])
+def test_filter_trans_eqtls(toy_input, tmp_path, chunksize):
+    output = str(tmp_path / f'filtered_{chunksize}.txt')
+    result = CliRunner().invoke(filter_trans_eqtls, ['-i', str(toy_input), '-o', output, '--chunksize', str(chunksize)])
+    assert result.exit_code == 0, result.output
+    out = pd.read_csv(output, sep='\t')
+    assert list(out['variant_id']) == ['chr1_100_A_G', 'chr1_200_A_G', 'chr1_300_A_G', 'chr1_400_A_G',
+                                       'chr1_500_A_G', 'chr3_100_A_G']
+    assert list(out.columns)[-1] == 'abs_slope'
+    with open(output.replace('.txt', '_stats.txt')) as f:
+        stats = f.read()
+    assert 'Final associations: 6\n' in stats
+    assert 'Unique genes: 2\n' in stats
+
+def test_filter_trans_eqtls_modes_identical(toy_input, tmp_path):
+    outputs = []
+    for chunksize in (0, 2):
+        output = str(tmp_path / f'mode_{chunksize}.txt')
+        result = CliRunner().invoke(filter_trans_eqtls, ['-i', str(toy_input), '-o', output, '--chunksize', str(chunksize)])
+        assert result.exit_code == 0, result.output
+        with open(output) as f:
+            outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+
+def test_filter_trans_eqtls_empty(toy_input, tmp_path):
+    output = str(tmp_path / 'empty.txt')
+    result = CliRunner().invoke(filter_trans_eqtls, ['-i', str(toy_input), '-o', output, '--pval-threshold', '1e-20'])
+    assert result.exit_code == 0, result.output
+    with open(output) as f:
+        assert f.read() == 'phenotype_id\tvariant_id\tpval\tqval\tslope\tmaf\n'
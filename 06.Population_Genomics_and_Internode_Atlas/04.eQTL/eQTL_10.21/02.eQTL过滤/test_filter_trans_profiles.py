@@ -0,0 +1,69 @@
+import os
+import sys
+import pandas as pd
+import pytest
+from click.testing import CliRunner
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from filter_trans_eqtls import filter_trans_eqtls
+from filter_trans_profiles import filter_trans_profiles
+from test_filter_trans_eqtls import TOY_ROWS
+
+COLUMNS = ['phenotype_id', 'variant_id', 'pval', 'qval', 'slope', 'maf']
+
+@pytest.fixture
+def toy_files(tmp_path):
+    trans = tmp_path / 'trans.txt'
+    pd.DataFrame(TOY_ROWS, columns=COLUMNS).to_csv(trans, sep='\t', index=False)
+    gene_bed = tmp_path / 'genes.bed'
+    # g1 在 chr2（全部为不同染色体），g3 与其 SNP 同在 chr3 且距离很近
+    gene_bed.write_text('chr2\t1000\t2000\tg1\nchr2\t1000\t2000\tg2\nchr3\t100\t300\tg3\n')
+    return trans, gene_bed
+
+def run_profiles(toy_files, tmp_path, *profiles):
+    trans, gene_bed = toy_files
+    prefix = str(tmp_path / 'out')
+    args = ['-i', str(trans), '-o', prefix, '-g', str(gene_bed)]
+    for p in profiles:
+        args += ['-p', p]
+    result = CliRunner().invoke(filter_trans_profiles, args)
+    assert result.exit_code == 0, result.output
+    return prefix
+
+def test_profile_matches_filter_trans_eqtls(toy_files, tmp_path):
+    prefix = run_profiles(toy_files, tmp_path, 'default:')
+    single = str(tmp_path / 'single.txt')
+    result = CliRunner().invoke(filter_trans_eqtls, ['-i', str(toy_files[0]), '-o', single])
+    assert result.exit_code == 0, result.output
+    with open(f'{prefix}_default.txt') as a, open(single) as b:
+        assert a.read() == b.read()
+    assert os.path.exists(f'{prefix}_default_stats.txt')
+
+def test_distance_profile(toy_files, tmp_path):
+    prefix = run_profiles(toy_files, tmp_path, 'true:distance=5000000')
+    out = pd.read_csv(f'{prefix}_true.txt', sep='\t')
+    assert set(out['phenotype_id']) == {'g1'}
+    with open(f'{prefix}_true_stats.txt') as f:
+        assert 'Total true trans-eQTLs: 5\n' in f.read()
+
+def test_empty_profiles_write_header_and_stats(toy_files, tmp_path):
+    prefix = run_profiles(toy_files, tmp_path, 'none:pval=1e-20', 'far:distance=5000000,pval=1e-20')
+    for name in ('none', 'far'):
+        with open(f'{prefix}_{name}.txt') as f:
+            assert f.read() == '\t'.join(COLUMNS) + '\n'
+    with open(f'{prefix}_none_stats.txt') as f:
+        assert 'Final associations: 0\n' in f.read()
+    with open(f'{prefix}_far_stats.txt') as f:
+        assert 'Total true trans-eQTLs: 0\n' in f.read()
+
+def test_placeholder_input_writes_empty_profiles(toy_files, tmp_path):
+    # qtl_analysis.py 没有显著关联时的占位文件：pd.DataFrame().to_csv(..., sep='\t')
+    trans, gene_bed = toy_files
+    pd.DataFrame().to_csv(trans, sep='\t')
+    prefix = run_profiles((trans, gene_bed), tmp_path, 'default:', 'true:distance=5000000')
+    for name in ('default', 'true'):
+        assert os.path.exists(f'{prefix}_{name}.txt')
+    with open(f'{prefix}_default_stats.txt') as f:
+        assert 'Final associations: 0\n' in f.read()
+    with open(f'{prefix}_true_stats.txt') as f:
+        assert 'Total true trans-eQTLs: 0\n' in f.read()
@@ -0,0 +1,43 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import genotype_cache
+
+def write_plink(prefix, bed_body):
+    with open(f'{prefix}.bed', 'wb') as f:
+        f.write(b'\x6c\x1b\x01' + bed_body)
+    with open(f'{prefix}.bim', 'w') as f:
+        f.write('1\ts1\t0\t100\tA\tG\n')
+    with open(f'{prefix}.fam', 'w') as f:
+        f.write('a a 0 0 0 -9\n')
+
+def test_fingerprint_changes_with_bed_content(tmp_path):
+    prefix = str(tmp_path / 'geno')
+    write_plink(prefix, bytes(4 << 20))
+    first = genotype_cache.plink_fingerprint(prefix)
+    # 同样大小、头尾相同，只改中间的基因型
+    body = bytearray(4 << 20)
+    body[2 << 20] = 0xff
+    tmp = f'{prefix}.bed.new'
+    with open(tmp, 'wb') as f:
+        f.write(b'\x6c\x1b\x01' + body)
+    os.replace(tmp, f'{prefix}.bed')
+    second = genotype_cache.plink_fingerprint(prefix)
+    assert second != first
+    assert genotype_cache.plink_fingerprint(prefix, verify=True) == second
+
+def test_fingerprint_reuses_recorded_hash(tmp_path, monkeypatch):
+    prefix = str(tmp_path / 'geno')
+    write_plink(prefix, bytes(1024))
+    first = genotype_cache.plink_fingerprint(prefix)
+    monkeypatch.setattr(genotype_cache, 'plink_content_hash', lambda p: (_ for _ in ()).throw(AssertionError('rehashed')))
+    assert genotype_cache.plink_fingerprint(prefix) == first
+
+def test_sample_indexer_rejects_missing_samples():
+    samples = pd.Index(['a', 'b', 'c'])
+    assert list(genotype_cache.sample_indexer(samples, ['c', 'a'])) == [2, 0]
+    with pytest.raises(ValueError, match='x'):
+        genotype_cache.sample_indexer(samples, ['a', 'x'])
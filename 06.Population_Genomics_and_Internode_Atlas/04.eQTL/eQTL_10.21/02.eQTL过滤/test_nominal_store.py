@@ -0,0 +1,38 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from nominal_store import build_store, NominalStore
+
+VARIANTS = pd.DataFrame({'chrom': ['1', '1', '2', '2', '3'], 'pos': [100, 200, 50, 150, 10]},
+                        index=pd.Index(['v1', 'v2', 'v3', 'v4', 'v5'], name='snp'))
+
+def write_nominal(prefix, chrom, rows):
+    df = pd.DataFrame(rows, columns=['phenotype_id', 'variant_id', 'start_distance', 'af', 'pval_nominal', 'slope'])
+    df = df.astype({'phenotype_id': str, 'variant_id': str, 'start_distance': np.int32,
+                    'af': np.float32, 'pval_nominal': np.float64, 'slope': np.float32})
+    df.to_parquet(f'{prefix}.cis_qtl_pairs.{chrom}.parquet', index=False)
+
+def test_build_store_skips_empty_chromosomes(tmp_path):
+    prefix = str(tmp_path / '1_n_5')
+    # 第一个和中间的染色体没有结果
+    write_nominal(prefix, '1', [])
+    write_nominal(prefix, '2', [('g2', 'v4', 10, 0.3, 1e-3, 0.2), ('g2', 'v3', -90, 0.3, 1e-2, 0.1)])
+    write_nominal(prefix, '3', [])
+    store_root = tmp_path / 'store'
+    build_store(prefix, str(store_root / '1_n_5'), VARIANTS, row_group_size=1)
+
+    store = NominalStore(str(store_root), variant_df=VARIANTS)
+    assert list(store.by_gene('g2')['variant_id']) == ['v3', 'v4']
+    assert store.by_region('1', 0, 1000).empty
+    genes = pd.read_csv(store_root / '1_n_5' / 'genes.tsv', sep='\t')
+    assert list(genes['phenotype_id']) == ['g2']
+
+def test_build_store_all_empty(tmp_path):
+    prefix = str(tmp_path / '1_n_5')
+    write_nominal(prefix, '1', [])
+    store_root = tmp_path / 'store'
+    build_store(prefix, str(store_root / '1_n_5'), VARIANTS)
+    assert NominalStore(str(store_root)).by_gene('g1').empty
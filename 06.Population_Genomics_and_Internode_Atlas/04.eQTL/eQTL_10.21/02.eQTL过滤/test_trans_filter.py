@@ -0,0 +1,28 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from trans_filter import TransFilterSink
+
+def make_sink():
+    variant_df = pd.DataFrame({'chrom': ['1'], 'pos': [100]}, index=pd.Index(['v1'], name='variant_id'))
+    phenotype_pos_df = pd.DataFrame({'chr': ['2'], 'pos': [1000]}, index=pd.Index(['g1'], name='phenotype_id'))
+    return TransFilterSink(variant_df, phenotype_pos_df)
+
+def test_sink_removes_spill_dir_when_mapping_fails():
+    batch = pd.DataFrame({'phenotype_id': ['g1'], 'variant_id': ['v1'], 'pval': [1e-12], 'b': [0.5],
+                          'b_se': [0.1], 'af': [0.3]})
+    with pytest.raises(RuntimeError):
+        with make_sink() as sink:
+            sink(batch)
+            tmp_dir = sink.bh.tmp_dir
+            assert os.path.isdir(tmp_dir)
+            raise RuntimeError('mapping failed')
+    assert not os.path.exists(tmp_dir)
+
+def test_sink_close_after_finish():
+    with make_sink() as sink:
+        assert sink.finish().empty
+    assert not os.path.exists(sink.bh.tmp_dir)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+'''
+trans-eQTL 扫描引擎
+
+map_trans_multi: 同一时期（相同样本和协变量）的多组表型矩阵（如 PEER K=5..40 的残差）
+共用基因型批次：每个基因型批次只解码、填补、MAF过滤和残差化一次，
+再依次与每组表型计算关联，每组输出一个与 tensorqtl.trans.map_trans 相同格式的稀疏结果。
+
+map_trans_cpu: 纯 CPU（NumPy/BLAS, float32）分块 trans 扫描，变异 × 基因切分为小块在线程池中计算，
+只有最大 |r| 超过 p 值阈值对应 r 阈值的块才计算 p 值，通过的位点对可直接流式写入文件。
+'''
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import torch
+from scipy import stats
+from tensorqtl import genotypeio
+from tensorqtl.core import Residualizer, impute_mean, filter_maf, center_normalize, get_t_pval
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+TRANS_COLUMNS = ['variant_id', 'phenotype_id', 'pval', 'b', 'b_se', 'af']
+
+def map_trans_multi(genotype_df, phenotype_dfs, covariates_df=None, pval_threshold=1e-5,
+                    maf_threshold=0.05, batch_size=20000, verbose=True):
+    """
+    对多组表型矩阵进行 trans-QTL 扫描，基因型批次在各组之间共享。
+
+    参数:
+        genotype_df (pd.DataFrame): 基因型（行为变异，列为样本）。
+        phenotype_dfs (dict): {名称: 表型DataFrame（行为基因，列为样本）}，各组样本顺序必须一致。
+        covariates_df (pd.DataFrame): 协变量（行为样本）。
+        pval_threshold (float): 稀疏输出的 p 值阈值。
+        maf_threshold (float): MAF 阈值。
+        batch_size (int): 每批变异数。
+
+    返回:
+        dict: {名称: DataFrame(variant_id, phenotype_id, pval, b, b_se, af)}
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    names = list(phenotype_dfs)
+    samples = phenotype_dfs[names[0]].columns
+    for name in names[1:]:
+        assert phenotype_dfs[name].columns.equals(samples), f"Samples of phenotype set {name} do not match"
+
+    n_samples = len(samples)
+    dof = n_samples - 2
+    if covariates_df is not None:
+        assert np.all(samples == covariates_df.index)
+        residualizer = Residualizer(torch.tensor(covariates_df.values, dtype=torch.float32).to(device))
+        dof -= covariates_df.shape[1]
+    else:
+        residualizer = None
+
+    # 表型只残差化和标准化一次
+    phenotypes = {}
+    for name in names:
+        phenotype_t = torch.tensor(phenotype_dfs[name].values, dtype=torch.float32).to(device)
+        if residualizer is not None:
+            phenotype_t = residualizer.transform(phenotype_t)
+        phenotypes[name] = (center_normalize(phenotype_t, dim=1), phenotype_t.var(1))
+        del phenotype_t
+
+    if verbose:
+        print(f"trans-QTL mapping: {n_samples} samples, {len(names)} phenotype sets, {genotype_df.shape[0]} variants")
+
+    # p 值阈值对应的相关系数阈值
+    tstat_threshold = -stats.t.ppf(pval_threshold / 2, dof)
+    r_threshold = tstat_threshold / np.sqrt(dof + tstat_threshold ** 2)
+
+    genotype_ix = genotype_df.columns.get_indexer(samples)
+    genotype_ix_t = torch.from_numpy(genotype_ix).to(device)
+
+    res = {name: [] for name in names}
+    n_variants = 0
+    start_time = time.time()
+    ggt = genotypeio.GenotypeGeneratorTrans(genotype_df, batch_size=batch_size)
+    for genotypes, variant_ids in ggt.generate_data(verbose=verbose):
+        # 基因型批次：填补、MAF过滤、残差化和标准化，各组表型共用
+        genotypes_t = torch.tensor(genotypes, dtype=torch.float).to(device)
+        genotypes_t = genotypes_t[:, genotype_ix_t]
+        impute_mean(genotypes_t)
+        genotypes_t, variant_ids, af_t = filter_maf(genotypes_t, variant_ids, maf_threshold)
+        n_variants += genotypes_t.shape[0]
+        if residualizer is not None:
+            genotypes_t = residualizer.transform(genotypes_t)
+        genotype_var_t = genotypes_t.var(1)
+        genotypes_t = center_normalize(genotypes_t, dim=1)
+
+        for name in names:
+            phenotype_t, phenotype_var_t = phenotypes[name]
+            r_t = torch.mm(genotypes_t, phenotype_t.t())
+            m = r_t.abs() >= r_threshold
+            ix_t = m.nonzero(as_tuple=False)
+            ix = ix_t.cpu().numpy()
+
+            r_t = r_t.masked_select(m).type(torch.float64)
+            r2_t = r_t.pow(2)
+            tstat_t = r_t * torch.sqrt(dof / (1 - r2_t))
+            std_ratio_t = torch.sqrt(phenotype_var_t[ix_t[:, 1]] / genotype_var_t[ix_t[:, 0]])
+            b_t = r_t * std_ratio_t
+            b_se_t = (b_t / tstat_t).type(torch.float32)
+            res[name].append(np.c_[
+                variant_ids[ix[:, 0]], phenotype_dfs[name].index[ix[:, 1]],
+                tstat_t.cpu(), b_t.cpu(), b_se_t.cpu(), af_t[ix_t[:, 0]].cpu()
+            ])
+        del genotypes_t
+
+    if verbose:
+        print(f"  * {n_variants} variants passed MAF >= {maf_threshold} filtering")
+        print(f"  elapsed time: {(time.time() - start_time) / 60:.2f} min")
+
+    # 合并批次，计算 p 值
+    results = {}
+    for name in names:
+        r = np.concatenate(res[name]) if res[name] else np.empty((0, 6), dtype=object)
+        r[:, 2] = get_t_pval(r[:, 2].astype(np.float64), dof)
+        pval_df = pd.DataFrame(r, columns=['variant_id', 'phenotype_id', 'pval', 'b', 'b_se', 'af'])
+        pval_df['pval'] = pval_df['pval'].astype(np.float64)
+        for col in ['b', 'b_se', 'af']:
+            pval_df[col] = pval_df[col].astype(np.float32)
+        results[name] = pval_df
+    return results
+
+def _residualize(M, Q):
+    """按行对协变量残差化（Q 为中心化协变量的正交基，None 时只中心化）"""
+    M0 = M - M.mean(axis=1, keepdims=True)
+    if Q is not None:
+        M0 -= (M0 @ Q) @ Q.T
+    return M0
+
+def _normalize(M):
+    """按行中心化并单位化，返回标准化矩阵和方差"""
+    var = M.var(axis=1, ddof=1)
+    M = M - M.mean(axis=1, keepdims=True)
+    M /= np.sqrt((M * M).sum(axis=1, keepdims=True))
+    return M, var
+
+def _scan_tile(genotypes, genotype_var, phenotypes, phenotype_var, r_threshold, dof):
+    """计算一个变异 × 基因块的相关，返回通过阈值的 (变异下标, 基因下标, t, b, b_se)"""
+    r = genotypes @ phenotypes.T
+    # 先用块内最大/最小值判断，整块都不显著时直接跳过
+    if r.size == 0 or (r.max() < r_threshold and r.min() > -r_threshold):
+        return None
+    ix, jx = np.nonzero(np.abs(r) >= r_threshold)
+    r = r[ix, jx].astype(np.float64)
+    tstat = r * np.sqrt(dof / (1 - r * r))
+    b = r * np.sqrt(phenotype_var[jx] / genotype_var[ix])
+    return ix, jx, tstat, b, (b / tstat).astype(np.float32)
+
+def map_trans_cpu(genotype_df, phenotype_df, covariates_df=None, pval_threshold=1e-5,
+                  maf_threshold=0.05, batch_size=20000, variant_block=4096, phenotype_block=2048,
+                  n_threads=None, out_file=None, sep='\t', on_batch=None, verbose=True):
+    """
+    纯 CPU 分块 trans-QTL 扫描，结果与 tensorqtl.trans.map_trans（return_sparse=True）一致。
+
+    参数:
+        variant_block (int): 每块的变异数（每个基因型批次再切分）。
+        phenotype_block (int): 每块的基因数。
+        n_threads (int): 线程数，默认使用全部CPU核；块内 BLAS 设为单线程。
+        out_file (str): 不为空时每个基因型批次的结果直接追加写入该文件，返回写出的位点对数。
+        on_batch (callable): 不为空时每个基因型批次的结果交给 on_batch(batch_df) 处理，不在内存中累积，
+            返回位点对数。
+
+    返回:
+        pd.DataFrame(variant_id, phenotype_id, pval, b, b_se, af)，或 out_file/on_batch 模式下的位点对数。
+    """
+    n_threads = n_threads or os.cpu_count() or 1
+    samples = phenotype_df.columns
+    n_samples = len(samples)
+    dof = n_samples - 2
+
+    Q = None
+    if covariates_df is not None:
+        assert np.all(samples == covariates_df.index)
+        C = covariates_df.values.astype(np.float64)
+        Q = np.linalg.qr(C - C.mean(axis=0))[0].astype(np.float32)
+        dof -= covariates_df.shape[1]
+
+    tstat_threshold = -stats.t.ppf(pval_threshold / 2, dof)
+    r_threshold = tstat_threshold / np.sqrt(dof + tstat_threshold ** 2)
+
+    # 表型只残差化和标准化一次，再切分为基因块
+    phenotypes, phenotype_var = _normalize(_residualize(phenotype_df.values.astype(np.float32), Q))
+    blocks = [(j, min(j + phenotype_block, len(phenotypes))) for j in range(0, len(phenotypes), phenotype_block)]
+    phenotype_ids = phenotype_df.index.values
+
+    if verbose:
+        print(f"trans-QTL mapping (CPU, {n_threads} threads): {n_samples} samples, "
+              f"{phenotype_df.shape[0]} phenotypes, {genotype_df.shape[0]} variants")
+
+    genotype_ix = genotype_df.columns.get_indexer(samples)
+    variant_ids_all = genotype_df.index.values
+    genotype_values = genotype_df.values
+    res, n_written, n_variants = [], 0, 0
+    start_time = time.time()
+    if out_file is not None:
+        pd.DataFrame(columns=TRANS_COLUMNS).to_csv(out_file, sep=sep, index=False)
+
+    limits = threadpool_limits(limits=1, user_api='blas') if threadpool_limits is not None else None
+    try:
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            for start in range(0, genotype_values.shape[0], batch_size):
+                end = min(start + batch_size, genotype_values.shape[0])
+                genotypes = genotype_values[start:end][:, genotype_ix].astype(np.float32)
+                variant_ids = variant_ids_all[start:end]
+
+                # 缺失值（-9）以均值填补
+                missing = genotypes == -9
+                if missing.any():
+                    n_obs = n_samples - missing.sum(axis=1)
+                    mu = np.where(missing, 0, genotypes).sum(axis=1) / np.maximum(n_obs, 1)
+                    genotypes[missing] = np.broadcast_to(mu[:, None], genotypes.shape)[missing]
+
+                # MAF 过滤
+                af = genotypes.sum(axis=1) / (2 * n_samples)
+                maf = np.where(af > 0.5, 1 - af, af)
+                if maf_threshold > 0:
+                    keep = maf >= maf_threshold
+                    genotypes, variant_ids, af = genotypes[keep], variant_ids[keep], af[keep]
+                n_variants += len(genotypes)
+                if len(genotypes) == 0:
+                    continue
+
+                genotypes, genotype_var = _normalize(_residualize(genotypes, Q))
+
+                # 变异 × 基因分块并行计算
+                tiles = [(i0, j0) for i0 in range(0, len(genotypes), variant_block) for j0, _ in blocks]
+                futures = [pool.submit(_scan_tile, genotypes[i0:i0 + variant_block], genotype_var[i0:i0 + variant_block],
+                                       phenotypes[j0:j0 + phenotype_block], phenotype_var[j0:j0 + phenotype_block],
+                                       r_threshold, dof) for i0, j0 in tiles]
+                parts = []
+                for (i0, j0), future in zip(tiles, futures):
+                    hit = future.result()
+                    if hit is None:
+                        continue
+                    ix, jx, tstat, b, b_se = hit
+                    ix = ix + i0
+                    parts.append(pd.DataFrame({
+                        'variant_id': variant_ids[ix], 'phenotype_id': phenotype_ids[j0 + jx],
+                        'pval': get_t_pval(tstat, dof), 'b': b.astype(np.float32), 'b_se': b_se,
+                        'af': af[ix].astype(np.float32),
+                    }))
+                if not parts:
+                    continue
+                batch_df = pd.concat(parts, ignore_index=True)
+                if out_file is not None:
+                    batch_df.to_csv(out_file, sep=sep, index=False, header=False, mode='a')
+                if on_batch is not None:
+                    on_batch(batch_df)
+                if out_file is not None or on_batch is not None:
+                    n_written += len(batch_df)
+                else:
+                    res.append(batch_df)
+    finally:
+        if limits is not None:
+            limits.unregister()
+
+    if verbose:
+        print(f"  * {n_variants} variants passed MAF >= {maf_threshold} filtering")
+        print(f"  elapsed time: {(time.time() - start_time) / 60:.2f} min")
+
+    if out_file is not None or on_batch is not None:
+        return n_written
+    if not res:
+        return pd.DataFrame(columns=TRANS_COLUMNS)
+    return pd.concat(res, ignore_index=True)
+
+def count_maf_variants(genotype_df, samples, maf_threshold=0.05, batch_size=20000):
+    """
+    统计 trans 扫描中通过 MAF 过滤的变异数（缺失值按均值填补，与 map_trans_cpu 一致），
+    乘以基因数即为 BH 校正的实际检验数。
+    """
+    genotype_ix = genotype_df.columns.get_indexer(samples)
+    genotype_values = genotype_df.values
+    n_variants = 0
+    for start in range(0, genotype_values.shape[0], batch_size):
+        genotypes = genotype_values[start:start + batch_size][:, genotype_ix].astype(np.float32)
+        missing = genotypes == -9
+        n_obs = len(genotype_ix) - missing.sum(axis=1)
+        af = np.where(missing, 0, genotypes).sum(axis=1) / (2 * np.maximum(n_obs, 1))
+        maf = np.where(af > 0.5, 1 - af, af)
+        n_variants += int((maf >= maf_threshold).sum())
+    return n_variants
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+trans-eQTL 映射过程中的流式过滤和注释
+
+TransFilterSink 逐批接收 trans 映射结果（tensorqtl 稀疏格式），在映射循环中完成
+p值、效应大小、MAF 和距离（真正的 trans）过滤，添加位置注释，并只保留每个基因
+p值最小的前 N 个位点对；所有批次的 p 值写入外存 BH 校正器，最后计算 q 值。
+结果与先写出 *_trans_all_significant.txt 再运行 filter_true_trans_eqtls.py 的流程一致
+（位置取自基因型变异表和表达BED，而不是解析变异ID）。
+'''
+
+import numpy as np
+import pandas as pd
+from filter_trans_eqtls import top_snps_per_gene
+from fdr import StreamingBH
+
+class TransFilterSink:
+    """
+    参数:
+        variant_df (DataFrame): 以 variant_id 为索引，包含 chrom 和 pos 列。
+        phenotype_pos_df (DataFrame): 表达BED中的基因位置（chr 和 pos 或 start 列）。
+        pval_threshold (float): 原始 p 值阈值。
+        effect_size_threshold (float): 最小 |slope|。
+        min_maf (float): 最小次等位基因频率。
+        distance_threshold (int): 同一染色体上被视为 trans 的最小距离。
+        snps_per_gene (int): 每个基因保留的位点对数。
+        raw_file (str): 不为空时把未过滤的稀疏结果逐批写入该文件。
+        n_tests (int): BH 分母，默认为映射输出的位点对数。
+    """
+
+    def __init__(self, variant_df, phenotype_pos_df, pval_threshold=1e-8, effect_size_threshold=0.1,
+                 min_maf=0.05, distance_threshold=5000000, snps_per_gene=5, raw_file=None, n_tests=None):
+        self.variant_df = variant_df
+        self.gene_chrom = phenotype_pos_df['chr'].astype(str)
+        self.gene_pos = phenotype_pos_df['pos' if 'pos' in phenotype_pos_df else 'start']
+        self.pval_threshold = pval_threshold
+        self.effect_size_threshold = effect_size_threshold
+        self.min_maf = min_maf
+        self.distance_threshold = distance_threshold
+        self.snps_per_gene = snps_per_gene
+        self.raw_file = raw_file
+        self.bh = StreamingBH(n_tests=n_tests)
+        self.top_df = None
+        self.n_pairs = 0
+
+    def __call__(self, batch_df):
+        if self.raw_file is not None:
+            batch_df.to_csv(self.raw_file, sep='\t', index=False, header=self.n_pairs == 0,
+                            mode='w' if self.n_pairs == 0 else 'a')
+        self.n_pairs += len(batch_df)
+        self.bh.add(batch_df['pval'].values)
+
+        # 不依赖 q 值的过滤
+        af = batch_df['af'].values
+        mask = (batch_df['pval'].values < self.pval_threshold) \
+            & (np.abs(batch_df['b'].values) > self.effect_size_threshold) \
+            & (np.minimum(af, 1 - af) >= self.min_maf)
+        df = batch_df[mask].rename(columns={'b': 'slope', 'b_se': 'slope_se'})
+        if df.empty:
+            return
+
+        # 位置注释和距离分类
+        variant_ix = self.variant_df.index.get_indexer(df['variant_id'])
+        gene_ix = self.gene_chrom.index.get_indexer(df['phenotype_id'])
+        var_chrom = self.variant_df['chrom'].astype(str).values[variant_ix]
+        var_pos = self.variant_df['pos'].values[variant_ix]
+        gene_chrom = self.gene_chrom.values[gene_ix]
+        gene_pos = self.gene_pos.values[gene_ix]
+        same_chrom = gene_chrom == var_chrom
+        abs_distance = np.abs(gene_pos - var_pos)
+        df = df.assign(gene_chrom=gene_chrom, gene_pos=gene_pos, var_chrom=var_chrom, var_pos=var_pos,
+                       distance=np.where(same_chrom, abs_distance, np.inf))
+        df = df[df['distance'].values > self.distance_threshold]
+
+        # 已保留的行都在当前批次之前，合并后稳定排序与整体排序的结果相同
+        self.top_df = df if self.top_df is None else pd.concat([self.top_df, df], ignore_index=True)
+        self.top_df = top_snps_per_gene(self.top_df, self.snps_per_gene)
+
+    def close(self):
+        """删除 BH 校正器的外存目录（finish 后或映射出错时调用，可重复调用）"""
+        self.bh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def finish(self, fdr_threshold=0.05):
+        """对全部位点对做 BH 校正，返回 q 值通过阈值的注释结果（每个基因最多 snps_per_gene 个）"""
+        if self.top_df is None or self.top_df.empty:
+            self.bh.close()
+            return pd.DataFrame()
+        df = self.top_df
+        # q 值随 p 值单调，先取每基因前N个再按 q 值过滤与先过滤再取前N个结果相同
+        self.bh.finalize()
+        qval = self.bh.qvalues(df['pval'].values)
+        self.bh.close()
+        df.insert(df.columns.get_loc('af') + 1, 'qval', qval)
+        df.insert(df.columns.get_loc('qval') + 1, 'effect_direction',
+                  np.where(df['slope'] > 0, 'positive', 'negative'))
+        df = df[df['qval'] < fdr_threshold].copy()
+        same_chrom = np.isfinite(df['distance'].values)
+        abs_distance = np.where(same_chrom, df['distance'].values, 0).astype(np.int64)
+        df['trans_type'] = np.where(
+            same_chrom, 'same_chrom_' + abs_distance.astype(str).astype(object) + 'bp', 'different_chrom'
+        )
+        return df